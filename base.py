@@ -7,10 +7,16 @@ import larpix
 import larpix.io
 import larpix.logger
 
+import pacman_sim
+import instrumentation
+import latency
+import confirmed_write
+
 _default_controller_config=None
 _default_pacman_version='v1rev3'
 _default_logger=False
 _default_reset=True
+_default_simulate=None
 
 ##### default network (single chip) if no hydra network provided
 _default_chip_id = 2
@@ -52,11 +58,12 @@ def flush_data(controller, runtime=0.1, rate_limit=0., max_iterations=10):
             break
 
         
-def main(controller_config=_default_controller_config, pacman_version=_default_pacman_version, logger=_default_logger, reset=_default_reset, **kwargs):
+def main(controller_config=_default_controller_config, pacman_version=_default_pacman_version, logger=_default_logger, reset=_default_reset, simulate=_default_simulate, **kwargs):
     print('[START BASE]')
     ###### create controller with pacman io
     c = larpix.Controller()
-    c.io = larpix.io.PACMAN_IO(relaxed=True)
+    c.io = pacman_sim.create_io(simulate)
+    instrumentation.instrument(c)
 
     
     ###### set power to tile    
@@ -163,29 +170,25 @@ def main(controller_config=_default_controller_config, pacman_version=_default_p
     ##### issue soft reset (resets state machines, configuration memory untouched)
     c.io.reset_larpix(length=24)
 
+    ##### measure UART round trip per io_channel and hop depth for verify / enforce timeouts
+    c.latency = latency.measure_network(c, clk_ratio=clk_ctrl_2_clk_ratio_map[_default_clk_ctrl])
+
 
     ##### setup low-level registers to enable loopback
     print('set base configuration: Vref DAC, Vcm DAC, ADC hold delay, MISO differential')
-    chip_config_pairs=[]
+    chip_register_pairs=[]
     for chip_key, chip in reversed(c.chips.items()):
-        initial_config = deepcopy(chip.config)
         c[chip_key].config.vref_dac = 185 # register 82
         c[chip_key].config.vcm_dac = 41 # register 83
         c[chip_key].config.adc_hold_delay = 15 # register 129
         c[chip_key].config.enable_miso_differential = [1,1,1,1] # register 125
-        chip_config_pairs.append((chip_key,initial_config))
-    c.io.double_send_packets = True
+        chip_register_pairs.append((chip_key,[82,83,125,129]))
     c.io.gruop_packets_by_io_group = True
-    chip_register_pairs = c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=0.01)
-    chip_register_pairs = c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=0.01)
+    ###### one write (packets sent once), then only registers that read back wrong are re-sent
+    ok,diff = confirmed_write.multi_write(c, chip_register_pairs, timeout=0.01, n=10, n_verify=10, connection_delay=0.01)
     flush_data(c)
-
-    for chip_key in c.chips:
-        chip_registers = [(chip_key, i) for i in [82,83,125,129]]
-        ok,diff = c.enforce_registers(chip_registers, timeout=0.01, n=10, n_verify=10)
-        if not ok:
-            raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
-    c.io.double_send_packets = False
+    if not ok:
+        raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
     c.io.gruop_packets_by_io_group = False
     print('base configuration successfully enforced')
     
@@ -200,6 +203,7 @@ if __name__ == '__main__':
     parser.add_argument('--pacman_version', default=_default_pacman_version, type=str, help='''Pacman version in use''')
     parser.add_argument('--logger', default=_default_logger, action='store_true', help='''Flag to create an HDF5Logger object to track data''')
     parser.add_argument('--no_reset', default=_default_reset, action='store_false', help='''Flag that if present, chips will NOT be reset, otherwise chips will be reset during initialization''')
+    parser.add_argument('--simulate', default=_default_simulate, nargs='?', const='', type=str, help='''Use the hardware-free PACMAN simulator, optionally with a JSON sim config file''')
     args = parser.parse_args()
     c = main(**vars(args))
 
@@ -7,10 +7,15 @@ import larpix
 import larpix.io
 import larpix.logger
 
+import pacman_sim
+import instrumentation
+import latency
+
 _default_controller_config=None
 _default_pacman_version='v1rev3'
 _default_logger=False
 _default_reset=True
+_default_simulate=None
 
 ##### default network (single chip) if no hydra network provided
 _default_chip_id = 2
@@ -52,11 +57,12 @@ def flush_data(controller, runtime=0.1, rate_limit=0., max_iterations=10):
             break
 
         
-def main(controller_config=_default_controller_config, pacman_version=_default_pacman_version, logger=_default_logger, reset=_default_reset, **kwargs):
+def main(controller_config=_default_controller_config, pacman_version=_default_pacman_version, logger=_default_logger, reset=_default_reset, simulate=_default_simulate, **kwargs):
     print('[START BASE]')
     ###### create controller with pacman io
     c = larpix.Controller()
-    c.io = larpix.io.PACMAN_IO(relaxed=True)
+    c.io = pacman_sim.create_io(simulate)
+    instrumentation.instrument(c)
 
     
     ###### set power to tile    
@@ -163,6 +169,9 @@ def main(controller_config=_default_controller_config, pacman_version=_default_p
     ##### issue soft reset (resets state machines, configuration memory untouched)
     c.io.reset_larpix(length=24)
 
+    ##### measure UART round trip per io_channel and hop depth for verify / enforce timeouts
+    c.latency = latency.measure_network(c, clk_ratio=clk_ctrl_2_clk_ratio_map[_default_clk_ctrl])
+
 
     ##### setup low-level registers to enable loopback
     print('set base configuration: Vref DAC, Vcm DAC, ADC hold delay, MISO differential')
@@ -200,6 +209,7 @@ if __name__ == '__main__':
     parser.add_argument('--pacman_version', default=_default_pacman_version, type=str, help='''Pacman version in use''')
     parser.add_argument('--logger', default=_default_logger, action='store_true', help='''Flag to create an HDF5Logger object to track data''')
     parser.add_argument('--no_reset', default=_default_reset, action='store_false', help='''Flag that if present, chips will NOT be reset, otherwise chips will be reset during initialization''')
+    parser.add_argument('--simulate', default=_default_simulate, nargs='?', const='', type=str, help='''Use the hardware-free PACMAN simulator, optionally with a JSON sim config file''')
     args = parser.parse_args()
     c = main(**vars(args))
 
@@ -0,0 +1,208 @@
+'''
+End-to-end QC benchmark against simulated tiles
+
+Runs the QC chain (base configuration, UART link mapping, pedestal run and
+evaluation, threshold trimming, trigger-rate scan, plot_anode parsing) on
+synthetic networks of 100-chip tiles using the PACMAN simulator, and records
+per-stage wall time, UART transactions and peak (Python) memory to a JSON
+baseline. Given a previous baseline, stages that got worse by more than the
+tolerance are flagged as regressions.
+
+Usage:
+    python3 benchmark_qc.py --tiles 1 8 16 --output bench.json --baseline bench_old.json
+
+'''
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from collections import Counter
+
+import graphs
+import pacman_sim
+import instrumentation
+import base
+import map_uart_links_qc
+import pedestal_qc
+import threshold_qc
+import trigger_rate_qc
+
+_default_tiles=[1, 8, 16]
+_default_stages=['base','map_uart_links','pedestal','pedestal_evaluation','threshold','trigger_rate','plot_anode']
+_default_sim_config=''
+_default_map_tiles=1
+_default_pedestal_runtime=5.
+_default_trigger_rate_runtime=0.5
+_default_workdir='benchmark_output'
+_default_output=None
+_default_baseline=None
+_default_tolerance=0.2
+_default_trace=None
+_default_geometry_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'multi_tile_layout-2.2.16-dict.json')
+
+metrics = ['wall_time', 'uart_transactions', 'peak_memory_mb']
+tiles_per_io_group = 8
+
+def synthetic_network_config(n_tiles, filename):
+    ###### hydra network of n_tiles full tiles, 8 tiles per io_group
+    network = dict(miso_us_uart_map=[3,0,1,2], miso_ds_uart_map=[1,2,3,0], mosi_uart_map=[2,3,0,1])
+    for itile in range(n_tiles):
+        io_group = 1 + itile // tiles_per_io_group
+        tile = 1 + itile % tiles_per_io_group
+        arr = graphs.NumberedArrangement()
+        paths = arr.get_path([ [root] for root in pacman_sim.root_chips ])
+        network.setdefault(str(io_group), dict())
+        for n, path in enumerate(paths):
+            nodes = [ {"chip_id" : 'ext', "miso_us": [None,None,None,path[0]], "root" : True} ]
+            for k, chip in enumerate(path):
+                if k < len(path)-1: nodes.append({'chip_id' : chip, "miso_us" : arr.get_map(chip, path[k+1])})
+                else: nodes.append({'chip_id' : chip, "miso_us" : [None, None, None, None]})
+            network[str(io_group)][str(pacman_sim.io_channel_of_root(tile, path[0]))] = dict(nodes=nodes)
+    with open(filename,'w') as f:
+        json.dump({"_config_type": "controller", "name": 'synthetic-{}-tiles'.format(n_tiles),
+                   "asic_version": 2, "layout": "2.5.0", "network": network}, f, indent=4)
+    return filename
+
+
+def measure(record, stage, function, *args, **kwargs):
+    print('[BENCHMARK] stage',stage)
+    uart_before = Counter(pacman_sim.uart_counters)
+    calls_before = Counter(instrumentation.counters)
+    tracemalloc.reset_peak()
+    start = time.time()
+    with instrumentation.stage(stage, verbose=False):
+        result = function(*args, **kwargs)
+    wall_time = time.time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    uart = pacman_sim.uart_counters - uart_before
+    calls = instrumentation.counters - calls_before
+    record[stage] = dict(
+        wall_time = wall_time,
+        uart_transactions = uart['packets_sent'] + uart['packets_received'],
+        packets_sent = uart['packets_sent'],
+        packets_received = uart['packets_received'],
+        peak_memory_mb = peak / 1e6,
+        retries = calls['retries'],
+        listen_time = calls['listen_time']
+        )
+    print('[BENCHMARK] ==> %.3f seconds --- %s'%(wall_time, stage))
+    return result
+
+
+def run_pedestal(controller_config, sim_config, runtime, ped_fname, disabled_channels):
+    ###### same sequence as pedestal_qc.main, without the cooling wait and refinement pass
+    periodic_trigger_cycles = pedestal_qc._default_periodic_trigger_cycles
+    c = base.main(controller_config=controller_config, logger=True, filename=ped_fname, simulate=sim_config)
+    pedestal_qc.configure_pedestal(c, periodic_trigger_cycles, disabled_channels)
+    base.flush_data(c, rate_limit=(1+1/(periodic_trigger_cycles*1e-7)*len(c.chips)))
+    pedestal_qc.run_pedestal(c, runtime)
+    c.io.reset_larpix(length=24)
+
+
+def run_map_uart_links(n_map_tiles, sim_config):
+    map_uart_links_qc.arr = graphs.NumberedArrangement()
+    pacman_tiles = list(range(1, n_map_tiles+1))
+    map_uart_links_qc.main(None, False, None, 'v1rev3', simulate=sim_config,
+                           pacman_tiles=pacman_tiles, tile_ids=['benchmark-{}'.format(tile) for tile in pacman_tiles])
+
+
+def run_benchmark(n_tiles, stages, sim_config, map_tiles, pedestal_runtime, trigger_rate_runtime, geometry_file):
+    record = dict()
+    controller_config = synthetic_network_config(n_tiles, 'synthetic-{}-tiles.json'.format(n_tiles))
+    ped_fname = 'benchmark-pedestal-{}-tiles.h5'.format(n_tiles)
+    disabled_channels = {"All": threshold_qc.nonrouted_channels}
+
+    if 'base' in stages:
+        measure(record, 'base', base.main, controller_config=controller_config, simulate=sim_config)
+    if 'map_uart_links' in stages:
+        measure(record, 'map_uart_links', run_map_uart_links, min(map_tiles, n_tiles, tiles_per_io_group), sim_config)
+    if 'pedestal' in stages:
+        measure(record, 'pedestal', run_pedestal, controller_config, sim_config, pedestal_runtime, ped_fname, disabled_channels)
+    if 'pedestal_evaluation' in stages and os.path.isfile(ped_fname):
+        measure(record, 'pedestal_evaluation', pedestal_qc.evaluate_pedestal, ped_fname, disabled_channels,
+                pedestal_qc._default_baseline_cut_value, False, pedestal_qc._default_noise_cut_value, False)
+    if 'threshold' in stages and os.path.isfile(ped_fname):
+        measure(record, 'threshold', threshold_qc.main, controller_config=controller_config, pedestal_file=ped_fname, simulate=sim_config)
+    if 'trigger_rate' in stages:
+        measure(record, 'trigger_rate', trigger_rate_qc.main, controller_config=controller_config, runtime=trigger_rate_runtime, simulate=sim_config)
+    if 'plot_anode' in stages and os.path.isfile(ped_fname):
+        import plot_anode
+        geo = plot_anode.load_geometry(geometry_file)
+        measure(record, 'plot_anode', plot_anode.parse_packets, ped_fname, geo)
+    return record
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for config_name, record in results.items():
+        for stage, values in record.items():
+            old = baseline.get(config_name, dict()).get(stage)
+            if old is None: continue
+            for metric in metrics:
+                if metric not in old or old[metric] <= 0: continue
+                if values[metric] > old[metric]*(1+tolerance):
+                    regressions.append((config_name, stage, metric, old[metric], values[metric]))
+    return regressions
+
+
+def main(tiles=_default_tiles, stages=_default_stages, sim_config=_default_sim_config, map_tiles=_default_map_tiles,
+         pedestal_runtime=_default_pedestal_runtime, trigger_rate_runtime=_default_trigger_rate_runtime,
+         workdir=_default_workdir, output=_default_output, baseline=_default_baseline, tolerance=_default_tolerance,
+         geometry_file=_default_geometry_file, trace=_default_trace):
+    print('START BENCHMARK')
+    if trace: instrumentation.open_trace(os.path.abspath(trace))
+    if sim_config: sim_config = os.path.abspath(sim_config)
+    geometry_file = os.path.abspath(geometry_file)
+    if output: output = os.path.abspath(output)
+    if baseline: baseline = os.path.abspath(baseline)
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    tracemalloc.start()
+    results = dict()
+    try:
+        for n_tiles in tiles:
+            results['{}_tiles'.format(n_tiles)] = run_benchmark(n_tiles, stages, sim_config, map_tiles,
+                                                                pedestal_runtime, trigger_rate_runtime, geometry_file)
+    finally:
+        tracemalloc.stop()
+        os.chdir(cwd)
+
+    print('\n===========\t benchmark summary \t===========')
+    for config_name, record in results.items():
+        for stage, values in record.items():
+            print('{:>10} {:>20}\t{:10.3f} s\t{:10d} UART packets\t{:8.1f} MB'.format(
+                config_name, stage, values['wall_time'], values['uart_transactions'], values['peak_memory_mb']))
+
+    if output:
+        with open(output,'w') as f: json.dump(results, f, indent=4)
+        print('benchmark saved to',output)
+
+    regressions = []
+    if baseline:
+        with open(baseline,'r') as f: regressions = compare(results, json.load(f), tolerance)
+        for config_name, stage, metric, old, new in regressions:
+            print('REGRESSION {} {} {}: {:.3f} -> {:.3f}'.format(config_name, stage, metric, old, new))
+        print('\n===========\t',len(regressions),' regressions vs',baseline,'\t===========')
+    print('END BENCHMARK')
+    return results, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tiles', default=_default_tiles, nargs='+', type=int, help='''Number of 100-chip tiles per benchmark configuration (default=%(default)s)''')
+    parser.add_argument('--stages', default=_default_stages, nargs='+', type=str, help='''QC stages to run (default=%(default)s)''')
+    parser.add_argument('--sim_config', default=_default_sim_config, type=str, help='''JSON sim config file for the PACMAN simulator''')
+    parser.add_argument('--map_tiles', default=_default_map_tiles, type=int, help='''Number of tiles to run UART link mapping on (default=%(default)s)''')
+    parser.add_argument('--pedestal_runtime', default=_default_pedestal_runtime, type=float, help='''Pedestal run duration [s] (default=%(default)s)''')
+    parser.add_argument('--trigger_rate_runtime', default=_default_trigger_rate_runtime, type=float, help='''Per-ASIC trigger rate window [s] (default=%(default)s)''')
+    parser.add_argument('--workdir', default=_default_workdir, type=str, help='''Directory for files written by the QC scripts (default=%(default)s)''')
+    parser.add_argument('--output', default=_default_output, type=str, help='''JSON file to save the benchmark results to''')
+    parser.add_argument('--baseline', default=_default_baseline, type=str, help='''Previous benchmark JSON to flag regressions against''')
+    parser.add_argument('--tolerance', default=_default_tolerance, type=float, help='''Fractional increase counted as a regression (default=%(default)s)''')
+    parser.add_argument('--geometry_file', default=_default_geometry_file, type=str, help='''Path to geometry file''')
+    parser.add_argument('--trace', default=_default_trace, type=str, help='''Append per-stage timing and UART transaction counts to this JSON-lines file''')
+    args = parser.parse_args()
+    results, regressions = main(**vars(args))
+    if regressions: exit(1)
@@ -0,0 +1,219 @@
+'''
+ASIC configuration archive helpers
+
+threshold_qc writes one config-<chip_key>-<timestamp>.json per chip and
+run, so a configs directory accumulates many files per chip. ConfigIndex
+scans the directory once and keeps the newest file of each chip (the last
+in sorted filename order, as when globbing per chip), and load_configs
+reads the selected files in a thread pool.
+
+A Snapshot holds the register values of many chips as one (chip x register)
+uint8 array indexed by chip key, saved as a single .npz. Reading one snapshot
+replaces one file open per chip, and two snapshots are compared register by
+register in one array operation. Per-chip JSON can still be exported.
+
+Usage:
+    index = config_store.ConfigIndex('configs/')
+    config_store.load_configs([(c[chip_key].config, index[chip_key]) for chip_key in c.chips if chip_key in index])
+
+    $ python3 config_store.py --snapshot configs/ --output anode.npz
+    $ python3 config_store.py --diff anode.npz config-snapshot-<time>.npz
+    $ python3 config_store.py --export anode.npz --output configs/
+
+'''
+import os
+import re
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import larpix
+import larpix.bitarrayhelper as bah
+
+_default_max_workers=8
+
+config_filename_format='config-{chip_key}-{timestamp}.json'
+snapshot_filename_format='config-snapshot-{timestamp}.npz'
+time_format='%Y_%m_%d_%H_%S_%Z'
+_config_filename_re = re.compile(r'^config-(\d+-\d+-\d+)-(.*)\.json$')
+
+class ConfigIndex:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.newest = dict() # str(chip_key): filename
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                match = _config_filename_re.match(entry.name)
+                if match is None: continue
+                chip_key = match.group(1)
+                if chip_key not in self.newest or entry.name > self.newest[chip_key]:
+                    self.newest[chip_key] = entry.name
+
+    def __contains__(self, chip_key):
+        return str(chip_key) in self.newest
+
+    def __getitem__(self, chip_key):
+        return os.path.join(self.directory, self.newest[str(chip_key)])
+
+    def __len__(self):
+        return len(self.newest)
+
+    def get(self, chip_key, default=None):
+        return self[chip_key] if chip_key in self else default
+
+
+def load_configs(config_files, max_workers=_default_max_workers, verbose=True):
+    '''
+    Loads [(Configuration, filename), ...] in a thread pool; each
+    configuration is loaded from its own file
+
+    '''
+    def load(config_file):
+        config, filename = config_file
+        if verbose: print('loading',filename)
+        config.load(filename)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(load, config_files))
+
+
+_fields = None
+
+def _register_fields():
+    ###### (name, first bit, elements or None for a scalar, bits per element) of every Configuration_v2 register
+    global _fields
+    if _fields is None:
+        config = larpix.Configuration_v2()
+        _fields = []
+        for name, (start, end) in config.bit_map.items():
+            default = getattr(config, name)
+            n = len(default) if isinstance(default, list) else None
+            _fields.append((name, start, n, (end-start)//(n or 1)))
+    return _fields
+
+
+def register_values(registers):
+    '''
+    Decodes one chip's register array into {register name: value}, as
+    accepted by Configuration_v2.from_dict
+
+    '''
+    bits = np.unpackbits(np.asarray(registers, dtype=np.uint8), bitorder='little').astype(np.int64)
+    values = dict()
+    for name, start, n, width in _register_fields():
+        elements = bits[start:start+(n or 1)*width].reshape(n or 1, width).dot(1 << np.arange(width))
+        values[name] = elements.tolist() if n is not None else int(elements[0])
+    return values
+
+
+def config_registers(config):
+    '''
+    Returns the register values of a Configuration_v2 as a uint8 array
+
+    '''
+    return np.array([bah.touint(bits, endian='little') for bits in config.all_data(endian='little')], dtype=np.uint8)
+
+
+class Snapshot:
+
+    def __init__(self, chip_keys, registers):
+        self.chip_keys = [str(chip_key) for chip_key in chip_keys]
+        self.registers = np.asarray(registers, dtype=np.uint8).reshape(len(self.chip_keys), -1) # (chip x register)
+        self.row = dict([(chip_key, row) for row, chip_key in enumerate(self.chip_keys)])
+
+    @classmethod
+    def from_configs(cls, chip_configs):
+        '''
+        Builds a snapshot from [(chip_key, Configuration_v2), ...]
+
+        '''
+        chip_configs = list(chip_configs)
+        return cls([chip_key for chip_key, config in chip_configs],
+                   [config_registers(config) for chip_key, config in chip_configs])
+
+    def __contains__(self, chip_key):
+        return str(chip_key) in self.row
+
+    def __len__(self):
+        return len(self.chip_keys)
+
+    def config(self, chip_key, config=None):
+        '''
+        Loads the chip's registers into config (a new Configuration_v2 if None)
+
+        '''
+        if config is None: config = larpix.Configuration_v2()
+        config.from_dict(register_values(self.registers[self.row[str(chip_key)]]))
+        return config
+
+    def write(self, filename):
+        np.savez_compressed(filename, chip_keys=np.array(self.chip_keys), registers=self.registers)
+        return filename
+
+    def export_json(self, directory='.', timestamp=None):
+        '''
+        Writes one config-<chip_key>-<timestamp>.json per chip; returns the filenames
+
+        '''
+        if timestamp is None: timestamp = time.strftime(time_format)
+        filenames = []
+        for chip_key in self.chip_keys:
+            filename = os.path.join(directory, config_filename_format.format(chip_key=chip_key, timestamp=timestamp))
+            self.config(chip_key).write(filename, force=True)
+            filenames.append(filename)
+        return filenames
+
+
+def read_snapshot(filename):
+    with np.load(filename) as f:
+        return Snapshot(f['chip_keys'], f['registers'])
+
+
+def snapshot_directory(directory, max_workers=_default_max_workers):
+    '''
+    Snapshot of the newest per-chip JSON config of every chip in directory
+
+    '''
+    index = ConfigIndex(directory)
+    chip_configs = [(chip_key, larpix.Configuration_v2()) for chip_key in sorted(index.newest)]
+    load_configs([(config, index[chip_key]) for chip_key, config in chip_configs], max_workers=max_workers, verbose=False)
+    return Snapshot.from_configs(chip_configs)
+
+
+def diff_snapshots(a, b):
+    '''
+    Returns {chip_key: [register addresses that differ]} for chips in both
+    snapshots, and {chip_key: None} for chips in only one of them
+
+    '''
+    common = [chip_key for chip_key in a.chip_keys if chip_key in b]
+    rows_a = np.array([a.row[chip_key] for chip_key in common], dtype=int)
+    rows_b = np.array([b.row[chip_key] for chip_key in common], dtype=int)
+    differs = a.registers[rows_a] != b.registers[rows_b]
+    diff = dict([(common[i], np.flatnonzero(differs[i]).tolist()) for i in np.flatnonzero(differs.any(axis=1))])
+    for chip_key in set(a.chip_keys) ^ set(b.chip_keys): diff[chip_key] = None
+    return diff
+
+
+def main(snapshot=None, export=None, diff=None, output=None, max_workers=_default_max_workers, **kwargs):
+    if snapshot is not None:
+        if output is None: output = snapshot_filename_format.format(timestamp=time.strftime(time_format))
+        print('wrote', snapshot_directory(snapshot, max_workers).write(output))
+    if export is not None:
+        print('wrote', len(read_snapshot(export).export_json(output or '.')), 'chip configurations')
+    if diff is not None:
+        for chip_key, registers in diff_snapshots(read_snapshot(diff[0]), read_snapshot(diff[1])).items():
+            print(chip_key, 'only in one snapshot' if registers is None else registers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snapshot', default=None, type=str, help='''Configs directory to pack (newest file per chip) into one snapshot''')
+    parser.add_argument('--export', default=None, type=str, help='''Snapshot to write out as per-chip JSON configs''')
+    parser.add_argument('--diff', default=None, nargs=2, type=str, help='''Two snapshots to compare register by register''')
+    parser.add_argument('--output', default=None, type=str, help='''Snapshot file (--snapshot) or directory (--export)''')
+    parser.add_argument('--max_workers', default=_default_max_workers, type=int, help='''Threads reading configuration files''')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,85 @@
+'''
+Read-back confirmed configuration writes
+
+A configuration write is sent once, the registers it touched are read back
+in one bulk read, and only the registers that read back wrong are sent
+again (Controller.enforce_registers), up to n times. This replaces sending
+every write twice as a blind retry, followed by an enforce of the same or
+of every register. Timeouts and retries come from the controller's latency
+model where it has one. The IO's double_send_packets is turned off for the
+write and its read-back (it would send each packet twice again), and
+restored afterwards.
+
+Usage:
+    ok, diff = confirmed_write.multi_write(c, [(chip_key, list(range(66,74))), ...])
+    ok, diff = confirmed_write.differential_write(c, [(chip_key, initial_config), ...])
+
+'''
+from contextlib import contextmanager
+
+import latency
+
+_default_timeout=0.01
+_default_n=10
+_default_n_verify=10
+_default_connection_delay=0.01
+
+@contextmanager
+def single_send(c):
+    ###### packets sent once while inside, whatever double_send_packets was set to
+    double_send = getattr(c.io, 'double_send_packets', False)
+    c.io.double_send_packets = False
+    try:
+        yield
+    finally:
+        c.io.double_send_packets = double_send
+
+
+def register_pairs(c, chip_register_pairs):
+    ###### (chip_key, [registers]) for every form accepted by multi_write_configuration, empty writes dropped
+    pairs = []
+    for pair in chip_register_pairs:
+        chip_key, registers = pair if isinstance(pair, tuple) else (pair, None)
+        if registers is None: registers = range(c[chip_key].config.num_registers)
+        elif isinstance(registers, int): registers = [registers]
+        if len(registers): pairs.append( (chip_key, list(registers)) )
+    return pairs
+
+
+def confirm(c, chip_register_pairs, timeout=_default_timeout, n=_default_n, n_verify=_default_n_verify,
+            connection_delay=_default_connection_delay):
+    '''
+    Reads back registers that were just written and re-sends the ones that
+    differ; returns (ok, diff) as Controller.verify_registers
+
+    '''
+    chip_register_pairs = register_pairs(c, chip_register_pairs)
+    if not chip_register_pairs: return True, dict()
+    with single_send(c):
+        return c.enforce_registers(chip_register_pairs, connection_delay=connection_delay,
+                                   **latency.enforce_kwargs(c, chip_register_pairs, timeout=timeout, n=n, n_verify=n_verify))
+
+
+def multi_write(c, chip_register_pairs, timeout=_default_timeout, n=_default_n, n_verify=_default_n_verify,
+                connection_delay=_default_connection_delay):
+    '''
+    Sends chip_register_pairs once and confirms them by read-back
+
+    '''
+    chip_register_pairs = register_pairs(c, chip_register_pairs)
+    if not chip_register_pairs: return True, dict()
+    with single_send(c):
+        c.multi_write_configuration(chip_register_pairs, write_read=0, connection_delay=connection_delay)
+    return confirm(c, chip_register_pairs, timeout, n, n_verify, connection_delay)
+
+
+def differential_write(c, chip_config_pairs, timeout=_default_timeout, n=_default_n, n_verify=_default_n_verify,
+                       connection_delay=_default_connection_delay):
+    '''
+    Sends the registers that differ from each (chip_key, previous config)
+    once and confirms them by read-back
+
+    '''
+    with single_send(c):
+        chip_register_pairs = c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=connection_delay)
+    return confirm(c, chip_register_pairs, timeout, n, n_verify, connection_delay)
@@ -8,7 +8,6 @@ Usage:
 
 import sys
 import os
-import glob
 import argparse
 from copy import deepcopy
 
@@ -17,83 +16,75 @@ import larpix.io
 import larpix.logger
 
 import base
+import latency
+import config_store
+import confirmed_write
+import json
 
 _default_config_name='configs/'
 _default_controller_config=None
 _default_disabled_channels=None
 
-config_format = 'config-{chip_key}-*.json'
+_default_max_workers=config_store._default_max_workers
+_default_pipelined=False
 
-def main(config_name=_default_config_name, controller_config=_default_controller_config, disabled_channels=_default_disabled_channels, *args, **kwargs):
-    print('START LOAD CONFIG')
+csa_enable_registers=list(range(66,74))
+channel_mask_registers=list(range(131,139))
 
-    replica_dict = dict()
-    
-    # create controller
-    c = base.main(controller_config, *args, **kwargs)
+def set_csa_enable(c, chip_key, replica_dict, disabled_channels):
+    c[chip_key].config.csa_enable=replica_dict[chip_key]['replica_csa_enable'] ### comment out to hold front end in reset
 
-    c.io.group_packets_by_io_group = True
-    c.io.double_send_packets = True
+    #c[chip_key].config.csa_enable[35]=0
+    #c[chip_key].config.csa_enable[36]=0
+    #c[chip_key].config.csa_enable[37]=0
     
-    #chip_register_pairs = []
-    #possible_chip_ids = range(11,111)
-    #for chip_id in possible_chip_ids:
-    #    for io_group in c.network:
-    #        for io_channel in c.network[io_group]:
-    #            candidate_chip_key = larpix.Key(io_group, io_channel, chip_id)
-    #            if candidate_chip_key in c.chips:
-
-    # set configuration
-    #chip_register_pairs = []
-    chip_config_pairs = []
-    for chip_key, chip in reversed(c.chips.items()):
-
-        initial_config = deepcopy(chip.config)
-        if not os.path.isdir(config_name):
-            print('loading',config_name)
-            chip.config.load(config_name)
-        else:
-            config_files = sorted(glob.glob(os.path.join(config_name, config_format.format(chip_key=chip_key))))
-            if config_files:
-                print('loading',config_files[-1])
-                chip.config.load(config_files[-1])
+    # disable select channels
+    if disabled_channels is not None:
+        if 'All' in disabled_channels:
+            for channel in disabled_channels['All']:
+                c[chip_key].config.csa_enable[channel] = 0
+        if chip_key in disabled_channels:
+            for channel in disabled_channels[chip_key]:
+                c[chip_key].config.csa_enable[channel] = 0
 
-        # save channel mask, csa enable to apply later
-        replica_dict[chip_key] = dict(
-            replica_channel_mask = c[chip_key].config.channel_mask,
-            replica_csa_enable = c[chip_key].config.csa_enable)
-
-        # mask off and disable all channels
-        c[chip_key].config.channel_mask=[1]*64
-        c[chip_key].config.csa_enable=[0]*64
-        #c[chip_key].config.enable_hit_veto = 0
 
-        chip_config_pairs.append((chip_key,initial_config))
-        #register_names = list(chip.config.compare(initial_config).keys())
-        #register_addresses = sorted(list(set([addr for name in register_names for addr in chip.config.register_map[name]])))
+def set_channel_mask(c, chip_key, replica_dict, disabled_channels):
+    c[chip_key].config.channel_mask=replica_dict[chip_key]['replica_channel_mask']
 
-        #for addr in register_addresses:
-        #    chip_register_pairs.append( (chip_key,addr) )
+    #c[chip_key].config.channel_mask[35]=1
+    #c[chip_key].config.channel_mask[36]=1
+    #c[chip_key].config.channel_mask[37]=1
+    
+    # disable select channels
+    if disabled_channels is not None:
+        if 'All' in disabled_channels:
+            for channel in disabled_channels['All']:
+                c[chip_key].config.channel_mask[channel] = 1
+        if chip_key in disabled_channels:
+            for channel in disabled_channels[chip_key]:
+                c[chip_key].config.channel_mask[channel] = 1
 
-        #c.write_configuration(chip_key)
-        #c.write_configuration(chip_key)
 
-        #chip_register_pairs.append( (chip_key, list(range(0,237)) ) )
+def phased_load(c, chip_config_pairs, replica_dict, disabled_channels):
+    '''
+    Writes, enforces and enables every chip in lockstep: each phase waits for
+    the slowest chip before the next one starts
 
+    '''
     # write all config registers
     #c.io.double_send_packets = True
     #c.multi_write_configuration(chip_register_pairs, write_read=0, connection_delay=0.01)
     #c.multi_write_configuration(chip_register_pairs, write_read=0, connection_delay=0.01)
     print('writing configuration (all channels disabled)...')
-    chip_register_pairs = c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=0.01)
+    c.io.double_send_packets = False # sent once: the enforce below re-sends what reads back wrong
     chip_register_pairs = c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=0.01)
     base.flush_data(c)
             
     # enforce all config registers
     print('enforcing correct configuration...')
-    ok,diff = c.enforce_configuration(list(c.chips.keys()), timeout=0.01, connection_delay=0.01, n=10, n_verify=10)
+    ok,diff = c.enforce_configuration(list(c.chips.keys()), connection_delay=0.01, **latency.configuration_kwargs(c, c.chips.keys(), timeout=0.01, n=10, n_verify=10))
     if not ok:
-        if any([reg not in range(66,74) for key,regs in diff.items() for reg in regs]):
+        if any([reg not in csa_enable_registers for key,regs in diff.items() for reg in regs]):
             raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
     #for chip_key, chip in reversed(c.chips.items()):
     #    ok, diff = c.enforce_configuration(chip_key, timeout=0.01, n=10, n_verify=10)
@@ -107,66 +98,32 @@ def main(config_name=_default_config_name, controller_config=_default_controller
     # enable frontend
     chip_register_pairs = []
     for chip_key, chip in reversed(c.chips.items()):
-        c[chip_key].config.csa_enable=replica_dict[chip_key]['replica_csa_enable'] ### comment out to hold front end in reset
-
-        #c[chip_key].config.csa_enable[35]=0
-        #c[chip_key].config.csa_enable[36]=0
-        #c[chip_key].config.csa_enable[37]=0
-        
-        # disable select channels
-        if disabled_channels is not None:
-            if 'All' in disabled_channels:
-                for channel in disabled_channels['All']:
-                    c[chip_key].config.csa_enable[channel] = 0
-            if chip_key in disabled_channels:
-                for channel in disabled_channels[chip_key]:
-                    c[chip_key].config.csa_enable[channel] = 0
-
-        chip_register_pairs.append( (chip_key, list(range(66,74)) ) )
-
-    # write csa enable registers
+        set_csa_enable(c, chip_key, replica_dict, disabled_channels)
+        chip_register_pairs.append( (chip_key, csa_enable_registers ) )
+
+    # write and enforce csa enable registers
     print('enabling CSAs...')
-    c.io.double_send_packets = True
-    c.multi_write_configuration(chip_register_pairs)
-    c.multi_write_configuration(chip_register_pairs)
+    ok, diff = confirmed_write.multi_write(c, chip_register_pairs, timeout=0.01, n=10, n_verify=10)
     base.flush_data(c)
-            
-    # enforce csa enable registers
-    print('enforcing configuration...')
-    for chip_key, chip in reversed(c.chips.items()):
-        ok, diff = c.enforce_registers([(chip_key,list(range(66,74)) )], timeout=0.01, n=10, n_verify=10)
-        if not ok:
-            for key in diff:
-                #print('config error',key,diff[key])
-                raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys())) # BR 3/31/21
-            #sys.exit('Failed to configure CSA\t EXITING')
+    if not ok:
+        raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys())) # BR 3/31/21
+        #sys.exit('Failed to configure CSA\t EXITING')
     print('ENABLED FRONTEND')
 
             
     # channel mask
     chip_register_pairs = []
     for chip_key, chip in reversed(c.chips.items()):
-        c[chip_key].config.channel_mask=replica_dict[chip_key]['replica_channel_mask']
-
-        #c[chip_key].config.channel_mask[35]=1
-        #c[chip_key].config.channel_mask[36]=1
-        #c[chip_key].config.channel_mask[37]=1
-        
-        # disable select channels
-        if disabled_channels is not None:
-            if 'All' in disabled_channels:
-                for channel in disabled_channels['All']:
-                    c[chip_key].config.channel_mask[channel] = 1
-            if chip_key in disabled_channels:
-                for channel in disabled_channels[chip_key]:
-                    c[chip_key].config.channel_mask[channel] = 1
-
-        chip_register_pairs.append( (chip_key, list(range(131,139)) ) )
+        set_channel_mask(c, chip_key, replica_dict, disabled_channels)
+        chip_register_pairs.append( (chip_key, channel_mask_registers ) )
 
     # write channel mask registers
+    # (sent twice, not confirmed: frontends are already triggering, so a read-back would wait behind their data)
     print('writing channel mask...')
+    c.io.double_send_packets = True
     c.multi_write_configuration(chip_register_pairs)
     c.multi_write_configuration(chip_register_pairs)
+    c.io.double_send_packets = False
     base.flush_data(c)
             
     # enforce channel mask registers
@@ -179,7 +136,151 @@ def main(config_name=_default_config_name, controller_config=_default_controller
     #        #sys.exit('Failed to configure channel masks\t EXITING')
     print('APPLIED CHANNEL MASKS')
 
-            
+
+def pipelined_load(c, chip_config_pairs, replica_dict, disabled_channels, n=10, n_verify=10, connection_delay=0.01):
+    '''
+    Loads each io_channel's chain through the same phases as phased_load
+    (configuration write, enforce, CSA enable write, enforce, channel mask
+    write), but lets each chain advance as soon as its own chips verify.
+    Writes that are enforced are sent once; the enforce phase after them
+    re-sends only the registers that read back wrong.
+    Every step sends all pending write bursts first, then one verify read
+    covering every chain that is waiting to be enforced. That way one chain's
+    writes are in flight while another chain's reads are answered, and the
+    load time is set by the slowest chain rather than by the sum of phases.
+
+    '''
+    phases = ['write configuration', 'enforce configuration', 'write CSA enable', 'enforce CSA enable', 'write channel mask']
+    chains = dict()
+    for chip_key, config in chip_config_pairs:
+        chains.setdefault((chip_key.io_group, chip_key.io_channel), []).append((chip_key, config))
+    phase = dict([(chain, 0) for chain in chains])
+    attempts = dict([(chain, 0) for chain in chains])
+    enforce_phases = (1, 3)
+    step = 0
+    while phase:
+        step += 1
+        ###### write bursts
+        config_pairs = [pair for chain in phase if phase[chain] == 0 for pair in chains[chain]]
+        if config_pairs:
+            c.differential_write_configuration(config_pairs, write_read=0, connection_delay=connection_delay)
+        register_pairs = []
+        for chain in phase:
+            if phase[chain] == 2:
+                for chip_key, config in chains[chain]:
+                    set_csa_enable(c, chip_key, replica_dict, disabled_channels)
+                    register_pairs.append( (chip_key, csa_enable_registers) )
+        if register_pairs:
+            c.multi_write_configuration(register_pairs, write_read=0, connection_delay=connection_delay)
+        ###### channel masks are not enforced (see phased_load), so they are still sent twice
+        register_pairs = []
+        for chain in phase:
+            if phase[chain] == 4:
+                for chip_key, config in chains[chain]:
+                    set_channel_mask(c, chip_key, replica_dict, disabled_channels)
+                    register_pairs.append( (chip_key, channel_mask_registers) )
+        if register_pairs:
+            c.io.double_send_packets = True
+            c.multi_write_configuration(register_pairs)
+            c.multi_write_configuration(register_pairs)
+            c.io.double_send_packets = False
+        for chain in list(phase):
+            if phase[chain] in (0, 2): phase[chain] += 1
+            elif phase[chain] == 4: del phase[chain]
+
+        ###### one verify over every chain waiting to be enforced
+        verify_pairs = [(chip_key, list(range(c[chip_key].config.num_registers)) if phase[chain] == 1 else csa_enable_registers)
+                        for chain in phase if phase[chain] in enforce_phases for chip_key, config in chains[chain]]
+        if not verify_pairs: continue
+        ok, diff = c.verify_registers(verify_pairs, connection_delay=connection_delay,
+                                      **latency.verify_kwargs(c, verify_pairs, timeout=0.01, n=n_verify))
+        rewrite_pairs = []
+        for chain in [chain for chain in phase if phase[chain] in enforce_phases]:
+            chain_diff = dict([(chip_key, diff[chip_key]) for chip_key, config in chains[chain] if chip_key in diff])
+            if chain_diff: attempts[chain] += 1
+            if not chain_diff or (attempts[chain] >= n and phase[chain] == 1
+                                  and all([reg in csa_enable_registers for regs in chain_diff.values() for reg in regs])):
+                print('io_group',chain[0],'io_channel',chain[1],phases[phase[chain]],'done (step {})'.format(step))
+                phase[chain] += 1
+                attempts[chain] = 0
+            elif attempts[chain] >= n:
+                raise RuntimeError(chain_diff,'\nconfig error on chips',list(chain_diff.keys()))
+            else:
+                rewrite_pairs += [(chip_key, list(regs.keys())) for chip_key, regs in chain_diff.items()]
+        if rewrite_pairs:
+            c.multi_write_configuration(rewrite_pairs, write_read=0, connection_delay=connection_delay)
+    base.flush_data(c)
+    print('ENABLED FRONTEND')
+    print('APPLIED CHANNEL MASKS')
+
+
+def main(config_name=_default_config_name, controller_config=_default_controller_config, disabled_channels=_default_disabled_channels, *args, max_workers=_default_max_workers, pipelined=_default_pipelined, **kwargs):
+    print('START LOAD CONFIG')
+
+    replica_dict = dict()
+    
+    # create controller
+    c = base.main(controller_config, *args, **kwargs)
+
+    c.io.group_packets_by_io_group = True
+    c.io.double_send_packets = False # only the unconfirmed channel mask writes are double sent
+    
+    #chip_register_pairs = []
+    #possible_chip_ids = range(11,111)
+    #for chip_id in possible_chip_ids:
+    #    for io_group in c.network:
+    #        for io_channel in c.network[io_group]:
+    #            candidate_chip_key = larpix.Key(io_group, io_channel, chip_id)
+    #            if candidate_chip_key in c.chips:
+
+    # set configuration
+    #chip_register_pairs = []
+    chip_config_pairs = []
+    initial_configs = dict([(chip_key, deepcopy(chip.config)) for chip_key, chip in c.chips.items()])
+    if os.path.isfile(config_name) and config_name.endswith('.npz'):
+        ###### whole-anode snapshot: one file read for every chip
+        print('loading',config_name)
+        snapshot = config_store.read_snapshot(config_name)
+        for chip_key, chip in reversed(c.chips.items()):
+            if chip_key in snapshot: snapshot.config(chip_key, chip.config)
+        config_files = []
+    elif not os.path.isdir(config_name):
+        config_files = [(chip.config, config_name) for chip_key, chip in reversed(c.chips.items())]
+    else:
+        ###### one directory scan for the newest config of every chip
+        index = config_store.ConfigIndex(config_name)
+        config_files = [(chip.config, index[chip_key]) for chip_key, chip in reversed(c.chips.items()) if chip_key in index]
+    config_store.load_configs(config_files, max_workers=max_workers)
+
+    for chip_key, chip in reversed(c.chips.items()):
+
+        initial_config = initial_configs[chip_key]
+
+        # save channel mask, csa enable to apply later
+        replica_dict[chip_key] = dict(
+            replica_channel_mask = c[chip_key].config.channel_mask,
+            replica_csa_enable = c[chip_key].config.csa_enable)
+
+        # mask off and disable all channels
+        c[chip_key].config.channel_mask=[1]*64
+        c[chip_key].config.csa_enable=[0]*64
+        #c[chip_key].config.enable_hit_veto = 0
+
+        chip_config_pairs.append((chip_key,initial_config))
+        #register_names = list(chip.config.compare(initial_config).keys())
+        #register_addresses = sorted(list(set([addr for name in register_names for addr in chip.config.register_map[name]])))
+
+        #for addr in register_addresses:
+        #    chip_register_pairs.append( (chip_key,addr) )
+
+        #c.write_configuration(chip_key)
+        #c.write_configuration(chip_key)
+
+        #chip_register_pairs.append( (chip_key, list(range(0,237)) ) )
+
+    if pipelined: pipelined_load(c, chip_config_pairs, replica_dict, disabled_channels)
+    else: phased_load(c, chip_config_pairs, replica_dict, disabled_channels)
+
     c.io.double_send_packets = False
 
     if hasattr(c,'logger') and c.logger:
@@ -191,7 +292,10 @@ def main(config_name=_default_config_name, controller_config=_default_controller
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--controller_config', default=_default_controller_config, type=str, help='''Hydra network configuration file''')
-    parser.add_argument('--config_name', default=_default_config_name, type=str, help='''Directory or file to load chip configurations from (default=%(default)s)''')
+    parser.add_argument('--config_name', default=_default_config_name, type=str, help='''Directory, file or .npz snapshot to load chip configurations from (default=%(default)s)''')
     parser.add_argument('--disabled_channels', default=_default_disabled_channels, type=json.loads, help='''Json-formatted dict of <chip_key>:[<channels>] to disable (default=%(default)s)''')
+    parser.add_argument('--max_workers', default=_default_max_workers, type=int, help='''Threads reading chip configuration files (default=%(default)s)''')
+    parser.add_argument('--pipelined', default=_default_pipelined, action='store_true', help='''Load each io_channel chain through the write / enforce phases independently instead of all chips in lockstep''')
+    parser.add_argument('--simulate', default=base._default_simulate, nargs='?', const='', type=str, help='''Use the hardware-free PACMAN simulator, optionally with a JSON sim config file''')
     args = parser.parse_args()
     c = main(**vars(args))
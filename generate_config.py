@@ -1,5 +1,6 @@
-import qc.graphs as graphs
+import graphs
 import json
+import link_db
 import argparse
 
 
@@ -16,9 +17,16 @@ _header = {"_config_type": "controller", "name": _name, "asic_version": 2,"layou
 
 
 
-def main(_name=_name, _io_group=_io_group, _good_root_connections=_good_root_connections, _io_channels=_io_channels, _excluded_links=_excluded_links, _excluded_chips=_excluded_chips, verbose=False):
+def main(_name=_name, _io_group=_io_group, _good_root_connections=_good_root_connections, _io_channels=_io_channels, _excluded_links=_excluded_links, _excluded_chips=_excluded_chips, verbose=False, balanced=False, link_db_file=None, tile_id=None):
 	nchips_hit = 0
+	header = dict(_header, name=_name, network={str(_io_group) : {}}) # fresh per call, so successive tiles don't accumulate
 	na = graphs.NumberedArrangement()
+	if link_db_file:
+		# links last seen bad in map_uart_links_qc runs, instead of the hand-kept list
+		db = link_db.LinkDB(link_db_file)
+		_excluded_links = db.bad_links(tile_id)
+		db.close()
+		print('excluding', len(_excluded_links), 'bad links of tile', tile_id, 'from', link_db_file)
 	for link in _excluded_links:
 		na.add_onesided_excluded_link(link)
 	for chip in _excluded_chips:
@@ -26,7 +34,14 @@ def main(_name=_name, _io_group=_io_group, _good_root_connections=_good_root_con
 
 	_dict = {}
 
-	paths = na.get_path([ [root] for root in _good_root_connections  ])
+	if balanced:
+		# breadth-first forest: shortest possible chains, chips spread over the roots
+		trees, depth = na.get_balanced_forest(_good_root_connections)
+		paths = [list(tree.keys()) for tree in trees]
+	else:
+		paths = na.get_path([ [root] for root in _good_root_connections  ])
+		depth = na.path_depths(paths)
+	print('chain depth histogram {depth: chips}:', na.depth_histogram(depth))
 
 	for i in range(11, 111):
 		if not any([i in path for path in paths]):
@@ -37,26 +52,28 @@ def main(_name=_name, _io_group=_io_group, _good_root_connections=_good_root_con
 		nchips_hit += len(path)
 		print(len(path))
 
-		_header['network'][str(_io_group)][str(_io_channels[n])] = {}
+		header['network'][str(_io_group)][str(_io_channels[n])] = {}
 
 		nodes = [ {"chip_id" : 'ext', "miso_us": [None,None,None,root_connection], "root" : True} ]
 		for k, chip in enumerate(path):
-			if k < len(path)-1:
+			if balanced:
+				nodes.append({'chip_id' : chip, "miso_us" : na.get_tree_map(chip, trees[n][chip])})
+			elif k < len(path)-1:
 				nodes.append({'chip_id' : chip, "miso_us" : na.get_map(chip, path[k+1])})
 			else:
 				nodes.append({'chip_id' : chip, "miso_us" : [None, None, None, None]})
 
-		_header['network'][str(_io_group)][str(_io_channels[n])]['nodes'] = nodes
+		header['network'][str(_io_group)][str(_io_channels[n])]['nodes'] = nodes
 
 
-	_header['network']["miso_us_uart_map"] = [ 3, 0, 1, 2 ]
-	_header['network']["miso_ds_uart_map"] = [ 1, 2, 3, 0 ]
-	_header['network']["mosi_uart_map"] = [ 2, 3, 0, 1 ]
+	header['network']["miso_us_uart_map"] = [ 3, 0, 1, 2 ]
+	header['network']["miso_ds_uart_map"] = [ 1, 2, 3, 0 ]
+	header['network']["mosi_uart_map"] = [ 2, 3, 0, 1 ]
 
 	print(nchips_hit)
 
 
-	jsonString = json.dumps(_header, indent=4)
+	jsonString = json.dumps(header, indent=4)
 	jsonFile = open(_name + ".json", "w")
 	jsonFile.write(jsonString)
 	jsonFile.close()
@@ -69,5 +86,8 @@ def main(_name=_name, _io_group=_io_group, _good_root_connections=_good_root_con
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--verbose', default=True, type=bool, help='''Print status of algorithm at each step''')
+	parser.add_argument('--balanced', default=False, action='store_true', help='''Breadth-first network (shortest chains) instead of daisy chains''')
+	parser.add_argument('--link_db', dest='link_db_file', default=None, type=str, help='''Take the excluded links from this map_uart_links_qc link database''')
+	parser.add_argument('--tile_id', default=None, type=str, help='''Tile ID to look up in --link_db''')
 	args = parser.parse_args()
 	c = main(**vars(args))
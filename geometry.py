@@ -0,0 +1,117 @@
+'''
+Cached pixel geometry lookup for the multi-tile layout
+
+The layout JSON ({str(unique channel id): [x, y]}) is parsed once and saved
+next to it as a .npz of the sorted unique channel ids and their (x, y). The
+cache is rebuilt whenever the JSON's mtime or size changes. Lookups take
+arrays of unique channel ids and use np.searchsorted; channels not in the
+layout are looked up again on the other io_channels of the same tile, since
+a tile's network can be brought up on any of its four io_channels.
+
+Usage:
+    geo = geometry.load('multi_tile_layout-2.2.16-dict.json')
+    x, y, found = geo.xy(unique_ids)
+
+'''
+import json
+import os
+
+import numpy as np
+
+_io_channels_per_tile=4
+_n_tiles=8
+
+def cache_filename(filename):
+    return os.path.splitext(filename)[0] + '.npz'
+
+
+def _tile_io_channel_ids(unique):
+    ###### the same channel on each io_channel of its tile (io_channels 1-32 -> tiles 1-8)
+    channel_id = unique % 64
+    chip_id = (unique // 64) % 256
+    io_channel = (unique // (64*256)) % 256
+    io_group = (unique // (64*256*256)) % 256
+    tile = np.where((io_channel >= 1) & (io_channel <= _io_channels_per_tile*_n_tiles), (io_channel-1)//_io_channels_per_tile + 1, -1)
+    return [channel_id + 64*(chip_id + 256*((tile-1)*_io_channels_per_tile + j + 256*io_group))
+            for j in range(1, _io_channels_per_tile+1)]
+
+
+class Geometry:
+
+    def __init__(self, unique, positions):
+        order = np.argsort(unique)
+        self.unique = np.asarray(unique, dtype=np.int64)[order]
+        self.positions = np.asarray(positions, dtype=float)[order] # (n, 2): x, y [mm]
+
+    def _find(self, unique):
+        if len(self.unique) == 0: return np.zeros(len(unique), dtype=int), np.zeros(len(unique), dtype=bool)
+        index = np.minimum(np.searchsorted(self.unique, unique), len(self.unique)-1)
+        return index, self.unique[index] == unique
+
+    def index(self, unique, remap_tile=True):
+        '''
+        Returns (index into positions, found) for an array of unique channel ids
+
+        '''
+        unique = np.atleast_1d(np.asarray(unique, dtype=np.int64))
+        index, found = self._find(unique)
+        if remap_tile and not found.all():
+            missing = ~found
+            for tile_unique in _tile_io_channel_ids(unique[missing]):
+                tile_index, tile_found = self._find(tile_unique)
+                # last io_channel of the tile that matches wins
+                index[missing] = np.where(tile_found, tile_index, index[missing])
+                found[missing] |= tile_found
+        return index, found
+
+    def xy(self, unique, remap_tile=True):
+        '''
+        Returns x, y [mm] and found for an array of unique channel ids
+
+        '''
+        index, found = self.index(unique, remap_tile)
+        positions = self.positions[index]
+        return positions[:,0], positions[:,1], found
+
+    ###### dict-style access by str(unique), as with the parsed JSON
+    def __contains__(self, key):
+        return bool(self._find(np.array([int(key)], dtype=np.int64))[1][0])
+
+    def __getitem__(self, key):
+        index, found = self._find(np.array([int(key)], dtype=np.int64))
+        if not found[0]: raise KeyError(key)
+        return list(self.positions[index[0]])
+
+    def __len__(self):
+        return len(self.unique)
+
+
+def parse_layout(filename):
+    with open(filename, 'r') as f: layout = json.load(f)
+    unique = np.array([int(key) for key in layout.keys()], dtype=np.int64)
+    positions = np.array([value[:2] for value in layout.values()], dtype=float).reshape(-1, 2)
+    return Geometry(unique, positions)
+
+
+def load(filename, cache=True):
+    '''
+    Loads the layout from its .npz cache, re-parsing the JSON if the cache is
+    missing or out of date
+
+    '''
+    stat = os.stat(filename)
+    npz = cache_filename(filename)
+    if cache and os.path.isfile(npz):
+        with np.load(npz) as f:
+            if float(f['source_mtime']) == stat.st_mtime and int(f['source_size']) == stat.st_size:
+                geo = Geometry.__new__(Geometry)
+                geo.unique, geo.positions = f['unique'], f['positions']
+                return geo
+    geo = parse_layout(filename)
+    if cache:
+        try:
+            np.savez(npz, unique=geo.unique, positions=geo.positions, source_mtime=stat.st_mtime, source_size=stat.st_size)
+            print('geometry cache written:', npz)
+        except OSError as e:
+            print('geometry cache not written:', e)
+    return geo
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import Counter
 
 #gives directional chip ids for chips on a tile
 
@@ -12,6 +13,19 @@ class NumberedArrangement:
 		self.excluded_chips = set()
 		self.good_connections = set()
 
+		#neighbor table, indexed by chip id
+		self.n_ids = self.start_index + self.nrows*self.ncols
+		ids = np.arange(self.n_ids)
+		self.rows = (ids - self.start_index) // self.ncols
+		self.cols = (ids - self.start_index) - self.ncols*self.rows
+		on_grid = ids >= self.start_index
+		self.neighbors = np.full((self.n_ids, 4), -1, dtype=int) #columns: left, right, down, up
+		self.neighbors[:,0] = np.where(on_grid & (self.cols-1 >= 0), ids-1, -1)
+		self.neighbors[:,1] = np.where(on_grid & (self.cols+1 < self.ncols), ids+1, -1)
+		self.neighbors[:,2] = np.where(on_grid & (self.rows+1 < self.nrows), ids+self.ncols, -1)
+		self.neighbors[:,3] = np.where(on_grid & (self.rows-1 >= 0), ids-self.ncols, -1)
+		self._neighbor_list = self.neighbors.tolist() # python ints for scalar lookups
+
 		self.m1 =[self.right, self.left, self.down, self.up]
 		self.m2 =[self.right, self.left, self.up, self.down]
 		self.m3 =[self.right, self.up, self.down, self.left]
@@ -39,6 +53,9 @@ class NumberedArrangement:
 
 		self.all_dir_maps = [self.m1, self.m2, self.m3, self.m4, self.m5, self.m6, self.m7, self.m8, self.m9, self.m10, self.m11, self.m12, self.m13, self.m14, self.m15, self.m16, self.m17, self.m18, self.m19, self.m20, self.m21, self.m22, self.m23, self.m24]
 		self.n_maps = len(self.all_dir_maps)
+		#direction maps as neighbor table columns
+		base_direction_map = [self.left, self.right, self.down, self.up]
+		self.all_dir_columns = [ [base_direction_map.index(direction) for direction in direction_map] for direction_map in self.all_dir_maps ]
 		#use grid points to create path
 		self.grid = [ [None for row in range(self.nrows)] for col in range(self.ncols) ]
 
@@ -63,6 +80,12 @@ class NumberedArrangement:
 	def all_chips(self):
 		return [i for i in range(self.start_index, self.start_index + self.ncols*self.nrows) if not (i in self.excluded_chips)]
 
+	def on_grid(self, index):
+		return self.start_index <= index < self.n_ids
+
+	def adjacent(self, ind1, ind2):
+		return self.on_grid(ind1) and self.on_grid(ind2) and ind2 in self._neighbor_list[ind1]
+
 	#number of steps between two chips
 	def distance(self, ind1, ind2):
 		if ind1 < self.start_index or ind2 < self.start_index:
@@ -71,6 +94,12 @@ class NumberedArrangement:
 		row2, col2 = self.row_col(ind2)
 		return np.abs(row1-row2) + np.abs(col1-col2)
 
+	def distances(self, indices, ind2):
+		#vectorized distance() from each of indices to ind2
+		indices = np.asarray(indices, dtype=int)
+		d = np.abs(self.rows[indices] - self.rows[ind2]) + np.abs(self.cols[indices] - self.cols[ind2])
+		return np.where((indices < self.start_index) | (ind2 < self.start_index), 9999, d)
+
 	def add_good_connection(self, link):
 		self.good_connections.add(link)
 		self.good_connections.add((link[1], link[0]))
@@ -100,27 +129,35 @@ class NumberedArrangement:
 		col_index = (index - self.start_index) - self.ncols * row_index
 		return row_index, col_index
 
-	def left(self, _index):
+	def _step(self, _index, column):
+		#table lookup on the grid, arithmetic (as before) off the grid
+		if self.start_index <= _index < self.n_ids:
+			return self._neighbor_list[_index][column]
 		row, col = self.row_col(_index)
-		return self.index(row, col-1) if col-1 >= 0 else -1
+		if column == 0: return self.index(row, col-1) if col-1 >= 0 else -1
+		if column == 1: return self.index(row, col+1) if col+1 < self.ncols else -1
+		if column == 2: return self.index(row+1, col) if row+1 < self.nrows else -1
+		return self.index(row-1, col) if row-1  >= 0 else -1
+
+	def left(self, _index):
+		return self._step(_index, 0)
 
 	def right(self, _index):
-		row, col = self.row_col(_index)
-		return self.index(row, col+1) if col+1 < self.ncols else -1
+		return self._step(_index, 1)
 
 	def down(self, _index):
-		row, col = self.row_col(_index)
-		return self.index(row+1, col) if row+1 < self.nrows else -1
+		return self._step(_index, 2)
 
 	def up(self, _index):
-		row, col = self.row_col(_index)
-		return self.index(row-1, col) if row-1  >= 0 else -1
+		return self._step(_index, 3)
 
 	def no_move(self, _index):
 		print('tried to move from', _index, ', no move')
 		return _index
 
 	def get_map(self, ind1, ind2):
+		if not self.adjacent(ind1, ind2):
+			return [None, None, None, None]
 		if self.up(ind1) == ind2:
 			return [ind2,None,None,None]
 		elif self.left(ind1) == ind2:
@@ -133,6 +170,8 @@ class NumberedArrangement:
 			return [None, None, None, None]
 
 	def get_map_index(self, ind1, ind2):
+		if not self.adjacent(ind1, ind2):
+			return -1
 		if self.up(ind1) == ind2:
 			return 0
 		elif self.left(ind1) == ind2:
@@ -160,20 +199,16 @@ class NumberedArrangement:
 	def connect_chips(self, start, end, extra_excluded_chips=[]):
 		#gives a path connecting start to end
 		#excludes forbidden chips and uart connections
-		base_direction_map = [self.left, self.right, self.down, self.up]
+		extra_excluded_chips = set(extra_excluded_chips)
 		path = [start]
+		occupied = set(path)
 		while not (path[-1] == end):
 			curr = path[-1]
 			possible_steps = []
-			for direction in base_direction_map:
-				pstep = direction(curr)
+			for pstep in self._neighbor_list[curr]:
 				if (curr, pstep) in self.excluded_links or (pstep, curr) in self.excluded_links:
 					continue
-				if pstep in self.excluded_chips:
-					continue
-				if pstep in extra_excluded_chips:
-					continue
-				if pstep in path:
+				if pstep in self.excluded_chips or pstep in extra_excluded_chips or pstep in occupied:
 					continue
 				if pstep < 0:
 					continue
@@ -182,63 +217,120 @@ class NumberedArrangement:
 			if len(possible_steps) == 0:
 				return []
 
-			distance_map = [self.distance(end, step) for step in possible_steps]
-			best_steps_index = np.argmin(distance_map)
-			#print(best_steps_index)
+			best_steps_index = np.argmin(self.distances(possible_steps, end))
 			path.append(possible_steps[best_steps_index])
+			occupied.add(path[-1])
 
 		return path
 
-	def get_path_sub(self, existing_path=None, ind=0):
+	def get_path_sub(self, existing_path=None, ind=0, occupied=None):
+		#grows every path by one step per round (in path order) until none can grow;
+		#paths are extended in place and a path that stops can never restart, since
+		#occupancy only grows, so each round visits only the still-active paths
 		if existing_path is None:
 			existing_path = [[self.start_index]]
+		if occupied is None:
+			occupied = set([chip for path in existing_path for chip in path])
 
 		#prefers right, down, left, up
 
-		direction_map = self.all_dir_maps[ind]
-		still_stepping = [False for path in existing_path]
-
+		direction_columns = self.all_dir_columns[ind]
 		new_paths = existing_path.copy()
+		active = list(range(len(new_paths)))
+
+		while active:
+			still_active = []
+			for ipath in active:
+				path = new_paths[ipath]
+				starting_point = path[-1]
+				neighbors = self._neighbor_list[starting_point]
+				for column in direction_columns:
+					next_id = neighbors[column]
+
+					if next_id < 0:
+						continue
 
-		for ipath, path in enumerate(existing_path):
-
-			starting_point = path[-1]
-			for direction in direction_map:
-				next_id = direction(starting_point)
-
-				if next_id < 0:
-					continue
-
-				if any( [next_id in path for path in existing_path] ):
-					continue
-
-				if next_id in self.excluded_chips:
-					continue
-
-				if (starting_point, next_id) in self.excluded_links:
-					exclude = []
-					for p in new_paths:
-						exclude += p
-					addon = self.connect_chips(starting_point, next_id, exclude)
-					if len(addon) == 0:
+					if next_id in occupied:
 						continue
 
-					new_paths[ipath] += addon[1:]
-					still_stepping[ipath] = True
-					break
+					if next_id in self.excluded_chips:
+						continue
 
-				if next_id in self.excluded_chips:
-					continue
+					if (starting_point, next_id) in self.excluded_links:
+						addon = self.connect_chips(starting_point, next_id, occupied)
+						if len(addon) == 0:
+							continue
 
-				new_paths[ipath] += [next_id]
-				still_stepping[ipath] = True
-				break
+						path.extend(addon[1:])
+						occupied.update(addon[1:])
+						still_active.append(ipath)
+						break
 
-		if any(still_stepping):
-			return self.get_path_sub(new_paths, ind)
+					path.append(next_id)
+					occupied.add(next_id)
+					still_active.append(ipath)
+					break
+			active = still_active
 
 		return new_paths
 
+	def get_balanced_forest(self, roots):
+		'''
+		Spanning forest over the usable links, grown breadth-first from all
+		roots at once. Every reachable chip sits at its shortest hop distance
+		from a root, so the deepest chain is as short as it can be; a chip
+		reachable from several roots at the same depth goes to the root with
+		the fewest chips so far. Returns one {chip: [children]} dict per root
+		(in BFS order) and {chip: depth}
+
+		'''
+		trees = [dict() for root in roots]
+		depth = dict()
+		tree_of = dict()
+		frontier = []
+		for n, root in enumerate(roots):
+			if not self.on_grid(root) or root in self.excluded_chips or root in depth: continue
+			trees[n][root] = []
+			depth[root] = 1
+			tree_of[root] = n
+			frontier.append(root)
+
+		while frontier:
+			candidates = dict() # next chip: possible parents on the frontier
+			for chip in frontier:
+				for next_id in self._neighbor_list[chip]:
+					if next_id < 0 or next_id in depth or next_id in self.excluded_chips:
+						continue
+					if (chip, next_id) in self.excluded_links:
+						continue
+					candidates.setdefault(next_id, []).append(chip)
+
+			frontier = []
+			#chips with a single possible parent first, then balance the rest
+			for next_id in sorted(candidates, key=lambda chip: (len(candidates[chip]), chip)):
+				parent = min(candidates[next_id], key=lambda chip: (len(trees[tree_of[chip]]), chip))
+				n = tree_of[parent]
+				trees[n][parent].append(next_id)
+				trees[n][next_id] = []
+				depth[next_id] = depth[parent] + 1
+				tree_of[next_id] = n
+				frontier.append(next_id)
+		return trees, depth
+
+	def get_tree_map(self, chip, children):
+		#miso_us map of a chip with several upstream chips
+		miso_us = [None, None, None, None]
+		for child in children:
+			miso_us[self.get_map_index(chip, child)] = child
+		return miso_us
+
+	def path_depths(self, paths):
+		return dict([(chip, k+1) for path in paths for k, chip in enumerate(path)])
+
+	def depth_histogram(self, depth):
+		#{hop depth: number of chips}
+		return dict(sorted(Counter(depth.values()).items()))
+
 	def get_path(self, existing_path=None):
 		def length(path_list):
 			l = 0
@@ -260,28 +352,3 @@ class NumberedArrangement:
 		#print(all_lengths)
 		i = np.argmax(all_lengths)
 		return self.get_path_sub(existing_path.copy(), i)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,146 @@
+'''
+Stage timing and UART transaction instrumentation for the QC scripts
+
+Wrap a stage in ``with instrumentation.stage('name'):`` to time it. Controllers
+passed through ``instrument(c)`` count packets sent/received at the IO, time
+spent listening for replies (the verify/read timeouts), calls to the
+configuration write/verify/enforce methods, and writes reissued by enforce_*
+(retries).
+
+When a trace file is open (``open_trace(filename)``, ``--trace`` on the QC
+scripts, or the QC_TRACE_FILE environment variable) every stage and controller
+call is appended to it as one JSON object per line.
+
+'''
+import functools
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+_default_trace_file=os.environ.get('QC_TRACE_FILE')
+
+controller_calls = ['write_configuration', 'multi_write_configuration', 'differential_write_configuration',
+                    'read_configuration', 'multi_read_configuration',
+                    'verify_configuration', 'verify_registers',
+                    'enforce_configuration', 'enforce_registers']
+
+# process-wide totals: packets_sent, packets_received, listen_time, calls, retries
+counters = Counter()
+
+_trace = None
+_stages = []
+_calls = []
+
+def open_trace(filename):
+    global _trace
+    close_trace()
+    _trace = open(filename, 'a')
+    print('instrumentation trace:',filename)
+
+
+def close_trace():
+    global _trace
+    if _trace is not None: _trace.close()
+    _trace = None
+
+
+def emit(event, **fields):
+    '''
+    Appends one JSON line to the trace (no-op when no trace is open)
+
+    '''
+    if _trace is None:
+        if not _default_trace_file: return
+        open_trace(_default_trace_file)
+    record = dict(event=event, time=time.time(), stage='/'.join(_stages))
+    record.update(fields)
+    _trace.write(json.dumps(record, default=str)+'\n')
+    _trace.flush()
+
+
+@contextmanager
+def stage(name, verbose=True):
+    '''
+    Times the enclosed block and records the transactions made inside it
+
+    '''
+    _stages.append(name)
+    before = Counter(counters)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        delta = dict(counters - before)
+        emit('stage', name=name, duration=elapsed, **delta)
+        _stages.pop()
+        if verbose: print('==> %.3f seconds --- %s'%(elapsed, name))
+
+
+def _instrument_io(io):
+    send, empty_queue = io.send, io.empty_queue
+    start_listening, stop_listening = io.start_listening, io.stop_listening
+    listen_start = [None]
+
+    def counted_send(packets, *args, **kwargs):
+        counters['packets_sent'] += len(packets)
+        return send(packets, *args, **kwargs)
+
+    def counted_empty_queue(*args, **kwargs):
+        packets, bytestream = empty_queue(*args, **kwargs)
+        counters['packets_received'] += len(packets)
+        return packets, bytestream
+
+    def timed_start_listening(*args, **kwargs):
+        listen_start[0] = time.time()
+        return start_listening(*args, **kwargs)
+
+    def timed_stop_listening(*args, **kwargs):
+        if listen_start[0] is not None:
+            counters['listen_time'] += time.time() - listen_start[0]
+            listen_start[0] = None
+        return stop_listening(*args, **kwargs)
+
+    io.send, io.empty_queue = counted_send, counted_empty_queue
+    io.start_listening, io.stop_listening = timed_start_listening, timed_stop_listening
+
+
+def _instrument_call(name, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        ###### writes issued directly by an enforce_* call are retries
+        if 'write' in name and _calls and _calls[-1].startswith('enforce'): counters['retries'] += 1
+        counters['calls'] += 1
+        _calls.append(name)
+        before = Counter(counters)
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            _calls.pop()
+            delta = counters - before
+            emit('call', name=name, depth=len(_calls), duration=elapsed,
+                 packets_sent=delta['packets_sent'], packets_received=delta['packets_received'],
+                 listen_time=delta['listen_time'], retries=delta['retries'])
+    return wrapper
+
+
+def instrument(c):
+    '''
+    Wraps the controller's IO and configuration methods in place; safe to call
+    more than once
+
+    '''
+    if getattr(c, '_instrumented', False): return c
+    _instrument_io(c.io)
+    for name in controller_calls:
+        if hasattr(c, name): setattr(c, name, _instrument_call(name, getattr(c, name)))
+    c._instrumented = True
+    return c
+
+
+def summary():
+    return dict(counters)
@@ -0,0 +1,212 @@
+'''
+UART round-trip latency model for verify / enforce timeouts
+
+After the hydra network is initialized, a chip ID read is timed on the root
+and on the deepest chip of each io_channel, giving a per-io_channel fit of
+round-trip time vs. hop depth and the fraction of unanswered probes. Verify
+and enforce calls then take their timeout from the depth of the chips they
+read and the UART time to move the read packets, and their retry count from
+the measured probe loss, never fewer retries than the caller asked for.
+io_channels that were never measured fall back to
+the fixed timeout / retry values used before.
+
+Usage:
+    c.latency = latency.measure_network(c)
+    ok, diff = c.enforce_registers(pairs, **latency.enforce_kwargs(c, pairs, timeout=0.01, n=10, n_verify=10))
+
+'''
+import math
+import time
+
+import numpy as np
+import networkx as nx
+
+import larpix
+
+_default_n_probe=3
+_default_max_wait=0.5 # [s] probe gives up after this
+_default_margin=3. # timeout = margin * expected round trip
+_default_min_timeout=2e-3 # [s]
+_default_max_timeout=2. # [s]
+_default_min_n=2
+_default_max_n=10
+_default_target_miss=1e-6 # probability that every retry is lost
+
+uart_clock=10e6 # [Hz] PACMAN UART reference clock, divided by the clock ratio
+uart_bits_per_packet=66
+
+def _key(chip_key):
+    return chip_key if isinstance(chip_key, larpix.Key) else larpix.Key(chip_key)
+
+
+def network_depths(c, io_group, io_channel):
+    '''
+    Returns {chip_key: hops from the PACMAN} for one io_channel's hydra network
+
+    '''
+    graph = c.network[io_group][io_channel]['miso_us']
+    depths = nx.single_source_shortest_path_length(graph, 'ext')
+    return dict([(larpix.Key(io_group, io_channel, chip_id), depth) for chip_id, depth in depths.items() if chip_id != 'ext'])
+
+
+def probe_round_trip(c, chip_key, max_wait=_default_max_wait):
+    '''
+    Times one chip ID (register 122) read; returns seconds, or None if no reply
+
+    '''
+    packets = c[chip_key].get_configuration_read_packets(registers=[122])
+    for packet in packets: packet.chip_key = chip_key
+    c.io.empty_queue()
+    c.io.start_listening()
+    start = time.time()
+    c.io.send(packets)
+    round_trip = None
+    while time.time() - start < max_wait:
+        replies, _ = c.io.empty_queue()
+        if any([isinstance(reply, larpix.Packet_v2) and reply.packet_type == larpix.Packet_v2.CONFIG_READ_PACKET
+                and reply.chip_key == chip_key for reply in replies]):
+            round_trip = time.time() - start
+            break
+        time.sleep(1e-4)
+    c.io.stop_listening()
+    return round_trip
+
+
+class LatencyModel:
+
+    def __init__(self, margin=_default_margin, clk_ratio=4):
+        self.margin = margin
+        self.packet_time = uart_bits_per_packet / (uart_clock / clk_ratio)
+        self.depth = dict() # (io_group, io_channel, chip_id): hops
+        self.fit = dict() # (io_group, io_channel): (offset [s], per hop [s])
+        self.loss = dict() # (io_group, io_channel): fraction of unanswered probes
+
+    def add_depths(self, depths):
+        for chip_key, depth in depths.items():
+            key = _key(chip_key)
+            self.depth[(key.io_group, key.io_channel, key.chip_id)] = depth
+
+    def measure(self, c, io_group, io_channel, depths, n_probe=_default_n_probe, max_wait=_default_max_wait):
+        '''
+        Probes the shallowest and deepest chips of depths ({chip_key: hops})
+
+        '''
+        self.add_depths(depths)
+        if not depths: return
+        probe_keys = [min(depths, key=depths.get), max(depths, key=depths.get)]
+        if probe_keys[0] == probe_keys[1]: probe_keys = probe_keys[:1]
+        x, y, lost = [], [], 0
+        for chip_key in probe_keys:
+            for _ in range(n_probe):
+                round_trip = probe_round_trip(c, chip_key, max_wait)
+                if round_trip is None:
+                    lost += 1
+                    continue
+                x.append(depths[chip_key])
+                y.append(round_trip)
+        self.loss[(io_group, io_channel)] = lost / (n_probe*len(probe_keys))
+        if not y: return # unreachable: keep the fixed fallback
+        x, y = np.array(x, dtype=float), np.array(y)
+        if len(set(x)) > 1:
+            per_hop, offset = np.polyfit(x, y, 1)
+            per_hop = max(per_hop, 0.)
+        else:
+            per_hop = 2*self.packet_time # one UART frame each way per hop
+            offset = np.max(y) - per_hop*x[0]
+        # worst case observed at each depth, not the average, sets the offset
+        offset = max(offset, np.max(y - per_hop*x))
+        self.fit[(io_group, io_channel)] = (float(max(offset, 0.)), float(per_hop))
+        print('io_group',io_group,'io_channel',io_channel,'round trip %.2f ms + %.3f ms/hop, %.0f%% probes lost'%(
+            self.fit[(io_group, io_channel)][0]*1e3, per_hop*1e3, 100*self.loss[(io_group, io_channel)]))
+
+    def _by_io_channel(self, chip_keys):
+        grouped = dict()
+        for chip_key in chip_keys:
+            key = _key(chip_key)
+            grouped.setdefault((key.io_group, key.io_channel), []).append(key)
+        return grouped
+
+    def timeout(self, chip_keys, n_reads=1):
+        '''
+        Time to wait for n_reads register replies from each of chip_keys, or
+        None if any of their io_channels was not measured
+
+        '''
+        timeout = 0.
+        for io_key, keys in self._by_io_channel(chip_keys).items():
+            if io_key not in self.fit: return None
+            offset, per_hop = self.fit[io_key]
+            # chips of unknown depth are taken to be at the end of the longest chain
+            channel_depth = max([depth for (io_group, io_channel, chip_id), depth in self.depth.items() if (io_group, io_channel) == io_key] + [1])
+            max_depth = max([self.depth.get((key.io_group, key.io_channel, key.chip_id), channel_depth) for key in keys])
+            # requests and replies share the io_channel's UART
+            transfer = 2*n_reads*len(keys)*self.packet_time
+            timeout = max(timeout, self.margin*(offset + per_hop*max_depth) + transfer)
+        return min(max(timeout, _default_min_timeout), _default_max_timeout)
+
+    def retries(self, chip_keys):
+        n = _default_min_n
+        for io_key in self._by_io_channel(chip_keys):
+            if io_key not in self.fit: return None
+            loss = self.loss[io_key]
+            if loss > 0.: n = max(n, int(math.ceil(math.log(_default_target_miss)/math.log(loss))))
+        return min(n, _default_max_n)
+
+
+def measure_network(c, clk_ratio=4, n_probe=_default_n_probe):
+    '''
+    Builds a LatencyModel for every io_channel in the controller's network
+
+    '''
+    model = LatencyModel(clk_ratio=clk_ratio)
+    for io_group, io_channels in c.network.items():
+        for io_channel in io_channels:
+            depths = network_depths(c, io_group, io_channel)
+            depths = dict([(chip_key, depth) for chip_key, depth in depths.items() if chip_key in c.chips])
+            model.measure(c, io_group, io_channel, depths, n_probe=n_probe)
+    return model
+
+
+def _reads_per_chip(chip_register_pairs):
+    n_reads = dict()
+    for chip_key, registers in chip_register_pairs:
+        n = len(registers) if isinstance(registers, (list, tuple, range)) else 1
+        n_reads[str(chip_key)] = n_reads.get(str(chip_key), 0) + n
+    return max(list(n_reads.values())+[1])
+
+
+def _timeout_and_retries(c, chip_keys, n_reads, timeout, n):
+    ###### model-derived values where c.latency covers every io_channel, else the fixed ones;
+    ###### the given n is a floor, a lossless channel only shortens the timeout
+    model = getattr(c, 'latency', None)
+    if model is None: return timeout, n
+    model_timeout, model_n = model.timeout(chip_keys, n_reads), model.retries(chip_keys)
+    if model_timeout is None or model_n is None: return timeout, n
+    return model_timeout, max(n, model_n)
+
+
+def verify_kwargs(c, chip_register_pairs, timeout, n):
+    '''
+    verify_registers timeout / n for chip_register_pairs; the given fixed values
+    are used for io_channels without a latency measurement
+
+    '''
+    timeout, n = _timeout_and_retries(c, [chip_key for chip_key, registers in chip_register_pairs],
+                                      _reads_per_chip(chip_register_pairs), timeout, n)
+    return dict(timeout=timeout, n=n)
+
+
+def enforce_kwargs(c, chip_register_pairs, timeout, n, n_verify):
+    timeout, n_model = _timeout_and_retries(c, [chip_key for chip_key, registers in chip_register_pairs],
+                                            _reads_per_chip(chip_register_pairs), timeout, 0)
+    return dict(timeout=timeout, n=max(n, n_model), n_verify=max(n_verify, n_model))
+
+
+def configuration_kwargs(c, chip_keys, timeout, n, n_verify):
+    '''
+    enforce_configuration timeout / n / n_verify for whole-chip reads of chip_keys
+
+    '''
+    chip_keys = list(chip_keys)
+    n_reads = max([c[chip_key].config.num_registers for chip_key in chip_keys]) if chip_keys else 1
+    return enforce_kwargs(c, [(chip_key, range(n_reads)) for chip_key in chip_keys], timeout, n, n_verify)
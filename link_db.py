@@ -0,0 +1,98 @@
+'''
+Persistent UART link-quality database
+
+Every link tested by map_uart_links_qc is appended to a SQLite file as a
+(tile_id, chip, next_chip, ok, time) row, so a tile's pass / fail history
+survives between runs. The latest result of each link decides its status.
+
+A re-check run preloads the arrangement from the history: links last seen
+good are taken as good and not probed again (except a random sample of them),
+links last seen bad are kept out of the planned network and re-probed by the
+per-chip tests, and links never tested are probed as usual.
+
+Usage:
+    $ python3 map_uart_links_qc.py --pacman_tile 1 --tile_id 1 --link_db links.db --recheck
+
+'''
+import sqlite3
+import random
+import time
+
+_default_link_db='uart_links.db'
+_default_recheck_fraction=0.1 # fraction of known-good links probed again on a re-check
+
+class LinkDB:
+
+    def __init__(self, filename=_default_link_db):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS link_tests (tile_id TEXT, chip INTEGER, next_chip INTEGER, ok INTEGER, time REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS link_tests_by_link ON link_tests (tile_id, chip, next_chip, time)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def record(self, tile_id, links, ok, timestamp=None):
+        '''
+        Appends one result per (chip, next_chip) link
+
+        '''
+        if timestamp is None: timestamp = time.time()
+        self.conn.executemany('INSERT INTO link_tests VALUES (?, ?, ?, ?, ?)',
+                              [(str(tile_id), int(chip), int(next_chip), int(bool(ok)), timestamp) for chip, next_chip in links])
+        self.conn.commit()
+
+    def history(self, tile_id, link):
+        '''
+        Returns [(time, ok), ...] for one link, oldest first
+
+        '''
+        rows = self.conn.execute('SELECT time, ok FROM link_tests WHERE tile_id=? AND chip=? AND next_chip=? ORDER BY time',
+                                 (str(tile_id), int(link[0]), int(link[1])))
+        return [(timestamp, bool(ok)) for timestamp, ok in rows]
+
+    def status(self, tile_id):
+        '''
+        Returns {(chip, next_chip): latest ok} for every link tested on the tile
+
+        '''
+        rows = self.conn.execute('SELECT chip, next_chip, ok FROM link_tests WHERE tile_id=? ORDER BY time', (str(tile_id),))
+        return dict([((chip, next_chip), bool(ok)) for chip, next_chip, ok in rows])
+
+    def good_links(self, tile_id):
+        return set([link for link, ok in self.status(tile_id).items() if ok])
+
+    def bad_links(self, tile_id):
+        return set([link for link, ok in self.status(tile_id).items() if not ok])
+
+
+def preload(db, tile_id, arr, recheck_fraction=_default_recheck_fraction, seed=None):
+    '''
+    Fills arr from the tile's history for a re-check run; returns the
+    (skipped good, excluded bad) link sets so record_run can tell fresh
+    results from preloaded ones
+
+    '''
+    rng = random.Random(seed)
+    status = db.status(tile_id)
+    good = set([link for link, ok in status.items() if ok and rng.random() >= recheck_fraction])
+    bad = set([link for link, ok in status.items() if not ok])
+    for link in good: arr.good_connections.add(link)
+    for link in bad: arr.add_onesided_excluded_link(link)
+    print('link database:', len(good), 'known-good links skipped,', len(bad), 'known-bad links to re-probe,',
+          len(status) - len(good) - len(bad), 'good links sampled')
+    return good, bad
+
+
+def record_run(db, tile_id, arr, preloaded_good=set(), timestamp=None):
+    '''
+    Records the links tested in this run; a link that failed in either
+    direction test counts as bad, as in the generated configuration
+
+    '''
+    bad = set(arr.excluded_links)
+    good = set(arr.good_connections) - bad - set(preloaded_good)
+    db.record(tile_id, good, True, timestamp)
+    db.record(tile_id, bad, False, timestamp)
+    print('link database:', len(good), 'good and', len(bad), 'bad links recorded for tile', tile_id, 'in', db.filename)
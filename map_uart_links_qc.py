@@ -6,12 +6,17 @@ import larpix
 import larpix.io
 import larpix.logger
 import generate_config
+import pacman_sim
+import instrumentation
+import latency
+import link_db
 
 _uart_phase = 0
 
 _default_controller_config=None
 _default_logger=False
 _default_reset=True
+_default_simulate=None
 
 _default_chip_id = 2
 _default_io_channel = 1
@@ -20,6 +25,13 @@ _default_mosi = 0
 
 _default_clk_ctrl = 1
 
+_default_batched_verify = False
+_default_batch_verify_timeout = 0.1
+_default_balanced_network = False
+
+_default_link_db = None
+_default_recheck = False
+
 clk_ctrl_2_clk_ratio_map = {
 		0: 2,
 		1: 4,
@@ -56,6 +68,9 @@ def flush_data(controller, runtime=0.1, rate_limit=0., max_iterations=10):
 
 arr = graphs.NumberedArrangement()
 
+def default_arrangement():
+	return arr
+
 def get_temp_key(io_group, io_channel):
 	return larpix.key.Key(io_group, io_channel, 1)
 
@@ -127,10 +142,11 @@ def get_good_roots(c, io_group, io_channels):
 
 	return good_roots, good_channels
 
-def reset_board_get_controller(io_group, io_channels, pacman_version='v1rev3'):
+def reset_board_get_controller(io_group, io_channels, pacman_version='v1rev3', simulate=_default_simulate):
 	#creating controller with pacman io
 	c = larpix.Controller()
-	c.io = larpix.io.PACMAN_IO(relaxed=True)
+	c.io = pacman_sim.create_io(simulate)
+	instrumentation.instrument(c)
 	c.io.double_send_packets = True
 
 	if pacman_version == 'v1rev3':
@@ -201,13 +217,15 @@ def reset_board_get_controller(io_group, io_channels, pacman_version='v1rev3'):
 
 	return c
 
-def init_initial_network(c, io_group, io_channels, paths):
+def init_initial_network(c, io_group, io_channels, paths, arrangements=None):
+	if arrangements is None: arrangements = [default_arrangement()]*len(paths)
 	root_chips = [path[0] for path in paths]
 
 	still_stepping = [True for root in root_chips]
 	ordered_chips_by_channel = [ [] for io_channel in io_channels  ]
 
 	for ipath, path in enumerate(paths):
+		arr = arrangements[ipath]
 
 		step = 0
 
@@ -259,18 +277,38 @@ def init_initial_network(c, io_group, io_channels, paths):
 
 	return True
 
-def test_network(c, io_group, io_channels, paths):
+def verify_chip_ids(c, keys, timeout=None):
+	'''
+	Reads the chip ID register of all keys in one verify_registers call with a
+	short (latency-model) timeout; keys that fail are re-read one at a time with the full
+	timeout before being reported. Returns the verified keys
+
+	'''
+	pairs = [(key, 122) for key in keys]
+	if timeout is None: timeout = latency.verify_kwargs(c, pairs, timeout=_default_batch_verify_timeout, n=1)['timeout']
+	ok, diff = c.verify_registers(pairs, timeout=timeout, n=1)
+	verified = [key for key in keys if key not in diff]
+	for key in keys:
+		if key not in diff: continue
+		ok, _ = c.verify_registers([(key, 122)], timeout=0.5, n=3)
+		if ok: verified.append(key)
+	return verified
+
+def test_network(c, io_group, io_channels, paths, arrangements=None, batched=_default_batched_verify):
+	if arrangements is None: arrangements = [default_arrangement()]*len(paths)
 	root_chips = [path[0] for path in paths]
 	step = 0
 	still_stepping = [True for path in paths]
 	valid = [True for path in paths]
 	while any(still_stepping):
 		step += 1
+		pending = [] # (ipath, prev_key, next_key) hops awaiting the batched verify of this step
 
 		for ipath, path in enumerate(paths):
 			
 			if not still_stepping[ipath] or not valid[ipath]:
 				continue
+			arr = arrangements[ipath]
 
 			if step > len(path)-1:
 				still_stepping[ipath] = False
@@ -298,7 +336,11 @@ def test_network(c, io_group, io_channels, paths):
 				print(next_key, 'already verified')
 				continue
 
-			ok, diff = c.verify_registers([(next_key, 122)], timeout=0.5, n=3)
+			if batched:
+				pending.append((ipath, prev_key, next_key))
+				continue
+
+			ok, diff = c.verify_registers([(next_key, 122)], **latency.verify_kwargs(c, [(next_key, 122)], timeout=0.5, n=3))
 			print(next_key, ok )
 
 			if ok:
@@ -311,9 +353,24 @@ def test_network(c, io_group, io_channels, paths):
 				still_stepping[ipath] = False
 				valid[ipath] = False
 
+		if not pending: continue
+		###### one verify for this step's hops on every still-stepping path
+		verified = verify_chip_ids(c, [next_key for ipath, prev_key, next_key in pending])
+		for ipath, prev_key, next_key in pending:
+			ok = next_key in verified
+			print(next_key, ok )
+			if ok:
+				arrangements[ipath].add_good_connection((prev_key.chip_id, next_key.chip_id))
+			else:
+				arrangements[ipath].add_onesided_excluded_link((prev_key.chip_id, next_key.chip_id))
+				still_stepping[ipath] = False
+				valid[ipath] = False
+
 	return all(valid)
 
-def test_chip(c, io_group, io_channel, path, ich, all_paths_copy, io_channels_copy):
+def test_chip_steps(c, io_group, io_channel, path, ich, all_paths_copy, io_channels_copy, arr=None):
+	###### test_chip as a generator: yields each chip ID read it waits on and is sent (ok, diff) back,
+	###### so that run_probes can read for several probes at once
 	#-loop over directions
 	#-check if chip in that direction is in current network
 	#---if in network:
@@ -339,6 +396,7 @@ def test_chip(c, io_group, io_channel, path, ich, all_paths_copy, io_channels_co
 	#		-disbale miso us from current (for good measure, we know it doesnt work)
 	#		-read register from chip
 	
+	if arr is None: arr = default_arrangement()
 	chip = path[ich]
 	#check if last chip in path
 	
@@ -422,7 +480,7 @@ def test_chip(c, io_group, io_channel, path, ich, all_paths_copy, io_channels_co
 		c.write_configuration(new_next_key, 'enable_miso_downstream')
 		
 		#check if we can communicate with it
-		ok, diff = c.verify_registers([(new_next_key, 122)], timeout=0.5, n=3) #just reading chip id
+		ok, diff = (yield [(new_next_key, 122)]) #just reading chip id
 		if True:
 			if ok:
 				print('successfully tested uart', chip, next_chip)
@@ -444,9 +502,9 @@ def test_chip(c, io_group, io_channel, path, ich, all_paths_copy, io_channels_co
 				c.write_configuration(next_key, 'enable_miso_downstream')
 
 				#test configs
-				ok, diff = c.verify_registers([(next_key, 122), (curr_key, 122)], timeout=0.5, n=3)
+				ok, diff = (yield [(next_key, 122), (curr_key, 122)])
 				if real_io_channel < 0:
-					ok2, diff2 = c.verify_registers([(prev_key, 122)], timeout=0.5, n=3)
+					ok2, diff2 = (yield [(prev_key, 122)])
 					ok = (ok and ok2)
 
 				if ok:
@@ -462,9 +520,9 @@ def test_chip(c, io_group, io_channel, path, ich, all_paths_copy, io_channels_co
 					c[next_key].config.enable_miso_downstream = next_ds_backup
 					c.write_configuration(next_key, 'enable_miso_downstream')
 
-					ok, diff = c.verify_registers([(next_key, 122), (curr_key, 122)], timeout=0.5, n=3)
+					ok, diff = (yield [(next_key, 122), (curr_key, 122)])
 					if real_io_channel < 0:
-						ok2, diff2 = c.verify_registers([(prev_key, 122)], timeout=0.5, n=3)
+						ok2, diff2 = (yield [(prev_key, 122)])
 						ok = (ok and ok2)
 
 					if ok:
@@ -482,58 +540,114 @@ def test_chip(c, io_group, io_channel, path, ich, all_paths_copy, io_channels_co
 							c.write_configuration(prev_key, 'enable_miso_upstream')
 
 
-						ok, diff = c.verify_registers([(next_key, 122), (curr_key, 122)], timeout=0.5, n=3)
+						ok, diff = (yield [(next_key, 122), (curr_key, 122)])
 
 						if real_io_channel < 0:
-							ok2, diff2 = c.verify_registers([(prev_key, 122)], timeout=0.5, n=3)
+							ok2, diff2 = (yield [(prev_key, 122)])
 							ok = (ok and ok2)
 
 						continue
 	return True
 	
 
+def test_chip(c, io_group, io_channel, path, ich, all_paths_copy, io_channels_copy, arr=None):
+	return run_probes(c, [[(None, test_chip_steps(c, io_group, io_channel, path, ich, all_paths_copy, io_channels_copy, arr))]])[None]
 
-def main(pacman_tile, generate_configuration, tile_id, pacman_version):
-	tile_name = 'id-' + tile_id 
-	io_group = 1
-	io_channels = [ 1 + 4*(pacman_tile - 1) + n for n in range(4)]
-	#io_channels = [1, 2, 4]
-	c = reset_board_get_controller(io_group, io_channels, pacman_version)
+def run_probes(c, queues):
+	'''
+	Runs queues of (label, test_chip_steps) probes side by side, one probe of
+	each queue at a time: the chip ID reads that the current probes wait on are
+	made in one verify_registers call, so probes on independent io_channels
+	share each read timeout. Returns {label: test_chip result}
 
-	root_chips, io_channels = get_good_roots(c, io_group, io_channels)
-	print(root_chips)
-	c = reset_board_get_controller(io_group, io_channels, pacman_version)
+	'''
+	queues = [iter(queue) for queue in queues]
+	results = dict()
+	current = dict() # queue index: (label, probe, pairs awaiting a read)
+
+	def advance(iqueue, reply=None):
+		###### steps the queue's probe to its next read, starting its next probes as they finish
+		label, probe, pairs = current.pop(iqueue, (None, None, None))
+		while True:
+			try:
+				if probe is not None:
+					current[iqueue] = (label, probe, probe.send(reply) if reply is not None else next(probe))
+					return
+			except StopIteration as e:
+				results[label] = e.value
+			label, probe = next(queues[iqueue], (None, None))
+			reply = None
+			if probe is None: return
+
+	for iqueue in range(len(queues)): advance(iqueue)
+	while current:
+		pairs = [pair for label, probe, probe_pairs in current.values() for pair in probe_pairs]
+		ok, diff = c.verify_registers(pairs, **latency.verify_kwargs(c, pairs, timeout=0.5, n=3))
+		for iqueue, (label, probe, probe_pairs) in list(current.items()):
+			keys = [key for key, register in probe_pairs]
+			probe_diff = dict([(key, registers) for key, registers in diff.items() if key in keys])
+			advance(iqueue, (not probe_diff, probe_diff))
+	return results
+
+
+def main(pacman_tile, generate_configuration, tile_id, pacman_version, simulate=_default_simulate, pacman_tiles=None, tile_ids=None, batched_verify=_default_batched_verify, balanced_network=_default_balanced_network, link_db_file=_default_link_db, recheck=_default_recheck, recheck_fraction=link_db._default_recheck_fraction):
+	###### one controller for all tiles; each tile keeps its own link arrangement
+	if pacman_tiles is None: pacman_tiles, tile_ids = [pacman_tile], [tile_id]
+	if tile_ids is None: tile_ids = [str(tile) for tile in pacman_tiles]
+	io_group = 1
+	tiles = []
+	for itile, tile in enumerate(pacman_tiles):
+		tiles.append(dict(
+			pacman_tile = tile,
+			tile_id = tile_ids[itile],
+			tile_name = 'id-' + tile_ids[itile],
+			io_channels = [ 1 + 4*(tile - 1) + n for n in range(4)],
+			arr = default_arrangement() if len(pacman_tiles) == 1 else graphs.NumberedArrangement()
+			))
+	c = reset_board_get_controller(io_group, sum([tile['io_channels'] for tile in tiles], []), pacman_version, simulate)
+
+	###### link history: known-good links are not probed again, known-bad ones are planned around and re-probed
+	db = link_db.LinkDB(link_db_file) if link_db_file else None
+	for tile in tiles:
+		tile['preloaded_good'], tile['preloaded_bad'] = set(), set()
+		if db and recheck: tile['preloaded_good'], tile['preloaded_bad'] = link_db.preload(db, tile['tile_id'], tile['arr'], recheck_fraction)
+
+	###### root round trips set the verify timeouts (deeper hops add one UART frame each way)
+	model = latency.LatencyModel(clk_ratio=clk_ctrl_2_clk_ratio_map[_default_clk_ctrl])
+	for tile in tiles:
+		tile['root_chips'], tile['io_channels'] = get_good_roots(c, io_group, tile['io_channels'])
+		print(tile['root_chips'])
+		for root, io_channel in zip(tile['root_chips'], tile['io_channels']):
+			model.measure(c, io_group, io_channel, {larpix.key.Key(io_group, io_channel, root): 1})
+	all_io_channels = sum([tile['io_channels'] for tile in tiles], [])
 
 	#need to init whole network first and write clock frequency, then we can step through and test
-
-	existing_paths = [ [chip] for chip in root_chips  ]
-
-	#initial network
-	paths = arr.get_path(existing_paths)
-	print('path including', sum(  [len(path) for path in paths] ), 'chips' )
-
-	#bring up initial network and set clock frequency
-	init_initial_network(c, io_group, io_channels, paths)
-	#test network to make sure all chips were brought up correctly
-	ok = test_network(c, io_group, io_channels, paths)
-
+	ok = False
 	while not ok:
-		c = reset_board_get_controller(io_group, io_channels, pacman_version)
-
-		existing_paths = [ [chip] for chip in root_chips  ]
-
-		#initial network
-		paths = arr.get_path(existing_paths)
-		print('path inlcuding', sum(  [len(path) for path in paths] ), 'chips' )
+		c = reset_board_get_controller(io_group, all_io_channels, pacman_version, simulate)
+
+		#initial network, paths of all tiles side by side
+		paths, io_channels, arrangements = [], [], []
+		for tile in tiles:
+			tile['paths'] = tile['arr'].get_path([ [chip] for chip in tile['root_chips'] ])
+			paths += tile['paths']
+			io_channels += tile['io_channels']
+			arrangements += [tile['arr']]*len(tile['paths'])
+		print('path including', sum(  [len(path) for path in paths] ), 'chips' )
+		for io_channel, path in zip(io_channels, paths):
+			model.add_depths(dict([(larpix.key.Key(io_group, io_channel, chip), step+1) for step, chip in enumerate(path)]))
+		c.latency = model
 
 		#bring up initial network and set clock frequency
-		init_initial_network(c, io_group, io_channels, paths)
-
+		init_initial_network(c, io_group, io_channels, paths, arrangements)
 		#test network to make sure all chips were brought up correctly
-		ok = test_network(c, io_group, io_channels, paths)
+		ok = test_network(c, io_group, io_channels, paths, arrangements, batched_verify)
 
 	#existing network is full initialized, start tests
-	chips_to_test = [] #keeps track of chips that weren't tested during this run for whatever reason
+	for tile in tiles: tile['chips_to_test'] = [] #keeps track of chips that weren't tested during this run for whatever reason
+
+	###### known-bad links were only excluded for planning; the per-chip tests decide them again
+	for tile in tiles: tile['arr'].excluded_links -= tile['preloaded_bad']
 
 	##
 	##
@@ -543,30 +657,43 @@ def main(pacman_tile, generate_configuration, tile_id, pacman_version):
 	##
 	##
 
-	for ipath, path in enumerate(paths):
-		for ich in range(len(path)):
-			ok = test_chip(c, io_group, io_channels[ipath], path, ich, paths.copy(), io_channels.copy())
-			#only returns whether or not a test was performed, not the test status
-			if not ok:
-				chips_to_test.append(path[ich])
-
-	#chips which are untested
-	missing_chips = [chip for chip in arr.all_chips() if not any( [chip in path for path in paths] ) ]
-	for chip in missing_chips:
-		chips_to_test.append(chip)
-
-	print('untested', chips_to_test)
-	print('bad (one-way) links: ', arr.excluded_links)
-	print('tested', len(arr.good_connections) + len(arr.excluded_links), 'uarts')
-
-	######
-	##generating config file
-	paths = arr.get_path(existing_paths)
-	_name = 'tile-' + tile_name + "-pacman-tile-"+str(pacman_tile)+"-hydra-network"
-	if generate_configuration:
-		print('writing configuration', _name + '.json, including', sum(  [len(path) for path in paths] ), 'chips'  )
-		generate_config.main(_name, io_group, root_chips, io_channels, arr.excluded_links, arr.excluded_chips)
-
+	###### per-chip probes run one at a time on each tile, side by side across tiles (independent io_channels):
+	###### each round's chip ID reads of all tiles go out in one verify
+	probes = [ [((itile, ipath, ich), test_chip_steps(c, io_group, tile['io_channels'][ipath], path, ich, tile['paths'].copy(), tile['io_channels'].copy(), tile['arr']))
+		for ipath, path in enumerate(tile['paths']) for ich in range(len(path))] for itile, tile in enumerate(tiles) ]
+	for (itile, ipath, ich), ok in run_probes(c, probes).items():
+		#only returns whether or not a test was performed, not the test status
+		if not ok:
+			tiles[itile]['chips_to_test'].append(tiles[itile]['paths'][ipath][ich])
+
+	for tile in tiles:
+		arr, paths = tile['arr'], tile['paths']
+		print('\n===========\t pacman tile', tile['pacman_tile'], tile['tile_name'], '\t===========')
+
+		if db: link_db.record_run(db, tile['tile_id'], arr, tile['preloaded_good'])
+		#known-bad links that could not be re-probed stay excluded
+		for link in tile['preloaded_bad']:
+			if not link in arr.good_connections: arr.add_onesided_excluded_link(link)
+
+		#chips which are untested
+		missing_chips = [chip for chip in arr.all_chips() if not any( [chip in path for path in paths] ) ]
+		for chip in missing_chips:
+			tile['chips_to_test'].append(chip)
+
+		print('untested', tile['chips_to_test'])
+		print('bad (one-way) links: ', arr.excluded_links)
+		print('tested', len(arr.good_connections) + len(arr.excluded_links), 'uarts')
+
+		######
+		##generating config file
+		if balanced_network: paths = [list(tree.keys()) for tree in arr.get_balanced_forest(tile['root_chips'])[0]]
+		else: paths = arr.get_path([ [chip] for chip in tile['root_chips'] ])
+		_name = 'tile-' + tile['tile_name'] + "-pacman-tile-"+str(tile['pacman_tile'])+"-hydra-network"
+		if generate_configuration:
+			print('writing configuration', _name + '.json, including', sum(  [len(path) for path in paths] ), 'chips'  )
+			generate_config.main(_name, io_group, tile['root_chips'], tile['io_channels'], arr.excluded_links, arr.excluded_chips, balanced=balanced_network)
+
+	if db: db.close()
 	return
 
 if __name__ == '__main__':
@@ -575,5 +702,13 @@ if __name__ == '__main__':
 	parser.add_argument('--pacman_version', default='v1rev3', type=str, help='''Pacman version; v1rev2 for SingleCube; otherwise, v1rev3''')
 	parser.add_argument('--tile_id', default='1', type=str, help='''Unique LArPix large-format tile ID''')
 	parser.add_argument('--generate_configuration', default=True, type=bool, help='''Flag to write configuration file with name tile-(tile number).json''')
+	parser.add_argument('--pacman_tiles', default=None, nargs='+', type=int, help='''Map several Pacman tiles in one run with one controller (overrides --pacman_tile)''')
+	parser.add_argument('--tile_ids', default=None, nargs='+', type=str, help='''Unique tile IDs matching --pacman_tiles (default: the Pacman tile numbers)''')
+	parser.add_argument('--batched_verify', default=_default_batched_verify, action='store_true', help='''Verify each network bring-up step for all paths in one short-timeout read''')
+	parser.add_argument('--balanced_network', default=_default_balanced_network, action='store_true', help='''Write a breadth-first hydra network (shortest chains, balanced over roots) instead of daisy chains''')
+	parser.add_argument('--link_db', dest='link_db_file', default=_default_link_db, type=str, help='''SQLite file recording the pass/fail history of every tested link, per tile ID''')
+	parser.add_argument('--recheck', default=_default_recheck, action='store_true', help='''With --link_db, skip links last seen good (except a sample) and re-probe only bad and untested links''')
+	parser.add_argument('--recheck_fraction', default=link_db._default_recheck_fraction, type=float, help='''Fraction of known-good links probed again with --recheck''')
+	parser.add_argument('--simulate', default=_default_simulate, nargs='?', const='', type=str, help='''Use the hardware-free PACMAN simulator, optionally with a JSON sim config file''')
 	args = parser.parse_args()
 	c = main(**vars(args))
@@ -0,0 +1,156 @@
+'''
+Shared per-channel packet statistics for the QC analysis scripts
+
+Packets are grouped by unique channel ID once and reduced into a per-channel
+ADC histogram (the LArPix-v2 dataword is 8 bits), from which count, mean,
+std, median and rate are derived as NumPy arrays.
+
+Datalogs are streamed through in fixed-size chunks, reading only the packet
+fields the analysis needs, so memory stays bounded for long runs.
+
+'''
+import h5py
+import numpy as np
+
+n_adc_bins = 256
+_default_chunk_size = 1000000
+packet_fields = ['packet_type','valid_parity','io_group','io_channel','chip_id','channel_id','dataword','timestamp']
+
+def unique_channel_id(io_group, io_channel, chip_id, channel_id): return channel_id + 100*(chip_id + 1000*(io_channel + 1000*(io_group)))
+
+
+def packet_unique_channel_id(data):
+    return unique_channel_id(data['io_group'].astype(np.uint64),
+                             data['io_channel'].astype(np.uint64),
+                             data['chip_id'].astype(np.uint64),
+                             data['channel_id'].astype(np.uint64))
+
+
+def channel_adc_histogram(unique_id, adc):
+    '''
+    Returns the sorted unique channel IDs and a (channel x 256) ADC histogram
+
+    '''
+    unique, inverse = np.unique(unique_id, return_inverse=True)
+    flat_index = inverse.astype(np.int64)*n_adc_bins + np.asarray(adc, dtype=np.int64)
+    hist = np.bincount(flat_index, minlength=len(unique)*n_adc_bins)
+    return unique, hist.reshape(len(unique), n_adc_bins)
+
+
+def histogram_median(hist, count):
+    # matches np.median: average of the two middle values for even counts
+    cumulative = np.cumsum(hist, axis=1)
+    lower = np.argmax(cumulative > ((count-1)//2)[:,None], axis=1)
+    upper = np.argmax(cumulative > (count//2)[:,None], axis=1)
+    return (lower + upper) / 2.
+
+
+def channel_statistics(unique, hist, livetime):
+    '''
+    Reduces a per-channel ADC histogram to a dict of per-channel arrays:
+    unique, count, mean, std, median, rate (NaN if livetime is None)
+
+    '''
+    adc_values = np.arange(hist.shape[1], dtype=np.float64)
+    count = hist.sum(axis=1)
+    safe_count = np.maximum(count, 1)
+    mean = hist.dot(adc_values) / safe_count
+    variance = hist.dot(adc_values**2) / safe_count - mean**2
+    std = np.sqrt(np.clip(variance, 0., None))
+    return dict(
+        unique = unique,
+        count = count,
+        mean = mean,
+        std = std,
+        median = histogram_median(hist, count),
+        rate = count / (livetime + 1e-9) if livetime is not None else np.full(len(count), np.nan)
+        )
+
+
+def grouped_channel_statistics(unique_id, adc, livetime):
+    unique, hist = channel_adc_histogram(unique_id, adc)
+    return channel_statistics(unique, hist, livetime)
+
+
+class ChannelAccumulator:
+    '''
+    Incrementally accumulates per-channel ADC histograms over packet chunks
+
+    '''
+    def __init__(self):
+        self.unique = None
+        self.hist = None
+
+    def add(self, unique_id, adc):
+        unique, hist = channel_adc_histogram(unique_id, adc)
+        hist = hist.astype(np.uint32) # keeps a full anode of channels at ~1 kB each
+        if self.unique is None:
+            self.unique, self.hist = unique, hist
+            return
+        merged = np.union1d(self.unique, unique)
+        if len(merged) != len(self.unique):
+            merged_hist = np.zeros((len(merged), n_adc_bins), dtype=self.hist.dtype)
+            merged_hist[np.searchsorted(merged, self.unique)] = self.hist
+            self.unique, self.hist = merged, merged_hist
+        self.hist[np.searchsorted(self.unique, unique)] += hist
+
+    def statistics(self, livetime):
+        if self.unique is None:
+            return channel_statistics(np.zeros(0, dtype=np.uint64), np.zeros((0, n_adc_bins), dtype=np.uint32), livetime)
+        return channel_statistics(self.unique, self.hist, livetime)
+
+
+def iter_packet_chunks(f, fields=packet_fields, chunk_size=_default_chunk_size, max_packets=None):
+    '''
+    Yields successive chunks of the packets dataset, restricted to fields
+
+    '''
+    packets = f['packets']
+    n_packets = len(packets)
+    if max_packets is not None: n_packets = min(n_packets, max_packets)
+    reader = packets.fields(list(fields))
+    for start in range(0, n_packets, chunk_size):
+        yield reader[start:min(start+chunk_size, n_packets)]
+
+
+def read_channel_statistics(datalog_file, unique_id_function=packet_unique_channel_id, valid_parity_only=True,
+                            chunk_size=_default_chunk_size, max_packets=None, require_livetime=True):
+    '''
+    Streams a datalog once and returns the per-channel statistics dict and the
+    livetime spanned by the timestamp packets. Without two distinct timestamps
+    there is no livetime: raises RuntimeError, or with require_livetime=False
+    returns livetime None and NaN rates (count, mean, std are still valid)
+
+    '''
+    accumulator = ChannelAccumulator()
+    min_time, max_time = None, None
+    with h5py.File(datalog_file,'r') as f:
+        for chunk in iter_packet_chunks(f, chunk_size=chunk_size, max_packets=max_packets):
+            unixtime = chunk['timestamp'][chunk['packet_type'] == 4]
+            if len(unixtime):
+                min_time = np.min(unixtime) if min_time is None else min(min_time, np.min(unixtime))
+                max_time = np.max(unixtime) if max_time is None else max(max_time, np.max(unixtime))
+            data_mask = chunk['packet_type'] == 0
+            if valid_parity_only: data_mask = np.logical_and(data_mask, chunk['valid_parity'] == 1)
+            data = chunk[data_mask]
+            if len(data): accumulator.add(unique_id_function(data), data['dataword'])
+    ###### rates over a zero livetime would flag every channel as noisy
+    if min_time is None or max_time == min_time:
+        if not require_livetime: return accumulator.statistics(None), None
+        raise RuntimeError('{}: no livetime, fewer than two distinct timestamp packets (packet_type 4) to compute rates from'.format(datalog_file))
+    livetime = float(max_time) - float(min_time)
+    return accumulator.statistics(livetime), livetime
+
+
+def chip_channel_counts(triggered_channels, n_channels=64):
+    '''
+    Counts [chip_key, channel_id] pairs (as extracted from a PacketCollection)
+    in one pass; returns the chip keys and a (chip x 64) count array
+
+    '''
+    chip_index = dict()
+    n = len(triggered_channels)
+    rows = np.fromiter((chip_index.setdefault(chip_key, len(chip_index)) for chip_key, channel in triggered_channels), dtype=np.int64, count=n)
+    channels = np.fromiter((channel for chip_key, channel in triggered_channels), dtype=np.int64, count=n)
+    counts = np.bincount(rows*n_channels + channels, minlength=len(chip_index)*n_channels)
+    return list(chip_index.keys()), counts.reshape(len(chip_index), n_channels)
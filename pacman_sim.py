@@ -0,0 +1,453 @@
+'''
+Hardware-free PACMAN IO for running the QC scripts offline
+
+SimulatedPACMAN_IO is a drop-in replacement for larpix.io.PACMAN_IO. Each
+(io_group, tile) is modelled as a 10x10 grid of LArPix-v2 chips behind four
+root chips (11, 41, 71, 101 on the tile's four io_channels). Config packets
+are routed through the hydra network using the chips' own miso upstream /
+downstream enables, so broken UART links and dead chips behave as they would
+on a real tile. While listening, chips generate self-triggered and periodic
+data packets from per-channel pedestal / noise distributions, limited by the
+UART bandwidth of each io_channel.
+
+Usage:
+    select with --simulate [<sim config json>] on any QC script
+
+'''
+import json
+import time
+from collections import defaultdict, Counter
+
+import numpy as np
+
+import larpix
+import larpix.io
+import larpix.format.rawhdf5format as rhdf5
+import larpix.format.pacman_msg_format as pacman_msg_fmt
+
+import graphs
+
+_default_sim_config = dict(
+    seed = 0,
+    broken_links = dict(), # '<io_group>-<tile>': [[from chip id, to chip id], ...] (one-sided)
+    dead_chips = dict(), # '<io_group>-<tile>': [chip id, ...]
+    pedestal_mean = 25., # [ADC] mean of per-channel pedestals
+    pedestal_spread = 5., # [ADC] spread of per-channel pedestals
+    noise_mean = 2.5, # [ADC] mean of per-channel pedestal RMS
+    noise_spread = 0.5, # [ADC] spread of per-channel pedestal RMS
+    noise_rate = 1e5, # [Hz] self-trigger rate with threshold at pedestal
+    hot_channel_fraction = 0.005, # fraction of channels with leakage-driven triggers
+    hot_channel_rate = 2e4, # [Hz] trigger rate of hot channels
+    vdda = 1800., # [mV]
+    threshold_offset = 210., # [mV] global threshold offset
+    trim_scale = 1.45, # [mV] per pixel trim DAC
+    uart_latency = 1e-4, # [s] fixed PACMAN round-trip latency
+    uart_clock = 10e6, # [Hz] PACMAN UART reference clock, divided by the clock ratio
+    uart_bits_per_packet = 66,
+    )
+
+root_chips = [11, 41, 71, 101]
+hard_reset_length = 64
+max_msg_words = 0xffff
+
+# process-wide UART transaction counts, summed over all simulated IO instances
+uart_counters = Counter()
+
+def load_sim_config(sim_config=None):
+    config = dict(_default_sim_config)
+    if sim_config:
+        with open(sim_config,'r') as f: config.update(json.load(f))
+    return config
+
+
+def create_io(simulate=None):
+    ###### PACMAN IO, or the simulator when simulate is a sim config path ('' for defaults)
+    if simulate is None: return larpix.io.PACMAN_IO(relaxed=True)
+    print('using simulated PACMAN IO',('with '+simulate) if simulate else '')
+    return SimulatedPACMAN_IO(sim_config=simulate)
+
+
+def tile_of_io_channel(io_channel): return (io_channel-1)//4 + 1
+
+
+def io_channel_of_root(tile, root): return (tile-1)*4 + root_chips.index(root) + 1
+
+
+class _RegisterMap:
+    '''
+    Bit locations of the configuration fields the simulator acts on, probed
+    once from larpix's own register encoding
+
+    '''
+    fields = dict(
+        chip_id = (1, 8),
+        enable_miso_upstream = (4, 1),
+        enable_miso_downstream = (4, 1),
+        enable_periodic_trigger = (1, 1),
+        periodic_trigger_cycles = (1, 32),
+        threshold_global = (1, 8),
+        pixel_trim_dac = (64, 5),
+        csa_enable = (64, 1),
+        channel_mask = (64, 1),
+        periodic_trigger_mask = (64, 1),
+        vref_dac = (1, 8),
+        vcm_dac = (1, 8),
+        )
+
+    def __init__(self):
+        self.chip = larpix.Chip(larpix.Key(1,1,1), version=2)
+        self.default_registers = self._registers()
+        self.bits = dict()
+        for name, (length, width) in self.fields.items():
+            self.bits[name] = self._probe(name, length, width)
+        self.routing_registers = set([addr for name in ('enable_miso_upstream','enable_miso_downstream')
+                                      for element in self.bits[name] for addr, bit in element])
+
+    def _registers(self):
+        registers = np.zeros(self.chip.config.num_registers, dtype=np.uint8)
+        for packet in self.chip.get_configuration_write_packets():
+            registers[packet.register_address] = packet.register_data
+        return registers
+
+    def _probe(self, name, length, width):
+        default = getattr(self.chip.config, name)
+        zero = [0]*length if length > 1 else 0
+        setattr(self.chip.config, name, zero)
+        zero_registers = self._registers()
+        element_bits = []
+        for element in range(length):
+            bits = []
+            for bit in range(width):
+                value = list(zero) if length > 1 else 0
+                if length > 1: value[element] = 1 << bit
+                else: value = 1 << bit
+                try:
+                    setattr(self.chip.config, name, value)
+                except ValueError:
+                    break
+                registers = self._registers()
+                changed = np.nonzero(registers != zero_registers)[0]
+                if not len(changed): break
+                addr = int(changed[0])
+                bits.append((addr, int(registers[addr] ^ zero_registers[addr]).bit_length()-1))
+            element_bits.append(bits)
+        setattr(self.chip.config, name, default)
+        return element_bits
+
+    def decode(self, registers, name):
+        values = [sum([((int(registers[addr]) >> bit) & 1) << i for i, (addr, bit) in enumerate(bits)])
+                  for bits in self.bits[name]]
+        return values if len(values) > 1 else values[0]
+
+_register_map = None
+
+def register_map():
+    global _register_map
+    if _register_map is None: _register_map = _RegisterMap()
+    return _register_map
+
+
+class SimulatedChip:
+
+    def __init__(self):
+        self.registers = register_map().default_registers.copy()
+        self._cache = dict()
+
+    def write(self, addr, data):
+        self.registers[addr] = data
+        self._cache = dict()
+
+    def reset(self):
+        self.registers = register_map().default_registers.copy()
+        self._cache = dict()
+
+    def __getattr__(self, name):
+        if name not in register_map().fields: raise AttributeError(name)
+        if name not in self._cache: self._cache[name] = register_map().decode(self.registers, name)
+        return self._cache[name]
+
+
+class SimulatedTile:
+
+    def __init__(self, io_group, tile, sim_config):
+        rng = np.random.default_rng([sim_config['seed'], io_group, tile])
+        self.io_group = io_group
+        self.tile = tile
+        self.arr = graphs.NumberedArrangement()
+        self.movers = [self.arr.left, self.arr.down, self.arr.right, self.arr.up] # miso uart index order
+        tile_name = '{}-{}'.format(io_group, tile)
+        self.broken_links = set([tuple(link) for link in sim_config['broken_links'].get(tile_name, [])])
+        self.dead_chips = set(sim_config['dead_chips'].get(tile_name, []))
+        self.chips = dict([(chip, SimulatedChip()) for chip in self.arr.all_chips() if chip not in self.dead_chips])
+        n_chips = self.arr.nrows*self.arr.ncols
+        self.pedestal = rng.normal(sim_config['pedestal_mean'], sim_config['pedestal_spread'], (n_chips, 64))
+        self.noise = np.abs(rng.normal(sim_config['noise_mean'], sim_config['noise_spread'], (n_chips, 64)))
+        self.hot = rng.random((n_chips, 64)) < sim_config['hot_channel_fraction']
+        self._routes = None
+
+    def _neighbor(self, chip, uart):
+        return self.movers[uart](chip)
+
+    def routes_in(self):
+        ###### {root: {chip: hops}} reached by packets sent from the pacman on each root's io_channel
+        if self._routes is not None: return self._routes
+        self._routes = dict()
+        for root in root_chips:
+            reached = dict()
+            if root in self.chips:
+                reached[root] = 1
+                queue = [root]
+                while queue:
+                    chip = queue.pop(0)
+                    for uart, enabled in enumerate(self.chips[chip].enable_miso_upstream):
+                        next_chip = self._neighbor(chip, uart)
+                        if not enabled or next_chip < 0 or next_chip in reached or next_chip not in self.chips: continue
+                        if (chip, next_chip) in self.broken_links: continue
+                        reached[next_chip] = reached[chip]+1
+                        queue.append(next_chip)
+            self._routes[root] = reached
+        return self._routes
+
+    def route_out(self, chip):
+        ###### (root, hops) where a packet from chip exits to the pacman, or None
+        visited = set([chip])
+        queue = [(chip, 1)]
+        while queue:
+            curr, hops = queue.pop(0)
+            for uart, enabled in enumerate(self.chips[curr].enable_miso_downstream):
+                if not enabled: continue
+                next_chip = self._neighbor(curr, uart)
+                if next_chip < 0 and uart == 0 and curr in root_chips: return curr, hops
+                if next_chip < 0 or next_chip in visited or next_chip not in self.chips: continue
+                if (curr, next_chip) in self.broken_links: continue
+                visited.add(next_chip)
+                queue.append((next_chip, hops+1))
+        return None
+
+    def write(self, chip, addr, data):
+        self.chips[chip].write(addr, data)
+        if addr in register_map().routing_registers: self._routes = None
+
+    def reset(self):
+        for chip in self.chips.values(): chip.reset()
+        self._routes = None
+
+    def channel_index(self, chip):
+        return chip - self.arr.start_index
+
+
+class _RawFileWriter:
+    ###### stands in for PACMAN_IO's raw file queue and worker process: each (msgs, io_groups) put is written at once
+    def __init__(self, io):
+        self.io = io
+
+    def put(self, item, *args, **kwargs):
+        msgs, io_groups = item
+        rhdf5.to_rawfile(filename=self.io.raw_filename, msgs=msgs, msg_headers={'io_groups': io_groups}, io_version=pacman_msg_fmt.latest_version)
+
+
+class SimulatedPACMAN_IO(larpix.io.IO):
+    '''
+    Simulated PACMAN IO, see module docstring
+
+    '''
+    default_raw_filename_fmt = 'sim-raw-%Y_%m_%d_%H_%M_%S_%Z.h5'
+
+    def __init__(self, sim_config=None, **kwargs):
+        super(SimulatedPACMAN_IO, self).__init__()
+        self.sim_config = load_sim_config(sim_config)
+        self.rng = np.random.default_rng(self.sim_config['seed'])
+        self.tiles = dict()
+        self.regs = defaultdict(int)
+        self.uart_clock_ratio = defaultdict(lambda: 2)
+        self.uart_free = defaultdict(float)
+        self.pending = []
+        self.last_generation = None
+        self.last_timestamp = None
+        self.double_send_packets = False
+        self.group_packets_by_io_group = False
+        self.disable_packet_parsing = False
+        self.enable_raw_file_writing = False
+        self.raw_filename = None
+        self._raw_file_queue = _RawFileWriter(self)
+
+    def tile(self, io_group, io_channel):
+        tile = tile_of_io_channel(io_channel)
+        if (io_group, tile) not in self.tiles:
+            self.tiles[(io_group, tile)] = SimulatedTile(io_group, tile, self.sim_config)
+        return self.tiles[(io_group, tile)]
+
+    def packet_time(self, io_group, io_channel):
+        uart_rate = self.sim_config['uart_clock'] / self.uart_clock_ratio[(io_group, io_channel)]
+        return self.sim_config['uart_bits_per_packet'] / uart_rate
+
+    ##### PACMAN register interface
+    def set_reg(self, reg, val, io_group=None):
+        self.regs[(io_group, reg)] = val
+
+    def get_reg(self, reg, io_group=None):
+        offset = (reg - 0x00024001) % 32
+        if 0x00024001 <= reg < 0x00024001 + 8*32 and offset in (0, 1, 16, 17):
+            # nominal tile power: IDDA, VDDA, IDDD, VDDD
+            if offset == 1: return ((1870//4) << 3) << 16
+            if offset == 17: return ((1650//4) << 3) << 16
+            if offset == 0: return (180//5) << 16
+            return (520//5) << 16
+        return self.regs[(io_group, reg)]
+
+    def enable_tile(self, *args, **kwargs): return None, 0b1
+    def set_vddd(self, *args, **kwargs): return None, 0
+    def set_vdda(self, *args, **kwargs): return None, 0
+    def get_vddd(self, *args, **kwargs): return None, (1650, 520)
+    def get_vdda(self, *args, **kwargs): return None, (1870, 180)
+
+    def set_uart_clock_ratio(self, channel, ratio, io_group=None):
+        self.uart_clock_ratio[(io_group, channel)] = ratio
+        return ratio
+
+    def reset_larpix(self, length=hard_reset_length, io_group=None):
+        if length < hard_reset_length: return
+        for (tile_io_group, tile), sim_tile in self.tiles.items():
+            if io_group is None or io_group == tile_io_group: sim_tile.reset()
+
+    ##### larpix IO interface
+    def send(self, packet_list):
+        now = time.time()
+        for packet in packet_list:
+            key = packet.chip_key
+            sim_tile = self.tile(key.io_group, key.io_channel)
+            uart_key = (key.io_group, key.io_channel)
+            n_send = 2 if self.double_send_packets else 1
+            self.uart_free[uart_key] = max(self.uart_free[uart_key], now) + n_send*self.packet_time(*uart_key)
+            uart_counters['packets_sent'] += n_send
+            root = root_chips[(key.io_channel-1) % 4]
+            for _ in range(n_send):
+                for chip, hops in list(sim_tile.routes_in()[root].items()):
+                    if sim_tile.chips[chip].chip_id != key.chip_id: continue
+                    if packet.packet_type == larpix.Packet_v2.CONFIG_WRITE_PACKET:
+                        sim_tile.write(chip, packet.register_address, packet.register_data)
+                    elif packet.packet_type == larpix.Packet_v2.CONFIG_READ_PACKET:
+                        self._reply(sim_tile, chip, hops, packet.register_address, self.uart_free[uart_key])
+
+    def _reply(self, sim_tile, chip, hops_in, register_address, sent_time):
+        route = sim_tile.route_out(chip)
+        if route is None: return
+        root, hops_out = route
+        io_channel = io_channel_of_root(sim_tile.tile, root)
+        chip_id = sim_tile.chips[chip].chip_id
+        packet = larpix.Packet_v2()
+        packet.chip_key = larpix.Key(sim_tile.io_group, io_channel, chip_id)
+        packet.packet_type = larpix.Packet_v2.CONFIG_READ_PACKET
+        packet.chip_id = chip_id
+        packet.register_address = register_address
+        packet.register_data = int(sim_tile.chips[chip].registers[register_address])
+        packet.downstream_marker = 1
+        packet.assign_parity()
+        ready = sent_time + self.sim_config['uart_latency'] + (hops_in + hops_out)*self.packet_time(sim_tile.io_group, io_channel)
+        self.pending.append((ready, packet))
+
+    def start_listening(self):
+        super(SimulatedPACMAN_IO, self).start_listening()
+        self.last_generation = time.time()
+        if self.last_timestamp is None: self.last_timestamp = self.last_generation
+
+    def stop_listening(self):
+        self._generate(time.time())
+        super(SimulatedPACMAN_IO, self).stop_listening()
+
+    def empty_queue(self):
+        now = time.time()
+        if self.is_listening: self._generate(now)
+        ready = [packet for t, packet in self.pending if t <= now]
+        self.pending = [(t, packet) for t, packet in self.pending if t > now]
+        uart_counters['packets_received'] += len(ready)
+        if self.enable_raw_file_writing and self.raw_filename and ready:
+            self._write_raw(ready)
+        if self.disable_packet_parsing: return [], b''
+        return ready, b''
+
+    def join(self): pass
+
+    def cleanup(self): pass
+
+    ##### data generation
+    def _generate(self, now):
+        if self.last_generation is None: return
+        dt = now - self.last_generation
+        self.last_generation = now
+        if dt <= 0: return
+        for sim_tile in self.tiles.values():
+            self._generate_tile(sim_tile, dt, now)
+        io_groups = set([io_group for io_group, tile in self.tiles])
+        while self.last_timestamp + 1 <= now:
+            self.last_timestamp += 1
+            for io_group in io_groups:
+                packet = larpix.TimestampPacket(timestamp=int(self.last_timestamp))
+                packet.io_group = io_group
+                self.pending.append((self.last_timestamp, packet))
+
+    def _generate_tile(self, sim_tile, dt, now):
+        sim_config = self.sim_config
+        vdda = sim_config['vdda']
+        by_io_channel = defaultdict(list)
+        for chip, sim_chip in sim_tile.chips.items():
+            self_trigger = np.array(sim_chip.csa_enable, dtype=bool) & ~np.array(sim_chip.channel_mask, dtype=bool)
+            periodic = np.zeros(64, dtype=bool)
+            if sim_chip.enable_periodic_trigger:
+                periodic = ~np.array(sim_chip.periodic_trigger_mask, dtype=bool)
+            if not (self_trigger.any() or periodic.any()): continue
+            route = sim_tile.route_out(chip)
+            if route is None: continue
+
+            i = sim_tile.channel_index(chip)
+            vref = vdda * sim_chip.vref_dac / 256.
+            vcm = vdda * sim_chip.vcm_dac / 256.
+            mv_per_adc = max(vref - vcm, 1.) / 256.
+            pedestal_mv = vcm + sim_tile.pedestal[i]*mv_per_adc
+            noise_mv = np.maximum(sim_tile.noise[i]*mv_per_adc, 1e-3)
+            threshold_mv = sim_chip.threshold_global*vdda/256. + sim_config['threshold_offset'] \
+                + sim_config['trim_scale']*np.array(sim_chip.pixel_trim_dac)
+            rate = sim_config['noise_rate'] * np.exp(-0.5*np.clip((threshold_mv - pedestal_mv)/noise_mv, 0, None)**2)
+            rate = np.where(sim_tile.hot[i], np.maximum(rate, sim_config['hot_channel_rate']), rate)
+            n_self = self.rng.poisson(np.where(self_trigger, rate, 0.)*dt)
+            n_periodic = np.zeros(64, dtype=int)
+            if periodic.any():
+                periodic_rate = 1. / (max(sim_chip.periodic_trigger_cycles, 1)*1e-7)
+                n_periodic = self.rng.poisson(np.where(periodic, periodic_rate, 0.)*dt)
+            threshold_adc = (threshold_mv - vcm) / mv_per_adc
+            for channel in np.nonzero(n_self + n_periodic)[0]:
+                adc = np.concatenate([
+                    threshold_adc[channel] + np.abs(self.rng.normal(0, sim_tile.noise[i][channel], n_self[channel])),
+                    self.rng.normal(sim_tile.pedestal[i][channel], sim_tile.noise[i][channel], n_periodic[channel])])
+                by_io_channel[route[0]].append((sim_chip.chip_id, int(channel), np.clip(adc, 0, 255).astype(int)))
+
+        for root, hits in by_io_channel.items():
+            io_channel = io_channel_of_root(sim_tile.tile, root)
+            n_total = sum([len(adc) for chip_id, channel, adc in hits])
+            max_packets = int(dt / self.packet_time(sim_tile.io_group, io_channel))
+            keep = 1. if n_total <= max_packets else max_packets / n_total
+            fifo_full = int(keep < 1.)
+            for chip_id, channel, adcs in hits:
+                for adc in adcs:
+                    if keep < 1. and self.rng.random() > keep: continue
+                    packet = larpix.Packet_v2()
+                    packet.chip_key = larpix.Key(sim_tile.io_group, io_channel, chip_id)
+                    packet.packet_type = larpix.Packet_v2.DATA_PACKET
+                    packet.chip_id = chip_id
+                    packet.channel_id = channel
+                    packet.dataword = int(adc)
+                    packet.timestamp = int(self.rng.integers(0, 2**31))
+                    packet.shared_fifo_full = fifo_full
+                    packet.downstream_marker = 1
+                    packet.assign_parity()
+                    self.pending.append((now, packet))
+
+    def _write_raw(self, packets):
+        msgs, io_groups = [], []
+        for io_group in sorted(set([packet.io_group for packet in packets])):
+            io_group_packets = [packet for packet in packets if packet.io_group == io_group]
+            # the message header holds a 16-bit word count
+            for i in range(0, len(io_group_packets), max_msg_words):
+                msgs.append(pacman_msg_fmt.format(io_group_packets[i:i+max_msg_words], msg_type='DATA'))
+                io_groups.append(io_group)
+        self._raw_file_queue.put((msgs, io_groups))
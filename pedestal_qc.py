@@ -3,6 +3,8 @@ import larpix.io
 import larpix.logger
 import base
 import base___no_enforce
+import packet_analysis
+import latency
 
 import argparse
 import json
@@ -23,6 +25,7 @@ _default_no_apply_baseline_cut=False
 _default_noise_cut_value=10.
 _default_no_apply_noise_cut=False
 _default_no_refinement=False
+_default_simulate=None
 
 def configure_pedestal(c, periodic_trigger_cycles, disabled_channels):
     c.io.group_packets_by_io_group = True
@@ -53,7 +56,7 @@ def configure_pedestal(c, periodic_trigger_cycles, disabled_channels):
     #base___no_enforce.flush_data(c)
 
     print('enforcing correct configuration...')
-    ok,diff = c.enforce_configuration(list(c.chips.keys()), timeout=0.01, connection_delay=0.01, n=3, n_verify=3)
+    ok,diff = c.enforce_configuration(list(c.chips.keys()), connection_delay=0.01, **latency.configuration_kwargs(c, c.chips.keys(), timeout=0.01, n=3, n_verify=3))
     if not ok:
         if any([reg not in range(66,74) and (not key.chip_id==12) for key, regs in diff.items() for reg in regs]):
             raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
@@ -77,7 +80,7 @@ def configure_pedestal(c, periodic_trigger_cycles, disabled_channels):
     #base___no_enforce.flush_data(c)
 
     print('enforcing correct configuration...')
-    ok,diff = c.enforce_configuration(list(c.chips.keys()), timeout=0.01, connection_delay=0.01, n=3, n_verify=3)
+    ok,diff = c.enforce_configuration(list(c.chips.keys()), connection_delay=0.01, **latency.configuration_kwargs(c, c.chips.keys(), timeout=0.01, n=3, n_verify=3))
     if not ok:
         if any([not key.chip_id==12 for key, regs in diff.items()]):
             raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
@@ -127,32 +130,17 @@ def run_pedestal(c, runtime):
 def evaluate_pedestal(datalog_file, disabled_channels, baseline_cut_value, no_apply_baseline_cut, noise_cut_value, no_apply_noise_cut):
     
     n_bad_channels=0
-    f = h5py.File(datalog_file,'r')
-    unixtime = f['packets']['timestamp'][f['packets']['packet_type'] == 4]
-    livetime = np.max(unixtime) - np.min(unixtime)
-    
-    data_mask=f['packets'][:]['packet_type']==0
-    valid_parity_mask=f['packets'][data_mask]['valid_parity']==1
-    data=(f['packets'][data_mask])[valid_parity_mask]
-
-    io_group=data['io_group'].astype(np.uint64)
-    io_channel=data['io_channel'].astype(np.uint64)
-    chip_id=data['chip_id'].astype(np.uint64)
-    channel_id=data['channel_id'].astype(np.uint64)
-    unique_channels = set(unique_channel_id(io_group, io_channel, chip_id, channel_id))
+    stats, livetime = packet_analysis.read_channel_statistics(datalog_file)
 
     record = defaultdict(list)
-    for unique in sorted(unique_channels):
+    for i, unique in enumerate(stats['unique']):
         flag=False
-        channel_mask = unique_channel_id(io_group, io_channel, chip_id, channel_id) == unique
-        adc = data[channel_mask]['dataword']
-        if len(adc)<2: continue
+        if stats['count'][i]<2: continue
         if no_apply_baseline_cut==False:
-            if np.mean(adc)>=baseline_cut_value: flag=True
+            if stats['mean'][i]>=baseline_cut_value: flag=True
         if no_apply_noise_cut==False:
-            if np.std(adc)>=noise_cut_value or np.std(adc)==0: flag=True
-        rate = len(adc)/ (livetime + 1e-9)
-        if rate>3: flag=True
+            if stats['std'][i]>=noise_cut_value or stats['std'][i]==0: flag=True
+        if stats['rate'][i]>3: flag=True
         if flag==True:
             n_bad_channels+=1
             _chip_key_ = from_unique_to_chip_key(unique)
@@ -185,7 +173,8 @@ def main(controller_config=_default_controller_config,
          no_apply_baseline_cut=_default_no_apply_baseline_cut,
          noise_cut_value=_default_noise_cut_value,
          no_apply_noise_cut=_default_no_apply_noise_cut,
-         no_refinement=_default_no_refinement):
+         no_refinement=_default_no_refinement,
+         simulate=_default_simulate):
 
     if no_refinement==False:
         if no_log_simple==False and no_apply_baseline_cut==True and apply_noise_cut==False:
@@ -214,7 +203,7 @@ def main(controller_config=_default_controller_config,
     ped_fname= ped_fname+".h5"
     print('initial disabled list: ',disabled_channels)
 
-    c = base.main(controller_config=controller_config, logger=True, filename=ped_fname)
+    c = base.main(controller_config=controller_config, logger=True, filename=ped_fname, simulate=simulate)
     #c = base___no_enforce.main(controller_config=controller_config, logger=True, filename=ped_fname)
     configure_pedestal(c, periodic_trigger_cycles, disabled_channels)
     print('Wait 3 seconds for cooling the ASICs...'); time.sleep(3)
@@ -232,7 +221,7 @@ def main(controller_config=_default_controller_config,
 
     if no_refinement==False:
         ped_fname="recursive_pedestal_%s.h5" % revised_bad_channel_filename
-        c = base.main(controller_config=controller_config, logger=True, filename=ped_fname)
+        c = base.main(controller_config=controller_config, logger=True, filename=ped_fname, simulate=simulate)
         #c = base___no_enforce.main(controller_config=controller_config, logger=True, filename=ped_fname)
         configure_pedestal(c, periodic_trigger_cycles, revised_disabled_channels)
         print('Wait 3 seconds for cooling the ASICs...'); time.sleep(3)
@@ -261,6 +250,8 @@ if __name__ == '__main__':
     parser.add_argument('--no_apply_noise_cut', default=_default_no_apply_noise_cut, action='store_true', help='''If flag present, disable pedestal standard deviation cut value applied''')
     parser.add_argument('--no_refinement', default=_default_no_refinement, action='store_true', help='''If flag present, pedestal is not run recursively to measure pedestal with bad channels removed''')
 
+    parser.add_argument('--simulate', default=_default_simulate, nargs='?', const='', type=str, help='''Use the hardware-free PACMAN simulator, optionally with a JSON sim config file''')
+
     args = parser.parse_args()
     c = main(**vars(args))
 
@@ -6,6 +6,10 @@ import numpy as np
 import json
 import glob
 import argparse
+import multiprocessing
+
+import packet_analysis
+import geometry
 
 _default_anode=False
 _default_histo=False
@@ -23,6 +27,8 @@ _default_adc_std=False
 _default_channel_id_packet_rate=False
 _default_io_channel_packet_rate=False
 _default_tile_packet_rate=False
+_default_batch=False
+_default_jobs=1
 
 nonrouted_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
 routed_channels=[i for i in range(64) if i not in nonrouted_channels]
@@ -51,10 +57,32 @@ def io_channel_to_tile_number(io_channel):
             return tile_number
     return -1
 
-def parse_asic_config(asic_config_dir, geometry_dict, cryo=True, vdda=1770):
-    offset=210; scale=1.45
-    if cryo: offset=465; scale=2.34
-    d = dict()
+def metric_table(unique, **columns):
+    '''
+    Columnar per-channel table: a structured array with unique, io_group and
+    one float column per metric (x, y included)
+
+    '''
+    unique = np.asarray(unique, dtype=np.int64)
+    table = np.zeros(len(unique), dtype=[('unique', np.int64), ('io_group', np.int64)] + [(name, np.float64) for name in columns])
+    table['unique'] = unique
+    table['io_group'] = unique_2_io_group(unique)
+    for name, values in columns.items(): table[name] = values
+    return table
+
+
+
+def asic_config_registers(asic_config_dir):
+    ###### (io_group, io_channel, chip_id, global threshold, pixel trim DACs, channel mask) per chip,
+    ###### from a directory of per-chip JSON configs or a config_store .npz snapshot
+    if asic_config_dir.endswith('.npz'):
+        import config_store # needs larpix to decode the registers
+        snapshot = config_store.read_snapshot(asic_config_dir)
+        for chip_key, registers in zip(snapshot.chip_keys, snapshot.registers):
+            io_group, io_channel, chip_id = [int(field) for field in chip_key.split('-')]
+            values = config_store.register_values(registers)
+            yield io_group, io_channel, chip_id, values['threshold_global'], np.array(values['pixel_trim_dac']), np.array(values['channel_mask'])
+        return
     for filename in glob.glob(asic_config_dir+'/*.json'):
         with open(filename,'r') as f:
             unique_name = filename.split("-")
@@ -68,95 +96,70 @@ def parse_asic_config(asic_config_dir, geometry_dict, cryo=True, vdda=1770):
                 io_channel = int(unique_name[-4])
                 chip_id = int(unique_name[-3])   
             config_data = json.load(f)
-            tile_number = io_channel_to_tile_number(io_channel)
-            gt = config_data['register_values']['threshold_global']
-            ptd = config_data['register_values']['pixel_trim_dac']
-            cm = config_data['register_values']['channel_mask']
-            if cm == [1]*64: print('ATTENTION all channels on ',io_group,'-',io_channel,'-',chip_id,'\t are disabled')
-            for i in routed_channels:
-                u = unique_channel_id_from_identifiers(io_group, io_channel, chip_id, i)
-                if str(u) not in geometry_dict: 
-                    flag = True
-                    #print(tile_number)
-                    #print(tile_number_to_io_channels(tile_number))
-                    for tile_io_channel in tile_number_to_io_channels(tile_number):
-                        if str(unique_channel_id_from_identifiers(io_group, tile_io_channel, chip_id, i)) in geometry_dict:
-                            u = unique_channel_id_from_identifiers(io_group, tile_io_channel, chip_id, i)
-                if not str(u) in geometry_dict:
-                    continue
-                d[u] = dict(
-                    threshold = ((gt*vdda)/256.) + offset + scale*ptd[i],
-                    global_dac = gt,
-                    pixel_trim_dac = ptd[i],
-                    channel_mask = cm[i],
-                    x = geometry_dict[str(u)][0],
-                    y = geometry_dict[str(u)][1]                    
-                    )   
-    return d            
-
-
-
-def parse_packets(datalog_file, geometry_dict, max_index=500000):
-    d = dict()
-    f = h5py.File(datalog_file,'r')
-    print(len(f['packets']),' packets')
-    if len(f['packets'])<max_index: max_index=len(f['packets'])
-    unixtime = f['packets'][:]['timestamp'][0:max_index][f['packets'][:]['packet_type'][0:max_index]==4]
-    livetime = np.max(unixtime) - np.min(unixtime)
-    data_mask=f['packets'][:]['packet_type'][0:max_index]==0
-    valid_parity_mask=f['packets'][:]['valid_parity'][0:max_index]==1
-
-    tile_rate, ioc_rate = [{} for i in range(2)]
-    for iog in range(1,3):
-        for ioc in range(1,33):
-            io_group_mask=f['packets'][:]['io_group'][0:max_index]==iog
-            io_channel_mask=f['packets'][:]['io_channel'][0:max_index]==ioc
-            m = np.logical_and(io_group_mask, np.logical_and(io_channel_mask, np.logical_and(data_mask, valid_parity_mask)))
-            adc = f['packets']['dataword'][0:max_index][m]
-            ioc_rate[(iog,ioc)]= len(adc)
-            tile = int((ioc-1)/4)+1
-            if (iog,tile) not in tile_rate: tile_rate[(iog,tile)]=len(adc)
-            else: tile_rate[(iog,tile)]+=len(adc)
-
-    mask = np.logical_and(data_mask, valid_parity_mask)
-    adc = f['packets']['dataword'][0:max_index][mask]
-    unique_id = unique_channel_id(f['packets'][0:max_index][mask])
-    unique_id_set = np.unique(unique_id)
-    for i in unique_id_set:
-        geo_i = str(i) 
-        if str(i) not in geometry_dict:
-            io_ch = unique_2_io_channel(i)
-            io_gr = unique_2_io_group(i)
-            chan_id = unique_2_channel_id(i)
-            ch_id = unique_2_chip_id(i)
-            tile_number = io_channel_to_tile_number(io_ch)
-            for tile_io_channel in tile_number_to_io_channels(tile_number):
-                if str(unique_channel_id_from_identifiers(io_gr, tile_io_channel, ch_id, chan_id)) in geometry_dict:
-                    geo_i = str(unique_channel_id_from_identifiers(io_gr, tile_io_channel, ch_id, chan_id))
-        if not (geo_i in geometry_dict):
-            continue
-
-        id_mask = unique_id == i
-        masked_adc = adc[id_mask]
-        tile = int((unique_2_io_channel(i)-1)/4)+1
-        d[i] = dict(
-            mean = np.mean(masked_adc),
-            std = np.std(masked_adc),
-            rate = len(masked_adc) / (livetime + 1e-9),
-            iochannel_rate = ioc_rate[(unique_2_io_group(i), unique_2_io_channel(i))] / (livetime + 1e-9),
-            tile_rate = tile_rate[(unique_2_io_group(i),tile)] / (livetime + 1e-9),
-            x = geometry_dict[geo_i][0],
-            y = geometry_dict[geo_i][1]
-            )
-    return d
+        yield (io_group, io_channel, chip_id, config_data['register_values']['threshold_global'],
+               np.array(config_data['register_values']['pixel_trim_dac']), np.array(config_data['register_values']['channel_mask']))
+
+
+
+def parse_asic_config(asic_config_dir, geo, cryo=True, vdda=1770):
+    offset=210; scale=1.45
+    if cryo: offset=465; scale=2.34
+    columns = dict(unique=[], threshold=[], global_dac=[], pixel_trim_dac=[], channel_mask=[], x=[], y=[])
+    for io_group, io_channel, chip_id, gt, ptd, cm in asic_config_registers(asic_config_dir):
+        if all(cm == 1): print('ATTENTION all channels on ',io_group,'-',io_channel,'-',chip_id,'\t are disabled')
+        ###### channels missing from the layout are found on the other io_channels of the tile
+        index, found = geo.index([unique_channel_id_from_identifiers(io_group, io_channel, chip_id, i) for i in routed_channels])
+        channels, index = np.array(routed_channels)[found], index[found]
+        columns['unique'].append(geo.unique[index])
+        columns['threshold'].append(((gt*vdda)/256.) + offset + scale*ptd[channels])
+        columns['global_dac'].append(np.full(len(channels), gt))
+        columns['pixel_trim_dac'].append(ptd[channels])
+        columns['channel_mask'].append(cm[channels])
+        columns['x'].append(geo.positions[index,0])
+        columns['y'].append(geo.positions[index,1])
+    columns = dict([(name, np.concatenate(values) if values else np.zeros(0)) for name, values in columns.items()])
+    ###### a channel configured twice keeps its last configuration
+    unique = columns.pop('unique').astype(np.int64)
+    _, last = np.unique(unique[::-1], return_index=True)
+    keep = len(unique) - 1 - last
+    return metric_table(unique[keep], **dict([(name, values[keep]) for name, values in columns.items()]))
+
+
+
+def group_totals(group, values):
+    ###### sum of values over each group, returned per element (one unique + bincount pass)
+    if len(group) == 0: return np.zeros(0)
+    _, inverse = np.unique(group, return_inverse=True)
+    return np.bincount(inverse, weights=values)[inverse]
+
+
+
+def parse_packets(datalog_file, geo, max_index=None):
+    with h5py.File(datalog_file,'r') as f: print(len(f['packets']),' packets')
+    stats, livetime = packet_analysis.read_channel_statistics(datalog_file, unique_id_function=unique_channel_id, max_packets=max_index)
+
+    unique = stats['unique']
+    io_group, io_channel = unique_2_io_group(unique), unique_2_io_channel(unique)
+    tile = ((io_channel-1)/4).astype(int)+1
+    ioc_rate = group_totals(io_group*256 + io_channel, stats['count']) / (livetime + 1e-9)
+    tile_rate = group_totals(io_group*256 + tile, stats['count']) / (livetime + 1e-9)
+
+    xs, ys, found = geo.xy(unique)
+    return metric_table(unique[found],
+                        mean = stats['mean'][found],
+                        std = stats['std'][found],
+                        rate = stats['rate'][found],
+                        iochannel_rate = ioc_rate[found],
+                        tile_rate = tile_rate[found],
+                        x = xs[found],
+                        y = ys[found])
 
 
 
 ### to extract single channel (X,Y) position: X == d[str(unique_channel_id)][0]; Y == d[str(unique_channel_id)][1]
-def load_geometry(g):
-    geom_dict = None
-    with open(g,'r') as f: geom_dict = json.load(f)
-    return geom_dict
+### (or, for arrays of unique channel ids, x, y, found = d.xy(unique_ids))
+def load_geometry(g, cache=True):
+    return geometry.load(g, cache=cache)
 
 
 
@@ -173,65 +176,83 @@ def get_z_range(metric_string):
 
 
     
-def plot_anode(metric_dict, metric_string, unit):
+def plot_anode(table, metric_string, unit, filename='anode.png'):
     zrange = get_z_range(metric_string); print(zrange)
     fig, ax = plt.subplots(1, 2, num=metric_string, figsize=(16,15))
-    if metric_string=='threshold' or metric_string=='global_dac' or metric_string=='rate':
-        c0 = fig.colorbar(ax[0].scatter([metric_dict[key]['x'] for key in metric_dict.keys() if unique_2_io_group(int(key))==1],
-                                        [metric_dict[key]['y'] for key in metric_dict.keys() if unique_2_io_group(int(key))==1],
-                                        c=[metric_dict[key][metric_string] for key in metric_dict.keys() if unique_2_io_group(int(key))==1],
-                                        marker='s',s=1.5,vmin=zrange[0],vmax=zrange[1]), ax = ax[0])
-        c1 = fig.colorbar(ax[1].scatter([metric_dict[key]['x'] for key in metric_dict.keys() if unique_2_io_group(int(key))==2],
-                                        [metric_dict[key]['y'] for key in metric_dict.keys() if unique_2_io_group(int(key))==2],
-                                        c=[metric_dict[key][metric_string] for key in metric_dict.keys() if unique_2_io_group(int(key))==2],
-                                        marker='s',s=1.5,vmin=zrange[0],vmax=zrange[1]), ax = ax[1])
-    else:
-        c0 = fig.colorbar(ax[0].scatter([metric_dict[key]['x'] for key in metric_dict.keys() if unique_2_io_group(int(key))==1],
-                                    [metric_dict[key]['y'] for key in metric_dict.keys() if unique_2_io_group(int(key))==1],
-                                    c=[metric_dict[key][metric_string] for key in metric_dict.keys() if unique_2_io_group(int(key))==1],
-                                    marker='s',s=1.5), ax = ax[0])
-        c1 = fig.colorbar(ax[1].scatter([metric_dict[key]['x'] for key in metric_dict.keys() if unique_2_io_group(int(key))==2],
-                                        [metric_dict[key]['y'] for key in metric_dict.keys() if unique_2_io_group(int(key))==2],
-                                        c=[metric_dict[key][metric_string] for key in metric_dict.keys() if unique_2_io_group(int(key))==2],
-                                        marker='s',s=1.5), ax = ax[1])
+    z_limits = dict()
+    if metric_string=='threshold' or metric_string=='global_dac' or metric_string=='rate': z_limits = dict(vmin=zrange[0], vmax=zrange[1])
+    colorbars = []
     for i in range(2):
+        anode = table[table['io_group']==i+1]
+        colorbars.append(fig.colorbar(ax[i].scatter(anode['x'], anode['y'], c=anode[metric_string], marker='s', s=1.5, **z_limits), ax = ax[i]))
         ax[i].set_xlabel('X [mm]')
         ax[i].set_ylabel('Y [mm]')
         ax[i].set_title('Anode '+str(i+1))
-    c0.set_label(unit); c1.set_label(unit)
+        colorbars[i].set_label(unit)
 
     plt.suptitle(metric_string)
     #plt.tight_layout()
 #    plt.show()
-    plt.savefig('anode'+'.png')
+    plt.savefig(filename)
 
 
 
-def plot_1d_histo(metric_dict, metric_string, unit):
+def plot_1d_histo(table, metric_string, unit, filename=None):
     zrange = get_z_range(metric_string); print(zrange)
     fig, ax = plt.subplots(num=metric_string, figsize=(8,6))
     nbins = np.linspace(zrange[0], zrange[1], (zrange[1]-zrange[0])+1)
     if metric_string=='std' or metric_string=='rate' or metric_string=='global_dac': nbins = np.linspace(zrange[0], zrange[1], (zrange[1]-zrange[0])*4+1)
     if metric_string=='threshold': nbins = np.linspace(zrange[0], zrange[1], int((zrange[1]-zrange[0])/4))
-    ax.hist([metric_dict[key][metric_string] for key in metric_dict.keys() if unique_2_io_group(int(key))==1],
-            bins=nbins, alpha=0.5, label='Anode 1')
-    ax.hist([metric_dict[key][metric_string] for key in metric_dict.keys() if unique_2_io_group(int(key))==2],
-            bins=nbins, alpha=0.5, label='Anode 2')
+    for i in range(2):
+        ax.hist(table[metric_string][table['io_group']==i+1], bins=nbins, alpha=0.5, label='Anode '+str(i+1))
     ax.set_xlabel(unit)
     ax.set_ylabel('Channel Count')
     ax.legend()
     ax.grid(True)
     plt.suptitle(metric_string)
     #plt.tight_layout()
-    plt.show()
-    #plt.savefig(plot_title+'.png')
+    if filename is None: plt.show()
+    else: plt.savefig(filename)
 
 
-    
-def find_noisy(metric_dict, metric_string, cut):
-    for key in metric_dict.keys():
-        i = metric_dict[key][metric_string]
-        if i>cut: print(unique_2_chip_key_string(key),'-',unique_2_channel_id(key),'\t ',metric_string,' \t value: ',i, '\t (cut ',cut,')')
+
+def find_noisy(table, metric_string, cut):
+    for row in table[table[metric_string]>cut]:
+        key, i = int(row['unique']), row[metric_string]
+        print(unique_2_chip_key_string(key),'-',unique_2_channel_id(key),'\t ',metric_string,' \t value: ',i, '\t (cut ',cut,')')
+
+
+
+def _render_png(job):
+    ###### one headless figure per job, so jobs can run in worker processes
+    plt.switch_backend('Agg')
+    kind, table, metric_string, unit = job
+    filename = kind+'-'+metric_string+'.png'
+    if kind=='anode': plot_anode(table, metric_string, unit, filename)
+    else: plot_1d_histo(table, metric_string, unit, filename)
+    plt.close('all')
+    return filename
+
+
+
+def render(plots, anode, histo, batch=_default_batch, jobs=_default_jobs):
+    '''
+    Draws (table, metric, unit) plots; in batch mode every plot is written
+    headless to <anode|histo>-<metric>.png, over jobs worker processes
+
+    '''
+    if not batch:
+        for table, metric_string, unit in plots:
+            if anode: plot_anode(table, metric_string, unit)
+            if histo: plot_1d_histo(table, metric_string, unit)
+        return
+    kinds = [kind for kind, requested in [('anode', anode), ('histo', histo)] if requested]
+    batch_jobs = [(kind, table, metric_string, unit) for table, metric_string, unit in plots for kind in kinds]
+    if jobs > 1 and len(batch_jobs) > 1:
+        with multiprocessing.Pool(min(jobs, len(batch_jobs))) as pool: filenames = pool.map(_render_png, batch_jobs)
+    else:
+        filenames = [_render_png(job) for job in batch_jobs]
+    print('wrote', ' '.join(filenames))
 
         
     
@@ -249,47 +270,33 @@ def main(anode=_default_anode,
          channel_id_packet_rate=_default_channel_id_packet_rate,
          io_channel_packet_rate=_default_io_channel_packet_rate,
          tile_packet_rate=_default_tile_packet_rate,
+         batch=_default_batch,
+         jobs=_default_jobs,
          **kwargs):
     
     if geometry_file==None: print('Geometry file absent. Exiting early'); return
-    geometry_dict = load_geometry(geometry_file)
+    geo = load_geometry(geometry_file)
     
     if threshold or pixel_trim_dac or global_threshold_dac or channel_mask:
         if asic_config_dir==None: print('ASIC config directory absent. Exiting early'); return
-        d = parse_asic_config(asic_config_dir, geometry_dict)
-        if threshold:
-            if anode: plot_anode(d, 'threshold', 'mV')
-            if histo: plot_1d_histo(d, 'threshold', 'mV')
-        if pixel_trim_dac:
-            if anode: plot_anode(d, 'pixel_trim_dac', 'DAC')
-            if histo: plot_1d_histo(d, 'pixel_trim_dac', 'DAC')
-        if global_threshold_dac:
-            if anode: plot_anode(d, 'global_dac', 'DAC')
-            if histo: plot_1d_histo(d, 'global_dac', 'DAC')
-        if channel_mask:
-            if anode: plot_anode(d, 'channel_mask', 'Boolean')
-            if histo: plot_1d_histo(d, 'channel_mask', 'Boolean')
+        d = parse_asic_config(asic_config_dir, geo)
+        render([(d, metric_string, unit) for requested, metric_string, unit in [
+            (threshold, 'threshold', 'mV'),
+            (pixel_trim_dac, 'pixel_trim_dac', 'DAC'),
+            (global_threshold_dac, 'global_dac', 'DAC'),
+            (channel_mask, 'channel_mask', 'Boolean')] if requested], anode, histo, batch, jobs)
         
     if adc_mean or adc_std or channel_id_packet_rate or io_channel_packet_rate or tile_packet_rate:
         if datalog_file==None: print('Datalog file absent. Exiting early'); return
-        d = parse_packets(datalog_file, geometry_dict)
-        if adc_mean:
-            if anode: plot_anode(d, 'mean', 'ADC')
-            if histo: plot_1d_histo(d, 'mean', 'ADC')
-        if adc_std:
-            if anode: plot_anode(d, 'std', 'ADC')
-            if histo: plot_1d_histo(d, 'std', 'ADC')
-            #find_noisy(d, 'std', 10)
-        if channel_id_packet_rate:
-            if anode: plot_anode(d, 'rate', 'Hz')
-            if histo: plot_1d_histo(d, 'rate', 'Hz')
-            #find_noisy(d, 'rate', 100)
-        if io_channel_packet_rate:
-            if anode: plot_anode(d, 'iochannel_rate', 'Hz')
-            if histo: plot_1d_histo(d, 'iochannel_rate', 'Hz')
-        if tile_packet_rate:
-            if anode: plot_anode(d, 'tile_rate', 'Hz')
-            if histo: plot_1d_histo(d, 'tile_rate', 'Hz')
+        d = parse_packets(datalog_file, geo)
+        render([(d, metric_string, unit) for requested, metric_string, unit in [
+            (adc_mean, 'mean', 'ADC'),
+            (adc_std, 'std', 'ADC'),
+            (channel_id_packet_rate, 'rate', 'Hz'),
+            (io_channel_packet_rate, 'iochannel_rate', 'Hz'),
+            (tile_packet_rate, 'tile_rate', 'Hz')] if requested], anode, histo, batch, jobs)
+        #find_noisy(d, 'std', 10)
+        #find_noisy(d, 'rate', 100)
 
     return
 
@@ -300,7 +307,7 @@ if __name__ == '__main__':
     parser.add_argument('--anode', default=_default_anode, action='store_true', help='''Plot anode''')
     parser.add_argument('--histo', default=_default_histo, action='store_true', help='''Plot 1D histogram''')
     # input file paths
-    parser.add_argument('--asic_config_dir', default=_default_asic_config_dir, type=str, help='''Path to ASIC config directory''')
+    parser.add_argument('--asic_config_dir', default=_default_asic_config_dir, type=str, help='''Path to ASIC config directory or .npz configuration snapshot''')
     parser.add_argument('--datalog_file', default=_default_datalog_file, type=str, help='''Path to datalog file''')
     parser.add_argument('--geometry_file', default=_default_geometry_file, type=str, help='''Path to geometry file''')
     # the following require ASIC configuraton file
@@ -314,5 +321,8 @@ if __name__ == '__main__':
     parser.add_argument('--channel_id_packet_rate', default=_default_channel_id_packet_rate, action='store_true', help='''Plot channel ID packet rate from datalog.hdf5 file ''') 
     parser.add_argument('--io_channel_packet_rate', default=_default_io_channel_packet_rate, action='store_true', help='''Plot IO channel packet rate from datalog.hdf5 file ''')
     parser.add_argument('--tile_packet_rate', default=_default_tile_packet_rate, action='store_true', help='''Plot tile packet rate from datalog.hdf5 file ''')
+    # batch report
+    parser.add_argument('--batch', default=_default_batch, action='store_true', help='''Write every requested plot headless to <anode|histo>-<metric>.png instead of showing it''')
+    parser.add_argument('--jobs', default=_default_jobs, type=int, help='''Worker processes for --batch''')
     args = parser.parse_args()
     main(**vars(args))
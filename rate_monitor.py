@@ -0,0 +1,89 @@
+'''
+Live message rates from the IO layer, without reading the raw file
+
+With raw file writing on, PACMAN_IO.empty_queue hands every batch of PACMAN
+messages (and their io_groups) to the raw file writer through
+io._raw_file_queue.put. RateMonitor counts them there, in the reading
+process: PACMAN messages per io_group, as rhdf5.len_rawfile counts them, and
+LArPix data words per (io_group, io_channel), read from byte 1 of each data
+word. The growing raw file is never reopened, and the counts are current
+up to the last empty_queue rather than to the writer's last flush.
+
+Usage:
+    monitor = rate_monitor.attach(c.io)
+    ...
+    dt, messages, words = monitor.rates() # since the previous call
+
+'''
+import time
+from collections import Counter
+
+import numpy as np
+
+import larpix.format.pacman_msg_format as pacman_msg_fmt
+
+_n_io_channels=256
+
+class RateMonitor:
+
+    def __init__(self):
+        self.messages = Counter() # io_group: PACMAN messages
+        self.words = dict() # io_group: data words per io_channel
+        self.last_messages = Counter()
+        self.last_words = dict()
+        self.last_time = time.time()
+
+    def count(self, msgs, io_groups):
+        for msg, io_group in zip(msgs, io_groups):
+            self.messages[io_group] += 1
+            if msg[:1] != pacman_msg_fmt.MSG_TYPE_DATA: continue
+            words = np.frombuffer(msg, dtype=np.uint8, offset=pacman_msg_fmt.HEADER_LEN).reshape(-1, pacman_msg_fmt.WORD_LEN)
+            io_channels = words[words[:,0] == ord(pacman_msg_fmt.WORD_TYPE_DATA), 1]
+            if io_group not in self.words: self.words[io_group] = np.zeros(_n_io_channels, dtype=np.int64)
+            self.words[io_group] += np.bincount(io_channels, minlength=_n_io_channels)
+
+    def total(self):
+        return sum(self.messages.values())
+
+    def rates(self):
+        '''
+        Returns (seconds, {io_group: messages/s}, {(io_group, io_channel):
+        data words/s}) since the previous call, io_channels without data left out
+
+        '''
+        now = time.time()
+        dt = max(now - self.last_time, 1e-9)
+        messages = dict([(io_group, (n - self.last_messages[io_group])/dt) for io_group, n in self.messages.items()])
+        words = dict()
+        for io_group, counts in self.words.items():
+            delta = counts - self.last_words.get(io_group, 0)
+            for io_channel in np.flatnonzero(delta):
+                words[(io_group, int(io_channel))] = delta[io_channel]/dt
+        self.last_messages = Counter(self.messages)
+        self.last_words = dict([(io_group, counts.copy()) for io_group, counts in self.words.items()])
+        self.last_time = now
+        return dt, messages, words
+
+
+def attach(io):
+    '''
+    Counts the messages io hands to its raw file writer; returns the io's
+    RateMonitor (the same one if already attached)
+
+    '''
+    if getattr(io, 'rate_monitor', None) is not None: return io.rate_monitor
+    monitor = RateMonitor()
+    queue = io._raw_file_queue
+    put = queue.put
+
+    def counted_put(item, *args, **kwargs):
+        monitor.count(*item)
+        return put(item, *args, **kwargs)
+
+    queue.put = counted_put
+    io.rate_monitor = monitor
+    return monitor
+
+
+def format_rates(words):
+    return ' '.join(['{}-{}: {:0.1f}Hz'.format(io_group, io_channel, rate) for (io_group, io_channel), rate in sorted(words.items())])
@@ -12,6 +12,8 @@ import larpix.format.rawhdf5format as rhdf5
 import larpix.format.pacman_msg_format as pacman_msg_fmt
 
 import base
+import instrumentation
+import rate_monitor
 #import load_config
 import enforce_loaded_config
 
@@ -26,6 +28,9 @@ _default_controller_config=None
 _default_runtime=10*60 # 10-min run files
 _default_outdir='./'
 _default_disabled_channels=None
+_default_simulate=None
+_default_trace=None
+_default_channel_rates=False
 
 def power_registers():
     adcs=['VDDA', 'IDDA', 'VDDD', 'IDDD']
@@ -42,20 +47,20 @@ def power_registers():
         data[i] = l
     return data
 
-def main(config_name=_default_config_name, controller_config=_default_controller_config, runtime=_default_runtime, outdir=_default_outdir, disabled_channels=_default_disabled_channels):
+def main(config_name=_default_config_name, controller_config=_default_controller_config, runtime=_default_runtime, outdir=_default_outdir, disabled_channels=_default_disabled_channels, simulate=_default_simulate, trace=_default_trace, channel_rates=_default_channel_rates):
     print('START RUN')
-    startTime = time.time()
+    if trace: instrumentation.open_trace(trace)
     # create controller
     c = None
-    if config_name is None:
-        c = base.main(controller_config)
-    else:
-        if controller_config is None:
-            c = enforce_loaded_config.main(config_name, logger=False, disabled_channels=disabled_channels)
+    with instrumentation.stage('load & enforce configuration'):
+        if config_name is None:
+            c = base.main(controller_config, simulate=simulate)
         else:
-            c = enforce_loaded_config.main(config_name, controller_config, logger=False, disabled_channels=disabled_channels)
-
-    print(time.time()-startTime,' seconds to load & enforce configuration')
+            if controller_config is None:
+                c = enforce_loaded_config.main(config_name, logger=False, disabled_channels=disabled_channels, simulate=simulate)
+            else:
+                c = enforce_loaded_config.main(config_name, controller_config, logger=False, disabled_channels=disabled_channels, simulate=simulate)
+    print('transactions:',instrumentation.summary())
             
     trigger_forward_enable=False
     if trigger_forward_enable:
@@ -73,9 +78,9 @@ def main(config_name=_default_config_name, controller_config=_default_controller
     time.sleep(3)
 
     c.io.disable_packet_parsing = True
+    ###### message counts taken as empty_queue hands messages to the raw file writer, not from the file
+    monitor = rate_monitor.attach(c.io)
     while True:
-        counter = 0
-        last_count = 0
         c.io.enable_raw_file_writing = True
         c.io.raw_filename = time.strftime(c.io.default_raw_filename_fmt)
         c.io.join()
@@ -84,20 +89,21 @@ def main(config_name=_default_config_name, controller_config=_default_controller
 
         c.start_listening()
         start_time = time.time()
-        last_time = start_time
+        first_count = monitor.total()
+        monitor.rates()
         while True:
             c.read()
             now = time.time()
             if now > start_time + runtime: break
-            if now > last_time + 5 and c.io.raw_filename and os.path.isfile(c.io.raw_filename):
-                counter = rhdf5.len_rawfile(c.io.raw_filename, attempts=0)
-                print(' average message rate [delta_t = {:0.2f} s]: {:0.2f} ({:0.02f}Hz)\r'.format(now-last_time,counter-last_count,(counter-last_count)/(now-last_time+1e-9)),end='')
-                last_count = counter
-                last_time = now
+            if now > monitor.last_time + 5:
+                dt, messages, words = monitor.rates()
+                print(' average message rate [delta_t = {:0.2f} s]: {:0.2f} ({:0.02f}Hz)\r'.format(dt,sum(messages.values())*dt,sum(messages.values())),end='')
+                if channel_rates: print('\n data word rate per io_group-io_channel:',rate_monitor.format_rates(words))
  
         c.stop_listening()
         c.read()
         c.io.join()
+        print('\n',monitor.total()-first_count,'messages written to',c.io.raw_filename)
         break
 
     print('END RUN')
@@ -110,5 +116,8 @@ if __name__ == '__main__':
     parser.add_argument('--outdir', default=_default_outdir, type=str, help='''Directory to send data files to''')
     parser.add_argument('--runtime', default=_default_runtime, type=float, help='''Time duration before flushing remaining data to disk and initiating a new run (in seconds) (default=%(default)s)''')
     parser.add_argument('--disabled_channels', default=_default_disabled_channels, type=json.loads, help='''json-formatted dict of <chip key>:[<channels>] you'd like disabled''')
+    parser.add_argument('--simulate', default=_default_simulate, nargs='?', const='', type=str, help='''Use the hardware-free PACMAN simulator, optionally with a JSON sim config file''')
+    parser.add_argument('--channel_rates', default=_default_channel_rates, action='store_true', help='''Print the data word rate of every io_group-io_channel with each message rate update''')
+    parser.add_argument('--trace', default=_default_trace, type=str, help='''Append per-stage timing and UART transaction counts to this JSON-lines file''')
     args = parser.parse_args()
     c = main(**vars(args))
@@ -3,12 +3,18 @@ import larpix.io
 import larpix.logger
 
 import base
+import packet_analysis
+import instrumentation
+import latency
+import config_store
+import confirmed_write
 import h5py
 import argparse
 import time
 import numpy as np
 import json
 from collections import Counter
+from copy import deepcopy
 
 _default_controller_config=None
 _default_pedestal_file=None
@@ -22,9 +28,17 @@ _default_cryo=False
 _default_vdda=1800
 _default_normalization=1.
 _default_verbose=False
+_default_batched_frontend=False
+_default_simulate=None
+_default_trace=None
 
 nonrouted_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
 
+def triggered_channel_rates(triggered_channels, null_sample_time):
+    ###### (chip x 64) trigger rate array from extracted [chip_key, channel_id] pairs
+    chip_keys, counts = packet_analysis.chip_channel_counts(triggered_channels)
+    return chip_keys, counts/null_sample_time
+
 def measure_background_rate_increase_trim(c, extreme_edge_chip_keys, null_sample_time, set_rate, verbose):
     print('=====> Rate threshold: ',set_rate,' Hz')
     flag = True
@@ -34,15 +48,15 @@ def measure_background_rate_increase_trim(c, extreme_edge_chip_keys, null_sample
         triggered_channels = c.reads[-1].extract('chip_key','channel_id',packet_type=0)
         print('total rate={}Hz'.format(len(triggered_channels)/null_sample_time))
         count = 0
-        for chip_key, channel in set(map(tuple,triggered_channels)):
-            rate = triggered_channels.count([chip_key,channel])/null_sample_time
-            if rate > set_rate:
-                count += 1
-                print(chip_key,' rate too high (',rate,
-                      ' Hz) increasinng channel ',channel,' trim DAC to 31')
-                if chip_key not in c.chips: continue
-                c[chip_key].config.pixel_trim_dac[channel] = 31
-                c.write_configuration(chip_key,[channel])
+        triggered_chip_keys, rates = triggered_channel_rates(triggered_channels, null_sample_time)
+        for ichip, channel in zip(*np.nonzero(rates > set_rate)):
+            chip_key, channel, rate = triggered_chip_keys[ichip], int(channel), rates[ichip, channel]
+            count += 1
+            print(chip_key,' rate too high (',rate,
+                  ' Hz) increasinng channel ',channel,' trim DAC to 31')
+            if chip_key not in c.chips: continue
+            c[chip_key].config.pixel_trim_dac[channel] = 31
+            c.write_configuration(chip_key,[channel])
         c.reads = []
         if count == 0: flag = False
 
@@ -61,21 +75,21 @@ def measure_background_rate_disable_csa(c, extreme_edge_chip_keys, csa_disable,
         print('total rate={}Hz'.format(len(triggered_channels)/null_sample_time))
         print('FIFO full flags {} half {}'.format(sum(fifo_flags), sum(fifo_half_full_flags)))
         count = 0
-        for chip_key, channel in set(map(tuple,triggered_channels)):
-            rate = triggered_channels.count([chip_key,channel])/null_sample_time
-            if rate > disable_rate:
-                count += 1
-                print(chip_key,' rate too high (',rate,
-                      ' Hz) disabling channel: ',channel)
-                if chip_key not in c.chips: continue
-                c.disable(chip_key,[channel])
-                c[chip_key].config.csa_enable[channel] = 0
-                c[chip_key].config.channel_mask[channel] = 1
-                c.write_configuration(chip_key,'csa_enable')
-                c.write_configuration(chip_key,'csa_enable')
-                c.write_configuration(chip_key,'channel_mask')
-                c.write_configuration(chip_key,'channel_mask')
-                csa_disable[chip_key].append(channel)
+        triggered_chip_keys, rates = triggered_channel_rates(triggered_channels, null_sample_time)
+        for ichip, channel in zip(*np.nonzero(rates > disable_rate)):
+            chip_key, channel, rate = triggered_chip_keys[ichip], int(channel), rates[ichip, channel]
+            count += 1
+            print(chip_key,' rate too high (',rate,
+                  ' Hz) disabling channel: ',channel)
+            if chip_key not in c.chips: continue
+            c.disable(chip_key,[channel])
+            c[chip_key].config.csa_enable[channel] = 0
+            c[chip_key].config.channel_mask[channel] = 1
+            c.write_configuration(chip_key,'csa_enable')
+            c.write_configuration(chip_key,'csa_enable')
+            c.write_configuration(chip_key,'channel_mask')
+            c.write_configuration(chip_key,'channel_mask')
+            csa_disable[chip_key].append(channel)
         c.reads = []
         if count == 0: flag = False
         #else:
@@ -117,36 +131,26 @@ def disable_multiple_channels(c, csa_disable):
 
 def find_pedestal(pedestal_file, noise_cut, c, verbose):
     count_noisy = 0
-    f = h5py.File(pedestal_file,'r')
-    data_mask = f['packets'][:]['packet_type']==0
-    valid_parity_mask = f['packets'][data_mask]['valid_parity']==1
-    good_data = (f['packets'][data_mask])[valid_parity_mask]
-    io_group = good_data['io_group'].astype(np.uint64)
-    io_channel = good_data['io_channel'].astype(np.uint64)
-    chip_id = good_data['chip_id'].astype(np.uint64)
-    channel_id = good_data['channel_id'].astype(np.uint64)
-    unique_channels = set(unique_channel_id(io_group, io_channel, chip_id, channel_id))
+    stats, livetime = packet_analysis.read_channel_statistics(pedestal_file, require_livetime=False)
 
     pedestal_channel, csa_disable = [{} for i in range(2)]
-    for unique in sorted(unique_channels):
-        channel_mask = unique_channel_id(io_group, io_channel, chip_id, channel_id) == unique
-
+    for i, unique in enumerate(stats['unique']):
         chip_key = from_unique_to_chip_key(unique)
         if chip_key not in c.chips: continue
 
         if from_unique_to_channel_id(unique) in nonrouted_channels:
             continue
 
-        adc = good_data[channel_mask]['dataword']
-        if len(adc) < 2 or np.mean(adc)>200. or np.std(adc)>noise_cut or np.mean(adc)==0:
+        mu, std = stats['mean'][i], stats['std'][i]
+        if stats['count'][i] < 2 or mu>200. or std>noise_cut or mu==0:
             if verbose: print(from_unique_to_chip_key(unique),' disabling channel',from_unique_to_channel_id(unique),
-                              ' with %.2f pedestal ADC RMS'%np.std(adc))
+                              ' with %.2f pedestal ADC RMS'%std)
             if chip_key not in csa_disable: csa_disable[chip_key] = []
             csa_disable[chip_key].append(from_unique_to_channel_id(unique))
             count_noisy += 1
             continue
 
-        pedestal_channel[unique] = dict(mu = np.mean(adc), std = np.std(adc))
+        pedestal_channel[unique] = dict(mu = mu, std = std)
 
     temp, temp_mu, temp_std = [ {} for i in range(3)]
     for unique in pedestal_channel.keys():
@@ -185,8 +189,8 @@ def disable_from_file(c, disabled_list, csa_disable):
                     c[chip_key].config.csa_enable[channel] = 0
                     if chip_key not in csa_disable: csa_disable[chip_key] = []
                     csa_disable[chip_key].append(channel)
-    c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
-    c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
+    ok, diff = confirmed_write.multi_write(c, chip_register_pairs, timeout=0.1, n=3, n_verify=3, connection_delay=0.001)
+    if not ok: print('config error:', diff)
     return csa_disable
 
 def from_ADC_to_mV(c, chip_key, adc, flag, vdda):
@@ -199,15 +203,17 @@ def find_mode(l):
     a = Counter(l)
     return a.most_common(1)
     
-def enable_frontend(c, channels, csa_disable, ):
-    chip_register_pairs = []
+def set_frontend_config(c, csa_disable):
+    ###### returns (chip key, registers) pairs per (io_group, io_channel), leaf chips first
+    chain_register_pairs = {}
     #for chip in c.chips:
     #    ok,diff = c.verify_registers([(chip, list(range(131,139))+list(range(66,74)))], timeout=0.1, n=3)
     #    if not ok: print('config error:', diff)
     for io_group, io_channels in c.network.items():
         for io_channel in io_channels:
+            chain_register_pairs[(io_group, io_channel)] = []
             for chip_key in c.get_network_keys(io_group,io_channel,root_first_traversal=False):
-                chip_register_pairs.append( (chip_key, list(range(131,139))+list(range(66,74))) )
+                chain_register_pairs[(io_group, io_channel)].append( (chip_key, list(range(131,139))+list(range(66,74))) )
                 for channel in range(64):
                     if chip_key in csa_disable:
                         if channel in csa_disable[chip_key]:
@@ -216,10 +222,17 @@ def enable_frontend(c, channels, csa_disable, ):
                             continue
                     c[chip_key].config.channel_mask[channel] = 0
                     c[chip_key].config.csa_enable[channel] = 1
+    return chain_register_pairs
+
+def enable_frontend(c, channels, csa_disable, ):
+    chain_register_pairs = set_frontend_config(c, csa_disable)
+    chip_register_pairs = [pair for pairs in chain_register_pairs.values() for pair in pairs]
 
     for pair in chip_register_pairs:
-        c.multi_write_configuration([pair], connection_delay=0.001)
-        c.multi_write_configuration([pair], connection_delay=0.001)
+        ###### confirmed before the rate check: a lost enable would measure a disabled chip
+        ok, diff = confirmed_write.multi_write(c, [pair], timeout=0.1, n=3, n_verify=3, connection_delay=0.001)
+        if not ok:
+            raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
         high_rate = True
         runtime = 0.5 #1
         while high_rate:
@@ -250,7 +263,7 @@ def enable_frontend(c, channels, csa_disable, ):
                 c.write_configuration(pair[0], registers)
             else:
                 high_rate = False
-            ok,diff = c.enforce_registers([pair], timeout=0.1, n=3, n_verify=3)
+            ok,diff = c.enforce_registers([pair], **latency.enforce_kwargs(c, [pair], timeout=0.1, n=3, n_verify=3))
             if not ok:
                 #print('config error:', diff)
                 raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
@@ -261,6 +274,40 @@ def enable_frontend(c, channels, csa_disable, ):
     #    ok,diff = c.enforce_registers([(chip_key, list(range(131, 139))+list(range(66,74)))], timeout=0.1, n=3, n_verify=3)
     #    if not ok: print('config error:', diff)
 
+def enable_frontend_batched(c, channels, csa_disable, runtime=0.5, rate_limit=2000):
+    ###### enables one chip per io_channel at a time, sharing each rate check window
+    chain_register_pairs = set_frontend_config(c, csa_disable)
+    n_rounds = max([len(pairs) for pairs in chain_register_pairs.values()]+[0])
+    for i_round in range(n_rounds):
+        round_pairs = [pairs[i_round] for pairs in chain_register_pairs.values() if i_round < len(pairs)]
+        ###### confirmed before the rate check: a lost enable would measure a disabled chip
+        ok, diff = confirmed_write.multi_write(c, round_pairs, timeout=0.1, n=3, n_verify=3, connection_delay=0.001)
+        if not ok:
+            raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
+        high_rate_pairs = round_pairs
+        while high_rate_pairs:
+            c.run(runtime,'check rate')
+            chip_triggers = Counter(c.reads[-1].extract('chip_key'))
+            fifo_half = c.reads[-1].extract('shared_fifo_half',packet_type=0)
+            fifo_full = c.reads[-1].extract('shared_fifo_full',packet_type=0)
+            print('\t\tfifo half full {} fifo full {}'.format(sum(fifo_half), sum(fifo_full)))
+            print('round {}/{} total packets {}\t{} chips'.format(i_round+1, n_rounds, len(c.reads[-1]), len(high_rate_pairs)))
+            threshold_pairs = []
+            for pair in high_rate_pairs:
+                if chip_triggers[pair[0]]/runtime <= rate_limit: continue
+                print('\t\t{} high rate channels! raise global threshold {}'.format(
+                    pair[0], c[pair[0]].config.threshold_global + 1))
+                c[pair[0]].config.threshold_global += 1
+                threshold_pairs.append( (pair[0], [123, 64]) )
+            if threshold_pairs:
+                c.multi_write_configuration(threshold_pairs, connection_delay=0.001)
+                c.multi_write_configuration(threshold_pairs, connection_delay=0.001)
+            ok,diff = c.enforce_registers(high_rate_pairs, **latency.enforce_kwargs(c, high_rate_pairs, timeout=0.1, n=3, n_verify=3))
+            if not ok:
+                raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
+            raised_keys = set([pair[0] for pair in threshold_pairs])
+            high_rate_pairs = [pair for pair in high_rate_pairs if pair[0] in raised_keys]
+
 def find_global_dac_seed(c, pedestal_chip, normalization, cryo, vdda, verbose):
     global_dac_lsb = vdda/256.
     offset = 210 # [mV] at 300 K
@@ -285,8 +332,8 @@ def find_global_dac_seed(c, pedestal_chip, normalization, cryo, vdda, verbose):
         c[chip_key].config.periodic_reset_cycles = 64 # registers [163-165]
         chip_register_pairs.append( (chip_key, list(range(0,65))+[128,163,164,165]) )
 
-    c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
-    c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
+    ok, diff = confirmed_write.multi_write(c, chip_register_pairs, timeout=0.1, n=3, n_verify=3, connection_delay=0.001)
+    if not ok: print('config error:', diff)
     return
 
 def load_trim_sigma(trim_sigma_file):
@@ -430,7 +477,8 @@ def update(c, status, csa_disable, channel):
         chip_register_pairs.append( (chip_key, [channel]) )
     c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
 
-def update_chip(c, status):
+def update_chip(c, status, shadow=None):
+    ###### shadow: {chip key: last written config}; if given, only changed registers are sent
     chip_register_pairs = []
     for chip_key in status.keys():
         chip_register_pairs.append( (chip_key, list(range(64))+ list(range(66,74)) +list(range(131,139) ) ))
@@ -440,7 +488,23 @@ def update_chip(c, status):
                 c[chip_key].config.csa_enable[channel] = 0
                 c[chip_key].config.channel_mask[channel] = 1
 
-    c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
+    if shadow is None:
+        c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
+        return
+    ###### compared per channel, so one changed trim sends one register rather than all 64
+    changed_pairs = []
+    for chip_key in status.keys():
+        config, last = c[chip_key].config, shadow[chip_key]
+        addresses = set()
+        for name in ['pixel_trim_dac','csa_enable','channel_mask']:
+            register_addresses = list(config.register_map[name])
+            values, last_values = getattr(config, name), getattr(last, name)
+            for channel in range(len(values)):
+                if values[channel] != last_values[channel]:
+                    addresses.add(register_addresses[channel*len(register_addresses)//len(values)])
+        if addresses: changed_pairs.append( (chip_key, sorted(addresses)) )
+        shadow[chip_key] = deepcopy(config)
+    if changed_pairs: c.multi_write_configuration(changed_pairs, connection_delay=0.001)
     return
 
 def silence_all(c, chip_keys):
@@ -463,6 +527,8 @@ def toggle_trim(c, channels, csa_disable, extreme_edge_chip_keys,
                 status[chip_key]['active'][channel] = False
                 status[chip_key]['disable'][channel] = True
 
+    shadow = dict([(chip_key, deepcopy(c[chip_key].config)) for chip_key in status])
+
     iter_ctr = 0
     flag = True
     while flag:
@@ -473,10 +539,11 @@ def toggle_trim(c, channels, csa_disable, extreme_edge_chip_keys,
         triggered_channels = c.reads[-1].extract('chip_key','channel_id',packet_type=0)
         print('total rate={}Hz'.format(len(triggered_channels)/null_sample_time))
         fired_channels = {}
-        for chip_key, channel in set(map(tuple,triggered_channels)):
+        triggered_chip_keys, rates = triggered_channel_rates(triggered_channels, null_sample_time)
+        for ichip, channel in zip(*np.nonzero(rates)):
+            chip_key, channel, rate = triggered_chip_keys[ichip], int(channel), rates[ichip, channel]
             if chip_key not in fired_channels: fired_channels[chip_key] = []
             fired_channels[chip_key].append(channel)
-            rate = triggered_channels.count([chip_key,channel])/null_sample_time
             if chip_key not in status.keys(): continue
             if status[chip_key]['active'][channel] == False: continue
 
@@ -511,7 +578,7 @@ def toggle_trim(c, channels, csa_disable, extreme_edge_chip_keys,
                     status[chip_key]['active'][channel] = False
                     if verbose: print('pixel trim bottomed out above noise floor!!!')
 
-        update_chip(c, status)
+        update_chip(c, status, shadow)
         count = 0
         for chip_key in status:
             if True in status[chip_key]['active']: count+=1
@@ -538,6 +605,10 @@ def save_config_to_file(c, chip_keys, csa_disable, verbose):
         config_filename = 'config-'+str(chip_key)+'-'+time_format+'.json'
         c[chip_key].config.write(config_filename, force=True)
         if verbose: print('\t',chip_key,'saved to',config_filename)
+    ###### all chips in one file as well, for enforce_loaded_config / plot_anode / config diffs
+    snapshot_filename = config_store.snapshot_filename_format.format(timestamp=time.strftime(config_store.time_format))
+    config_store.Snapshot.from_configs([(chip_key, c[chip_key].config) for chip_key in chip_keys]).write(snapshot_filename)
+    print('configuration snapshot saved to',snapshot_filename)
     return
 
 def save_stats(record):
@@ -557,11 +628,15 @@ def main(controller_config=_default_controller_config,
          vdda=_default_vdda,
          normalization=_default_normalization,
          verbose=_default_verbose,
+         batched_frontend=_default_batched_frontend,
+         simulate=_default_simulate,
+         trace=_default_trace,
          **kwargs):
 
     time_initial = time.time()
+    if trace: instrumentation.open_trace(trace)
 
-    c = base.main(controller_config=controller_config)
+    c = base.main(controller_config=controller_config, simulate=simulate)
     base.flush_data(c, runtime=2)
     print('START THRESHOLD\n')
 
@@ -575,43 +650,24 @@ def main(controller_config=_default_controller_config,
             extreme_edge_chip_keys += [larpix.Key(io_group, io_channel, chip_id) for chip_id in extreme_edge_chip_ids]
     read_extreme_edge = [(key,0) for key in extreme_edge_chip_keys]
 
-    timeStart = time.time()
-    pedestal_channel, pedestal_chip, csa_disable = find_pedestal(pedestal_file, noise_cut, c, verbose)
-    timeEnd = time.time()-timeStart
-    print('==> %.3f seconds --- pedestal evaluation \n\n'%timeEnd)
-
-    timeStart = time.time()
-    csa_disable = disable_from_file(c, disabled_list, csa_disable)
-    timeEnd = time.time()-timeStart
-    print('==> %.3f seconds --- disable channels from input list'%timeEnd)
-
-    timeStart = time.time()
-    find_global_dac_seed(c, pedestal_chip, normalization, cryo, vdda, verbose)
-    timeEnd = time.time()-timeStart
-    print('==> %.3f seconds --- set global DAC seed \n\n'%timeEnd)
-
-    timeStart = time.time()
-    enable_frontend(c, channels, csa_disable)
-    timeEnd  = time.time()-timeStart
-    print('==> %.3f seconds --- enable frontend \n\n'%timeEnd)
-
-    timeStart = time.time()
-    dr = disable_rate*50
-    csa_disable = measure_background_rate_disable_csa(c, extreme_edge_chip_keys, csa_disable, null_sample_time, dr, verbose)
-    timeEnd = time.time() - timeStart
-    print('==> %.3f seconds --- measured background rate with seeded global DAC & trim DAC maxed out\n --> silence channels that exceed rate\n\n'%timeEnd)
-
-    timeStart = time.time()
-    dr = disable_rate*5
-    csa_disable = measure_background_rate_disable_csa(c, extreme_edge_chip_keys, csa_disable, null_sample_time, dr, verbose)
-    timeEnd = time.time() - timeStart
-    print('==> %.3f seconds --- measured background rate with seeded global DAC & trim DAC maxed out\n --> silence channels that exceed rate\n\n'%timeEnd)
-
-    timeStart = time.time()
-    dr = disable_rate*0.5
-    csa_disable = measure_background_rate_disable_csa(c, extreme_edge_chip_keys, csa_disable, null_sample_time, dr, verbose)
-    timeEnd = time.time() - timeStart
-    print('==> %.3f seconds --- measured background rate with seeded global DAC & trim DAC maxed out\n --> silence channels that exceed rate\n\n'%timeEnd)
+    with instrumentation.stage('pedestal evaluation'):
+        pedestal_channel, pedestal_chip, csa_disable = find_pedestal(pedestal_file, noise_cut, c, verbose)
+
+    with instrumentation.stage('disable channels from input list'):
+        csa_disable = disable_from_file(c, disabled_list, csa_disable)
+
+    with instrumentation.stage('set global DAC seed'):
+        find_global_dac_seed(c, pedestal_chip, normalization, cryo, vdda, verbose)
+
+    with instrumentation.stage('enable frontend'):
+        if batched_frontend: enable_frontend_batched(c, channels, csa_disable)
+        else: enable_frontend(c, channels, csa_disable)
+
+    ###### measure background rate with seeded global DAC & trim DAC maxed out
+    ###### --> silence channels that exceed rate
+    for scale in [50, 5, 0.5]:
+        with instrumentation.stage('background rate disable CSA at {} Hz'.format(disable_rate*scale)):
+            csa_disable = measure_background_rate_disable_csa(c, extreme_edge_chip_keys, csa_disable, null_sample_time, disable_rate*scale, verbose)
 
     ###timeStart = time.time()
     ###trim_sigma = load_trim_sigma(trim_sigma_file)
@@ -638,19 +694,16 @@ def main(controller_config=_default_controller_config,
     ###timeEnd = time.time() - timeStart
     ###print('==> %.3f seconds --- measured background rate with seeded global & trim DACs\n --> trim DAC maxed out for channels that exceed rate\n\n'%timeEnd)
 
-    timeStart = time.time()
-    toggle_trim(c, channels, csa_disable, extreme_edge_chip_keys,
-                null_sample_time, set_rate, verbose)
-    timeEnd = time.time() - timeStart
-    print('==> %.3f seconds --- toggle trim DACs'%timeEnd)
+    with instrumentation.stage('toggle trim DACs'):
+        toggle_trim(c, channels, csa_disable, extreme_edge_chip_keys,
+                    null_sample_time, set_rate, verbose)
 
-    timeStart = time.time()
-    save_config_to_file(c, chip_keys, csa_disable, verbose)
-    timeEnd = time.time()-timeStart
-    print('==> %.3f seconds --- saving to json config file \n'%timeEnd)
+    with instrumentation.stage('saving to json config file'):
+        save_config_to_file(c, chip_keys, csa_disable, verbose)
 
     time10 = time.time()-time_initial
     print('END THRESHOLD ==> %.3f seconds total run time'%time10)
+    print('transactions:',instrumentation.summary())
     return c
 
 if __name__ == '__main__':
@@ -701,6 +754,19 @@ if __name__ == '__main__':
                         default=_default_verbose,
                         action='store_true',
                         help='''Print to screen debugging output''')
+    parser.add_argument('--batched_frontend',
+                        default=_default_batched_frontend,
+                        action='store_true',
+                        help='''Enable one chip per io_channel at a time, sharing rate checks across io_channels''')
+    parser.add_argument('--simulate',
+                        default=_default_simulate,
+                        nargs='?', const='',
+                        type=str,
+                        help='''Use the hardware-free PACMAN simulator, optionally with a JSON sim config file''')
+    parser.add_argument('--trace',
+                        default=_default_trace,
+                        type=str,
+                        help='''Append per-stage timing and UART transaction counts to this JSON-lines file''')
     args = parser.parse_args()
     c = main(**vars(args))
 
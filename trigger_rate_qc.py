@@ -3,6 +3,9 @@ import larpix.io
 import larpix.logger
 
 import base___no_enforce
+import packet_analysis
+import latency
+import confirmed_write
 
 import argparse
 import json
@@ -16,27 +19,53 @@ _default_chip_key=None
 _default_threshold=128
 _default_runtime=0.5
 _default_disabled_list=None
+_default_concurrent=False
+_default_reinitialize=False
+_default_simulate=None
 
 rate_cut=[10000,1000]#,100] #,10]
 suffix = ['no_cut','10kHz_cut','1kHz_cut','100Hz_cut']
 
 v2a_nonrouted_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
 
-def initial_setup(ctr, controller_config):
+def initial_setup(ctr, controller_config, simulate=_default_simulate):
     now = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     fname="trigger_rate_%s_" % suffix[ctr] #str(rate_cut[ctr])
     fname=fname+str(now)+".h5"
-    c = base___no_enforce.main(controller_config, logger=True, filename=fname)
+    c = base___no_enforce.main(controller_config, logger=True, filename=fname, simulate=simulate)
+    return c, fname
+
+def rearm(c, ctr):
+    ###### reuses an initialized controller: new logger file, all chips masked and silenced
+    now = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+    fname="trigger_rate_%s_" % suffix[ctr] #str(rate_cut[ctr])
+    fname=fname+str(now)+".h5"
+    if hasattr(c,'logger') and c.logger:
+        c.logger.flush()
+        c.logger.disable()
+    c.logger = larpix.logger.HDF5Logger(filename=fname)
+    print('filename:',c.logger.filename)
+
+    chip_register_pairs = []
+    for chip_key, chip in reversed(c.chips.items()):
+        chip.config.channel_mask=[1]*64
+        chip.config.csa_enable=[0]*64
+        chip.config.threshold_global = 255
+        chip_register_pairs.append( (chip_key, list(range(131,139))+[64]+list(range(66,74)) ) )
+    ok, diff = confirmed_write.multi_write(c, chip_register_pairs, timeout=0.01, n=10, n_verify=10)
+    if not ok: print('config error',diff)
+    base___no_enforce.flush_data(c)
+    c.logger.record_configs(list(c.chips.values()))
     return c, fname
 
 def find_mode(l):
     a = Counter(l)
     return a.most_common(1)
 
-def asic_test(c, chips_to_test, forbidden, threshold, runtime):
+def enable_chips(c, chip_keys, forbidden, threshold):
     channels = [i for i in range(0,64) if i not in v2a_nonrouted_channels]
-    c.io.double_send_packets = False
-    for chip_key in chips_to_test:
+    chip_register_pairs=[]
+    for chip_key in chip_keys:
         for channel in channels: #range(64):
             p = (chip_key,channel)
             if p in forbidden:
@@ -45,13 +74,33 @@ def asic_test(c, chips_to_test, forbidden, threshold, runtime):
             c[chip_key].config.channel_mask[channel] = 0
             c[chip_key].config.csa_enable[channel] = 1
         c[chip_key].config.threshold_global = threshold
-        chip_register_pairs=[]
         chip_register_pairs.append( (chip_key, list(range(131,139))+[64]+list(range(66,74)) ) )
-        c.multi_write_configuration(chip_register_pairs)
-        c.multi_write_configuration(chip_register_pairs)
-        ok, diff = c.enforce_configuration(chip_key, timeout=0.01, n=10, n_verify=10)
-        if not ok: print('config error',diff)
-        c.logger.record_configs([c[chip_key]])
+    ok, diff = confirmed_write.multi_write(c, chip_register_pairs, timeout=0.01, n=10, n_verify=10)
+    if not ok: print('config error',diff)
+    c.logger.record_configs([c[chip_key] for chip_key in chip_keys])
+    return chip_register_pairs
+
+def disable_chips(c, chip_register_pairs):
+    chip_keys = [pair[0] for pair in chip_register_pairs]
+    for chip_key in chip_keys:
+        c[chip_key].config.channel_mask=[1]*64
+        c[chip_key].config.csa_enable=[0]*64
+        c[chip_key].config.threshold_global = 255
+    ok, diff = confirmed_write.multi_write(c, chip_register_pairs, timeout=0.01, n=10, n_verify=10)
+    if not ok: print('config error',diff)
+    c.logger.record_configs([c[chip_key] for chip_key in chip_keys])
+
+def verify_pass(c, chip_keys):
+    ###### whole-chip enforce once per pass: per-chip writes only confirm the registers they touch
+    chip_keys = list(chip_keys)
+    ok, diff = c.enforce_configuration(chip_keys, **latency.configuration_kwargs(c, chip_keys, timeout=0.01, n=10, n_verify=10))
+    if not ok: print('config error',diff)
+    return ok, diff
+
+def asic_test(c, chips_to_test, forbidden, threshold, runtime):
+    c.io.double_send_packets = False
+    for chip_key in chips_to_test:
+        chip_register_pairs = enable_chips(c, [chip_key], forbidden, threshold)
 
         base___no_enforce.flush_data(c)
         c.logger.enable()
@@ -62,15 +111,58 @@ def asic_test(c, chips_to_test, forbidden, threshold, runtime):
         channel_triggers = c.reads[-1].extract('channel_id',chip_key=chip_key)
         print(chip_key,'\ttriggers:',len(c.reads[-1]),'\trate: {:0.2f}Hz'.format(len(c.reads[-1])/runtime),'\t offending chip, triggers',find_mode(chip_triggers),'\toffending channel, triggers: {}'.format(find_mode(channel_triggers)))
         
-        c[chip_key].config.channel_mask=[1]*64
-        c[chip_key].config.csa_enable=[0]*64
-        c[chip_key].config.threshold_global = 255
-        c.multi_write_configuration(chip_register_pairs)
-        c.multi_write_configuration(chip_register_pairs)
-        ok, diff = c.enforce_configuration(chip_key, timeout=0.01, n=10, n_verify=10)
-        if not ok: print('config error',diff)
-        c.logger.record_configs([c[chip_key]])
+        disable_chips(c, chip_register_pairs)
+
+def schedule_concurrent_rounds(chips_to_test):
+    ###### one chip per (io_group, io_channel) per round; chains are independent UARTs
+    chains = {}
+    for chip_key in chips_to_test:
+        chip_key = larpix.Key(chip_key)
+        chains.setdefault((chip_key.io_group, chip_key.io_channel), []).append(chip_key)
+    n_rounds = max([len(chain) for chain in chains.values()]+[0])
+    return [[chain[i] for chain in chains.values() if i < len(chain)] for i in range(n_rounds)]
+
+def asic_test_concurrent(c, chips_to_test, forbidden, threshold, runtime):
+    c.io.double_send_packets = False
+    rounds = schedule_concurrent_rounds(chips_to_test)
+    ambiguous = []
+    for i_round, round_keys in enumerate(rounds):
+        chip_register_pairs = enable_chips(c, round_keys, forbidden, threshold)
 
+        base___no_enforce.flush_data(c)
+        c.run(runtime,'collect data')
+        packets = c.reads[-1]
+
+        # a chip's rate is ambiguous if its chain carried packets from other
+        # chips or its FIFO reported overflow during the shared window
+        enabled = set(round_keys)
+        # (timestamp, sync and trigger packets carry no chip_key)
+        chip_packets = [p for p in packets if p.packet_type == 0 and p.chip_key is not None]
+        stray_chains = set([(p.chip_key.io_group, p.chip_key.io_channel) for p in chip_packets if p.chip_key not in enabled])
+        fifo_flagged = set([p.chip_key for p in chip_packets if p.shared_fifo_half or p.shared_fifo_full])
+        resolved = []
+        for chip_key in round_keys:
+            if (chip_key.io_group, chip_key.io_channel) in stray_chains or chip_key in fifo_flagged:
+                ambiguous.append(chip_key)
+                continue
+            resolved.append(chip_key)
+        chip_triggers = Counter(packets.extract('chip_key'))
+        for chip_key in resolved:
+            print(chip_key,'\ttriggers:',chip_triggers[chip_key],'\trate: {:0.2f}Hz'.format(chip_triggers[chip_key]/runtime))
+        print('round {}/{}: {} chips resolved, {} ambiguous'.format(i_round+1, len(rounds), len(resolved), len(round_keys)-len(resolved)))
+
+        c.logger.enable()
+        resolved = set(resolved)
+        ###### timestamp packets are kept: evaluate_rate takes the livetime from them
+        c.logger.record([p for p in packets if p.packet_type == 4 or (p.packet_type == 0 and p.chip_key in resolved)])
+        c.logger.flush()
+        c.logger.disable()
+
+        disable_chips(c, chip_register_pairs)
+
+    if ambiguous:
+        print('==> \tisolating',len(ambiguous),'ASICs with ambiguous rates')
+        asic_test(c, ambiguous, forbidden, threshold, runtime)
               
 def unique_channel_id(io_group, io_channel, chip_id, channel_id):
     return channel_id + 100*(chip_id + 1000*(io_channel + 1000*(io_group)))
@@ -90,19 +182,9 @@ def from_unique_to_channel_id(unique):
               
               
 def evaluate_rate(fname, ctr, runtime, forbidden):
-    f = h5py.File(fname,'r')
-    data_mask=f['packets'][:]['packet_type']==0
-    data=f['packets'][data_mask]
-
-    io_group=data['io_group'].astype(np.uint64)
-    io_channel=data['io_channel'].astype(np.uint64)
-    chip_id=data['chip_id'].astype(np.uint64)
-    channel_id=data['channel_id'].astype(np.uint64)
-    unique_channels = set(unique_channel_id(io_group, io_channel, chip_id, channel_id))
-
-    for unique in sorted(unique_channels):
-        channel_mask = unique_channel_id(io_group, io_channel, chip_id, channel_id) == unique
-        triggers = len(data[channel_mask]['dataword'])
+    stats, livetime = packet_analysis.read_channel_statistics(fname, valid_parity_only=False, require_livetime=False)
+
+    for unique, triggers in zip(stats['unique'], stats['count']):
         if triggers/runtime > rate_cut[ctr]:
             pair = ( chip_key_to_string(from_unique_to_chip_key(unique)), from_unique_to_channel_id(unique) )
             if pair not in forbidden:
@@ -129,10 +211,10 @@ def save_do_not_enable_list(forbidden):
         return 
 
               
-def main(controller_config=_default_controller_config, chip_key=_default_chip_key, threshold=_default_threshold, runtime=_default_runtime, disabled_list=_default_disabled_list):
+def main(controller_config=_default_controller_config, chip_key=_default_chip_key, threshold=_default_threshold, runtime=_default_runtime, disabled_list=_default_disabled_list, concurrent=_default_concurrent, reinitialize=_default_reinitialize, simulate=_default_simulate):
     print('START ITERATIVE TRIGGER RATE TEST')
 
-    c = base___no_enforce.main(controller_config)
+    c = base___no_enforce.main(controller_config, simulate=simulate)
     chips_to_test = c.chips.keys()
     if not chip_key is None: chips_to_test = [chip_key]
     print('chips to test: ',chips_to_test)
@@ -155,9 +237,12 @@ def main(controller_config=_default_controller_config, chip_key=_default_chip_ke
     print('==> \tinitial channel disable list set')
 
     for ctr in range(len(rate_cut)):
-        c, fname = initial_setup(ctr, controller_config)
+        if reinitialize: c, fname = initial_setup(ctr, controller_config, simulate)
+        else: c, fname = rearm(c, ctr)
         print('==> \ttesting ASICs with ',rate_cut[ctr],' Hz trigger rate threshold')
-        asic_test(c, chips_to_test, forbidden, threshold, runtime)
+        if concurrent: asic_test_concurrent(c, chips_to_test, forbidden, threshold, runtime)
+        else: asic_test(c, chips_to_test, forbidden, threshold, runtime)
+        verify_pass(c, chips_to_test)
         if ctr==3: continue
         n_initial=len(forbidden)
         forbidden = evaluate_rate(fname, ctr, runtime, forbidden)
@@ -176,6 +261,9 @@ if __name__ == '__main__':
     parser.add_argument('--threshold', default=_default_threshold, type=int, help='''Global threshold value to set (default=%(default)s)''')
     parser.add_argument('--runtime', default=_default_runtime, type=float, help='''Duration for run (in seconds) (default=%(default)s)''')
     parser.add_argument('--disabled_list', default=_default_disabled_list, type=str, help='''File containing json-formatted dict of <chip key>:[<channels>] to disable''')
+    parser.add_argument('--concurrent', default=_default_concurrent, action='store_true', help='''Test one ASIC per io_channel at a time, isolating only ASICs with ambiguous rates''')
+    parser.add_argument('--reinitialize', default=_default_reinitialize, action='store_true', help='''Re-run the full base setup before each rate cut pass instead of reusing the controller''')
+    parser.add_argument('--simulate', default=_default_simulate, nargs='?', const='', type=str, help='''Use the hardware-free PACMAN simulator, optionally with a JSON sim config file''')
     args = parser.parse_args()
     c = main(**vars(args))
 